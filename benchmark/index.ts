@@ -2,9 +2,9 @@ import type { ClickHouseSummary } from "@clickhouse/client-common/dist/clickhous
 import fs from "fs";
 import path from "path";
 
-import { OptimizationConfig, QueryConfig } from "./types/optimization-config";
+import { OptimizationConfig } from "./types/optimization-config";
+import { buildQueries } from "./util/build-queries";
 import { getClient, querySettings } from "./util/get-client";
-import { replaceQueryPlaceholders } from "./util/placeholders";
 import { runScriptsInFolder } from "./util/run-scripts-in-folder";
 import { beforeAllOptimizations } from "./util/setup";
 import { mean, tStat, variance } from "./util/summary-stats";
@@ -38,23 +38,6 @@ process.on("uncaughtException", async (err) => {
 
 const readFile = (filePath: string) => fs.readFileSync(filePath).toString();
 
-const buildQueries = async (queryConfig: QueryConfig) => {
-  const { getReplacements } = await import(
-    `./queries/${queryConfig.replacementScript}`
-  );
-  const replacements = await getReplacements();
-  const baselineQuery = replaceQueryPlaceholders(
-    path.join("queries", queryConfig.baseline.query),
-    { ...replacements, ...queryConfig.baseline.replacements }
-  );
-  const benchmarkQuery = replaceQueryPlaceholders(
-    path.join("queries", queryConfig.benchmark.query),
-    { ...replacements, ...queryConfig.benchmark.replacements }
-  );
-
-  return { baselineQuery, benchmarkQuery };
-};
-
 const runBenchmark = async () => {
   await beforeAllOptimizations();
 
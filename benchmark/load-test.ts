@@ -0,0 +1,286 @@
+import fs from "fs";
+import path from "path";
+
+import { OptimizationConfig } from "./types/optimization-config";
+import { buildQueries } from "./util/build-queries";
+import { getClient, getLoadClient, querySettings } from "./util/get-client";
+import { runScriptsInFolder } from "./util/run-scripts-in-folder";
+import { beforeAllOptimizations } from "./util/setup";
+import { mean, percentile } from "./util/summary-stats";
+import { cleanup } from "./util/teardown";
+
+/**
+ * Replays randomized flux queries against each optimization's baseline and benchmark
+ * queries with many queries in flight, as when many map users query at once.
+ *
+ * Queries are either run by LOAD_CONCURRENCY workers back to back (closed loop), or,
+ * when LOAD_RATE is set, started at that many queries per second with exponentially
+ * distributed gaps (open loop). Open loop latencies are measured from the time a
+ * query was due to start, so that a saturated server isn't hidden by queries
+ * starting late. Either way, at most LOAD_CONCURRENCY queries are sent to ClickHouse
+ * at once.
+ */
+
+type Variant = "baseline" | "benchmark";
+
+type QueryLogStats = {
+  read_rows: string;
+  read_bytes: string;
+  memory_usage: string;
+  query_duration_ms: string;
+};
+
+type LoadResult = {
+  queries: number;
+  errors: number;
+  elapsedS: number;
+  throughputQps: number;
+  latencyMs: Record<"mean" | "p50" | "p95" | "p99" | "max", number>;
+  readRows: Record<"mean" | "p95", number>;
+  readBytes: Record<"mean" | "p95", number>;
+  memoryUsage: Record<"mean" | "p95" | "max", number>;
+};
+
+type LoadTestResult = Record<
+  string,
+  { query: string; baseline: LoadResult; benchmark: LoadResult }[]
+>;
+
+const envNumber = (name: string, fallback?: number) =>
+  process.env[name] ? Number(process.env[name]) : fallback;
+
+const config = {
+  concurrency: envNumber("LOAD_CONCURRENCY", 8)!,
+  rate: envNumber("LOAD_RATE"),
+  queries: envNumber("LOAD_QUERIES", 200)!,
+  warmupQueries: envNumber("LOAD_WARMUP_QUERIES", 5)!,
+  optimizations: process.env.LOAD_OPTIMIZATIONS?.split(","),
+};
+
+const optimizationsDir = "optimizations";
+
+const client = getClient();
+const loadClient = getLoadClient(config.concurrency);
+const runId = `load-${Date.now()}`;
+
+let beforeExit: ((...args: any[]) => Promise<void>) | undefined = undefined;
+
+process.on("SIGINT", async () => {
+  await cleanup(beforeExit);
+});
+
+process.on("exit", async () => {
+  await cleanup(beforeExit);
+});
+
+process.on("uncaughtException", async (err) => {
+  console.error(err);
+  await cleanup(beforeExit);
+});
+
+const readFile = (filePath: string) => fs.readFileSync(filePath).toString();
+
+const sleep = (ms: number) => new Promise((resolve) => setTimeout(resolve, ms));
+
+const runQuery = async (query: string, queryId: string, dueAt: number) => {
+  await loadClient.command({
+    query,
+    query_id: queryId,
+    clickhouse_settings: querySettings,
+  });
+  return performance.now() - dueAt;
+};
+
+/**
+ * Runs the queries under load, returning the latency of each successful query by
+ * query id
+ */
+const runLoad = async (queries: string[], queryIdPrefix: string) => {
+  const latencies: Record<string, number> = {};
+  let errors = 0;
+  const run = async (i: number, dueAt: number) => {
+    const queryId = `${queryIdPrefix}-${i}`;
+    try {
+      latencies[queryId] = await runQuery(queries[i], queryId, dueAt);
+    } catch (err) {
+      errors++;
+      console.error("error running query", { queryId, err });
+    }
+  };
+
+  const start = performance.now();
+  if (config.rate) {
+    const running: Promise<void>[] = [];
+    let dueAt = start;
+    for (let i = 0; i < queries.length; i++) {
+      await sleep(dueAt - performance.now());
+      running.push(run(i, dueAt));
+      dueAt += (-Math.log(1 - Math.random()) / config.rate) * 1000;
+    }
+    await Promise.all(running);
+  } else {
+    let next = 0;
+    const worker = async () => {
+      while (next < queries.length) {
+        const i = next++;
+        await run(i, performance.now());
+      }
+    };
+    await Promise.all(Array(config.concurrency).fill(undefined).map(worker));
+  }
+
+  return { latencies, errors, elapsedS: (performance.now() - start) / 1000 };
+};
+
+const getQueryLogStats = async (queryIdPrefix: string) => {
+  await client.command({ query: "SYSTEM FLUSH LOGS" });
+  const response = await client.query({
+    query: `
+      SELECT query_id, read_rows, read_bytes, memory_usage, query_duration_ms
+      FROM system.query_log
+      WHERE type = 'QueryFinish'
+        AND startsWith(query_id, {prefix: String})
+    `,
+    query_params: { prefix: `${queryIdPrefix}-` },
+    format: "JSONEachRow",
+  });
+  return (await response.json<QueryLogStats & { query_id: string }>()).reduce(
+    (acc, { query_id, ...stats }) => {
+      acc[query_id] = stats;
+      return acc;
+    },
+    {} as Record<string, QueryLogStats>
+  );
+};
+
+const summarize = async (
+  queryIdPrefix: string,
+  { latencies, errors, elapsedS }: Awaited<ReturnType<typeof runLoad>>
+): Promise<LoadResult> => {
+  const latency = Object.values(latencies);
+  const queryLog = Object.values(await getQueryLogStats(queryIdPrefix));
+  const column = (name: keyof QueryLogStats) =>
+    queryLog.map((stats) => parseInt(stats[name], 10));
+  const [readRows, readBytes, memoryUsage] = [
+    column("read_rows"),
+    column("read_bytes"),
+    column("memory_usage"),
+  ];
+
+  return {
+    queries: latency.length,
+    errors,
+    elapsedS,
+    throughputQps: latency.length / elapsedS,
+    latencyMs: {
+      mean: mean(latency),
+      p50: percentile(latency, 0.5),
+      p95: percentile(latency, 0.95),
+      p99: percentile(latency, 0.99),
+      max: Math.max(...latency),
+    },
+    readRows: { mean: mean(readRows), p95: percentile(readRows, 0.95) },
+    readBytes: { mean: mean(readBytes), p95: percentile(readBytes, 0.95) },
+    memoryUsage: {
+      mean: mean(memoryUsage),
+      p95: percentile(memoryUsage, 0.95),
+      max: Math.max(...memoryUsage),
+    },
+  };
+};
+
+const runLoadTest = async () => {
+  await beforeAllOptimizations();
+
+  const optimizations = fs
+    .readdirSync(optimizationsDir)
+    .filter((file) => !file.startsWith("_") && !file.startsWith("."))
+    .filter(
+      (file) => !config.optimizations || config.optimizations.includes(file)
+    );
+
+  const data: LoadTestResult = {};
+
+  for (let optimizationName of optimizations) {
+    const optimizationDir = path.join("optimizations", optimizationName);
+    const setupPath = path.join(optimizationDir, "setup");
+    const teardownPath = path.join(optimizationDir, "teardown");
+
+    beforeExit = async () => {
+      console.log("cleaning up", { optimization: optimizationName });
+      await runScriptsInFolder(teardownPath, true);
+    };
+
+    const { queries: queryConfigs } = JSON.parse(
+      readFile(path.join(optimizationDir, "config.json"))
+    ) as OptimizationConfig;
+
+    console.log("running setup", { optimization: optimizationName });
+    await runScriptsInFolder(setupPath);
+
+    try {
+      for (let [j, queryConfig] of queryConfigs.entries()) {
+        // filters are drawn before the load starts, as drawing a start date is
+        // itself a query
+        const queries: Record<Variant, string[]> = {
+          baseline: [],
+          benchmark: [],
+        };
+        for (let i = 0; i < config.queries; i++) {
+          const { baselineQuery, benchmarkQuery } = await buildQueries(
+            queryConfig
+          );
+          queries.baseline.push(baselineQuery);
+          queries.benchmark.push(benchmarkQuery);
+        }
+
+        const result = {} as Record<Variant, LoadResult>;
+        for (let variant of ["baseline", "benchmark"] as Variant[]) {
+          console.log("running load", {
+            optimization: optimizationName,
+            variant,
+            ...config,
+          });
+          for (let query of queries[variant].slice(0, config.warmupQueries)) {
+            await client.command({ query, clickhouse_settings: querySettings });
+          }
+          const queryIdPrefix = `${runId}-${optimizationName}-${j}-${variant}`;
+          result[variant] = await summarize(
+            queryIdPrefix,
+            await runLoad(queries[variant], queryIdPrefix)
+          );
+          console.log("ran load", { variant, ...result[variant].latencyMs });
+        }
+
+        data[optimizationName] ??= [];
+        data[optimizationName].push({
+          query: queryConfig.benchmark.query,
+          ...result,
+        });
+      }
+    } catch (err) {
+      console.error("error running load test");
+      console.error(err);
+    } finally {
+      await beforeExit();
+    }
+  }
+
+  return data;
+};
+
+const writeResults = (data: LoadTestResult) => {
+  const outputPath = path.join(__dirname, "load-results.json");
+  fs.writeFileSync(
+    outputPath,
+    JSON.stringify({ config, results: data }, null, 2)
+  );
+};
+
+runLoadTest()
+  .then(writeResults)
+  .then(() => console.log("success"))
+  .catch((e) => {
+    console.error(e);
+    process.exit(1);
+  });
@@ -0,0 +1,20 @@
+CREATE TABLE
+  outbound_rollups (
+    date Date,
+    hour Int8,
+    day_of_week Int8,
+    station_id String,
+    trips Int64
+  ) ENGINE = SummingMergeTree ()
+ORDER BY
+  (date, station_id, hour, day_of_week) AS (
+    SELECT
+      r.date,
+      r.hour,
+      r.day_of_week,
+      cs.short_name AS station_id,
+      r.trips
+    FROM
+      file ('rollups/outbound/**/*.parquet', Parquet) r
+      JOIN current_stations cs ON r.station_id = cs.station_id
+  );
\ No newline at end of file
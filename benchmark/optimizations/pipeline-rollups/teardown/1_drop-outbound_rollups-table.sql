@@ -0,0 +1 @@
+DROP TABLE IF EXISTS outbound_rollups;
\ No newline at end of file
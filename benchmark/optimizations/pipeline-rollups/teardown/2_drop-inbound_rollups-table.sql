@@ -0,0 +1 @@
+DROP TABLE IF EXISTS inbound_rollups;
\ No newline at end of file
@@ -0,0 +1,31 @@
+SELECT
+  it.station_id AS stationId,
+  it.c AS inbound,
+  ot.c AS outbound
+FROM
+  (
+    SELECT
+      station_id,
+      SUM(trips) AS c
+    FROM
+      {{outbound_rollups_table}}
+    WHERE
+      date BETWEEN '{{startDate}}' AND '{{endDate}}'
+      AND hour BETWEEN intDiv({{startTime}}, 10000) AND intDiv({{endTime}}, 10000)
+      AND day_of_week IN ({{daysOfWeek}})
+    GROUP BY
+      station_id
+  ) ot
+  JOIN (
+    SELECT
+      station_id,
+      SUM(trips) AS c
+    FROM
+      {{inbound_rollups_table}}
+    WHERE
+      date BETWEEN '{{startDate}}' AND '{{endDate}}'
+      AND hour BETWEEN intDiv({{startTime}}, 10000) AND intDiv({{endTime}}, 10000)
+      AND day_of_week IN ({{daysOfWeek}})
+    GROUP BY
+      station_id
+  ) it ON ot.station_id = it.station_id;
\ No newline at end of file
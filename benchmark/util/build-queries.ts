@@ -0,0 +1,21 @@
+import path from "path";
+
+import { QueryConfig } from "../types/optimization-config";
+import { replaceQueryPlaceholders } from "./placeholders";
+
+export const buildQueries = async (queryConfig: QueryConfig) => {
+  const { getReplacements } = await import(
+    `../queries/${queryConfig.replacementScript}`
+  );
+  const replacements = await getReplacements();
+  const baselineQuery = replaceQueryPlaceholders(
+    path.join("queries", queryConfig.baseline.query),
+    { ...replacements, ...queryConfig.baseline.replacements }
+  );
+  const benchmarkQuery = replaceQueryPlaceholders(
+    path.join("queries", queryConfig.benchmark.query),
+    { ...replacements, ...queryConfig.benchmark.replacements }
+  );
+
+  return { baselineQuery, benchmarkQuery };
+};
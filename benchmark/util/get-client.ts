@@ -4,20 +4,31 @@ let client: ClickHouseClient;
 
 const timeout = Math.pow(2, 31) - 1;
 
+const createBenchmarkClient = (maxOpenConnections?: number) =>
+  createClient({
+    url: "http://localhost:8123",
+    request_timeout: timeout,
+    ...(maxOpenConnections ? { max_open_connections: maxOpenConnections } : {}),
+    clickhouse_settings: {
+      mutations_sync: "1",
+      session_timeout: timeout,
+    },
+  });
+
 export const getClient = () => {
   if (!client) {
-    client = createClient({
-      url: "http://localhost:8123",
-      request_timeout: timeout,
-      clickhouse_settings: {
-        mutations_sync: "1",
-        session_timeout: timeout,
-      },
-    });
+    client = createBenchmarkClient();
   }
   return client;
 };
 
+/**
+ * A client with a connection per concurrent query, as the shared client's pool would
+ * otherwise queue queries of a load test on the client side
+ */
+export const getLoadClient = (concurrency: number) =>
+  createBenchmarkClient(concurrency);
+
 export const querySettings = {
   use_query_cache: 0,
   enable_reads_from_query_cache: 0,
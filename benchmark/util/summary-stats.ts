@@ -11,3 +11,7 @@ export const tStat = (
   var2: number,
   n2: number
 ) => (mean1 - mean2) / Math.sqrt(var1 / n1 + var2 / n2);
+export const percentile = (sample: number[], p: number) => {
+  const sorted = [...sample].sort((a, b) => a - b);
+  return sorted[Math.min(sorted.length - 1, Math.floor(p * sorted.length))];
+};
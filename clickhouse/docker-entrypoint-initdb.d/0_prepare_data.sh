@@ -1,6 +1,8 @@
 #!/bin/bash
 
-# get GBFS station data and dump to file
-rm -f /var/lib/clickhouse/user_files/stations.json
-wget -q -O - https://gbfs.lyft.com/gbfs/1.1/bkn/en/station_information.json | jq '.data.stations' >> \
-  /var/lib/clickhouse/user_files/stations.json
+# get GBFS station data and dump to file, unless the pipeline has already
+# snapshotted the stations it resolved trips against
+if [ ! -f /var/lib/clickhouse/user_files/stations.json ]; then
+  wget -q -O - https://gbfs.lyft.com/gbfs/1.1/bkn/en/station_information.json | jq '.data.stations' >> \
+    /var/lib/clickhouse/user_files/stations.json
+fi
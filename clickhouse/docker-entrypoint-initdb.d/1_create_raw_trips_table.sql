@@ -17,7 +17,9 @@ CREATE TABLE
     member_casual String,
     bike_id String,
     gender String,
-    birth_year Int64
+    birth_year Int64,
+    start_current_station_id String,
+    end_current_station_id String
   ) ENGINE = MergeTree ()
 ORDER BY
   tuple () AS (
@@ -37,7 +39,9 @@ ORDER BY
       member_casual,
       bike_id,
       gender,
-      birth_year
+      birth_year,
+      start_current_station_id,
+      end_current_station_id
     FROM
-      file ('parquet/*.parquet', Parquet)
+      file ('parquet/**/*.parquet', Parquet)
   );
\ No newline at end of file
@@ -21,19 +21,5 @@ SELECT
   rt.birth_year
 FROM
   raw_trips rt
-  JOIN current_stations cs_s ON (
-    rt.start_station_name = cs_s.name
-    OR rt.start_station_id = cs_s.short_name
-    OR (
-      rt.start_lat = cs_s.latitude
-      AND rt.start_lng = cs_s.longitude
-    )
-  )
-  JOIN current_stations cs_e ON (
-    rt.end_station_name = cs_e.name
-    OR rt.end_station_id = cs_e.short_name
-    OR (
-      rt.end_lat = cs_e.latitude
-      AND rt.end_lng = cs_e.longitude
-    )
-  );
\ No newline at end of file
+  JOIN current_stations cs_s ON rt.start_current_station_id = cs_s.station_id
+  JOIN current_stations cs_e ON rt.end_current_station_id = cs_e.station_id;
\ No newline at end of file
@@ -0,0 +1,10 @@
+import { getFluxMetrics } from "@/lib/flux-cache";
+
+// metrics are per server process, so they must not be rendered at build time
+export const dynamic = "force-dynamic";
+
+export async function GET() {
+  return new Response(JSON.stringify(getFluxMetrics()), {
+    headers: { "Content-Type": "application/json" },
+  });
+}
@@ -0,0 +1,300 @@
+import { getClient } from "@/lib/clickhouse-client";
+import { LruCache } from "@/lib/lru-cache";
+import dayjs, { Dayjs } from "dayjs";
+
+export type FluxQuery = {
+  startDate: string;
+  endDate: string;
+  startTime?: string;
+  endTime?: string;
+  daysOfWeek?: string[];
+};
+
+export type StationCounts = Record<
+  string,
+  { inbound: number; outbound: number }
+>;
+
+type Granularity = "day" | "month";
+
+type Segment = {
+  key: string;
+  granularity: Granularity;
+  start: Dayjs;
+  end: Dayjs;
+};
+
+const SEGMENT_FORMATS: Record<Granularity, { key: string; sql: string }> = {
+  day: { key: "YYYYMMDD", sql: "%Y%m%d" },
+  month: { key: "YYYYMM", sql: "%Y%m" },
+};
+
+const envInt = (name: string, fallback: number) =>
+  Number.parseInt(process.env[name] ?? "") || fallback;
+
+const MB = 1024 * 1024;
+
+// a segment holds the counts of every station, so a few thousand segments cover
+// years of days and months for the filters in use. Segments grow with the number
+// of stations, so the cache is also bounded by their serialized size
+const segmentCache = new LruCache<string, StationCounts>(
+  envInt("FLUX_CACHE_MAX_SEGMENTS", 5000),
+  envInt("FLUX_CACHE_TTL_MS", 1000 * 60 * 60),
+  envInt("FLUX_CACHE_MAX_SEGMENT_MB", 256) * MB
+);
+
+// merged responses, so that repeating a query doesn't merge its segments again
+export const fluxResultCache = new LruCache<string, unknown>(
+  envInt("FLUX_CACHE_MAX_RESULTS", 100),
+  envInt("FLUX_CACHE_TTL_MS", 1000 * 60 * 60),
+  envInt("FLUX_CACHE_MAX_RESULT_MB", 64) * MB
+);
+
+const LATENCY_SAMPLES = 1000;
+const latencies: Record<"request" | "clickhouse", number[]> = {
+  request: [],
+  clickhouse: [],
+};
+const segmentCounts = { requested: 0, queried: 0, clickhouseQueries: 0 };
+
+export const recordLatency = (name: keyof typeof latencies, ms: number) => {
+  const samples = latencies[name];
+  samples.push(ms);
+  if (samples.length > LATENCY_SAMPLES) {
+    samples.shift();
+  }
+};
+
+const summarizeLatency = (samples: number[]) => {
+  const sorted = [...samples].sort((a, b) => a - b);
+  const percentile = (p: number) =>
+    sorted.length
+      ? sorted[Math.min(sorted.length - 1, Math.floor(p * sorted.length))]
+      : null;
+
+  return {
+    samples: sorted.length,
+    p50: percentile(0.5),
+    p95: percentile(0.95),
+    p99: percentile(0.99),
+  };
+};
+
+export const getFluxMetrics = () => ({
+  segmentCache: segmentCache.stats(),
+  resultCache: fluxResultCache.stats(),
+  segments: segmentCounts,
+  latencyMs: {
+    request: summarizeLatency(latencies.request),
+    clickhouse: summarizeLatency(latencies.clickhouse),
+  },
+});
+
+/**
+ * Splits the days from the start date to the end date (inclusive) into whole
+ * calendar months, and single days where the range starts or ends mid-month. Segments
+ * are aligned to the calendar so that overlapping ranges share them.
+ */
+export const getSegments = (startDate: string, endDate: string) => {
+  const segments: Segment[] = [];
+  const end = dayjs(endDate, "YYYYMMDD").add(1, "day");
+  let day = dayjs(startDate, "YYYYMMDD");
+  while (day.isBefore(end)) {
+    const nextMonth = day.startOf("month").add(1, "month");
+    const granularity =
+      day.date() === 1 && !nextMonth.isAfter(end) ? "month" : "day";
+    const next = granularity === "month" ? nextMonth : day.add(1, "day");
+    segments.push({
+      key: day.format(SEGMENT_FORMATS[granularity].key),
+      granularity,
+      start: day,
+      end: next,
+    });
+    day = next;
+  }
+
+  return segments;
+};
+
+/**
+ * The time of day and day of week filters, which apply the same way to every segment
+ */
+const getFilterCondition = (
+  { startTime, endTime, daysOfWeek }: FluxQuery,
+  field: "started_at" | "ended_at"
+) => {
+  let condition = "1";
+
+  if (startTime && endTime) {
+    const start = Number.parseInt(startTime);
+    const end = Number.parseInt(endTime);
+    if (start > end) {
+      condition += `
+        AND (
+          toYYYYMMDDhhmmss(${field}) % 1000000 > ${start}
+          OR toYYYYMMDDhhmmss(${field}) % 1000000 < ${end}
+        )
+      `;
+    } else {
+      condition += `
+        AND toYYYYMMDDhhmmss(${field}) % 1000000 BETWEEN ${start} AND ${end}
+      `;
+    }
+  }
+  if (daysOfWeek) {
+    condition += `
+      AND toDayOfWeek(${field}, 1) IN (${daysOfWeek.map(Number).join(",")})
+    `;
+  }
+
+  return condition;
+};
+
+const getFilterKey = ({ startTime, endTime, daysOfWeek }: FluxQuery) =>
+  `${startTime ?? ""}-${endTime ?? ""}|${
+    daysOfWeek ? [...daysOfWeek].map(Number).sort().join(",") : "*"
+  }`;
+
+export const getQueryKey = (query: FluxQuery) =>
+  `${query.startDate}-${query.endDate}|${getFilterKey(query)}`;
+
+/**
+ * Covers the segments with as few date ranges as possible, as missing segments are
+ * usually contiguous
+ */
+const getRangeCondition = (
+  segments: Segment[],
+  field: "started_at" | "ended_at"
+) => {
+  const ranges: { start: Dayjs; end: Dayjs }[] = [];
+  for (const { start, end } of segments) {
+    const last = ranges[ranges.length - 1];
+    if (last && last.end.isSame(start)) {
+      last.end = end;
+    } else {
+      ranges.push({ start, end });
+    }
+  }
+
+  const format = "YYYY-MM-DD HH:mm:ss";
+  return ranges
+    .map(
+      ({ start, end }) =>
+        `(${field} >= '${start.format(format)}' AND ${field} < '${end.format(
+          format
+        )}')`
+    )
+    .join(" OR ");
+};
+
+/**
+ * Counts trips per segment and station for segments of a single granularity, in
+ * one round trip for both directions
+ */
+const querySegments = async (
+  segments: Segment[],
+  query: FluxQuery,
+  abortSignal?: AbortSignal
+) => {
+  const { sql: segmentFormat } = SEGMENT_FORMATS[segments[0].granularity];
+  const directionSql = (
+    direction: "inbound" | "outbound",
+    table: string,
+    field: "started_at" | "ended_at",
+    stationField: string
+  ) => `
+    SELECT '${direction}' AS direction,
+           formatDateTime(${field}, '${segmentFormat}') AS segment,
+           ${stationField} AS stationId,
+           SUM(c) AS c
+    FROM ${table}
+    WHERE (${getRangeCondition(segments, field)})
+      AND ${getFilterCondition(query, field)}
+    GROUP BY segment, stationId
+  `;
+  const fluxSql = `
+    ${directionSql("outbound", "outbound_trips", "started_at", "start_station_id")}
+    UNION ALL
+    ${directionSql("inbound", "inbound_trips", "ended_at", "end_station_id")}
+  `;
+
+  const start = performance.now();
+  const rows = await getClient().query({
+    query: fluxSql,
+    format: "JSONEachRow",
+    abort_signal: abortSignal,
+  });
+  const json = await rows.json<{
+    direction: "inbound" | "outbound";
+    segment: string;
+    stationId: string;
+    // note: Clickhouse returns counts as strings
+    c: string;
+  }>();
+  recordLatency("clickhouse", performance.now() - start);
+  segmentCounts.clickhouseQueries++;
+
+  const countsBySegment: Record<string, StationCounts> = {};
+  for (const { key } of segments) {
+    countsBySegment[key] = {};
+  }
+  for (const { direction, segment, stationId, c } of json) {
+    const counts = countsBySegment[segment];
+    if (!counts) {
+      continue;
+    }
+    counts[stationId] ??= { inbound: 0, outbound: 0 };
+    counts[stationId][direction] += Number.parseInt(c);
+  }
+
+  return countsBySegment;
+};
+
+/**
+ * Gets the inbound and outbound trips of each station over a query's date range,
+ * taking the counts of cached segments and querying ClickHouse only for the rest
+ */
+export const getStationCounts = async (
+  query: FluxQuery,
+  { abortSignal }: { abortSignal?: AbortSignal } = {}
+) => {
+  const filterKey = getFilterKey(query);
+  const segments = getSegments(query.startDate, query.endDate);
+  const cached: StationCounts[] = [];
+  const missing: Record<Granularity, Segment[]> = { day: [], month: [] };
+  for (const segment of segments) {
+    const counts = segmentCache.get(`${segment.key}|${filterKey}`);
+    if (counts) {
+      cached.push(counts);
+    } else {
+      missing[segment.granularity].push(segment);
+    }
+  }
+  segmentCounts.requested += segments.length;
+  segmentCounts.queried += missing.day.length + missing.month.length;
+
+  const queried = await Promise.all(
+    Object.values(missing)
+      .filter((granularitySegments) => granularitySegments.length)
+      .map((granularitySegments) =>
+        querySegments(granularitySegments, query, abortSignal)
+      )
+  );
+  for (const countsBySegment of queried) {
+    for (const [key, counts] of Object.entries(countsBySegment)) {
+      segmentCache.set(`${key}|${filterKey}`, counts);
+      cached.push(counts);
+    }
+  }
+
+  const totals: StationCounts = {};
+  for (const counts of cached) {
+    for (const [stationId, { inbound, outbound }] of Object.entries(counts)) {
+      totals[stationId] ??= { inbound: 0, outbound: 0 };
+      totals[stationId].inbound += inbound;
+      totals[stationId].outbound += outbound;
+    }
+  }
+
+  return totals;
+};
@@ -0,0 +1,94 @@
+type Entry<V> = {
+  value: V;
+  bytes: number;
+  expiresAt: number;
+};
+
+/**
+ * The approximate size of a value, as the length of its JSON serialization
+ */
+export const serializedSize = (value: unknown) =>
+  JSON.stringify(value)?.length ?? 0;
+
+/**
+ * A cache holding up to `maxEntries` values, of at most `maxBytes` in total as
+ * measured by `sizeOf`, for at most `ttlMs` each, evicting the least recently used
+ * values when full. A value larger than `maxBytes` on its own isn't cached. Relies
+ * on Map iterating in insertion order, so that reinserting a key on access moves it
+ * to the most recently used end.
+ */
+export class LruCache<K, V> {
+  private entries = new Map<K, Entry<V>>();
+  bytes = 0;
+  hits = 0;
+  misses = 0;
+  evictions = 0;
+  rejections = 0;
+
+  constructor(
+    private maxEntries: number,
+    private ttlMs: number,
+    private maxBytes = Infinity,
+    private sizeOf: (value: V) => number = serializedSize
+  ) {}
+
+  get(key: K): V | undefined {
+    const entry = this.entries.get(key);
+    if (!entry || entry.expiresAt <= Date.now()) {
+      if (entry) {
+        this.delete(key);
+      }
+      this.misses++;
+      return undefined;
+    }
+
+    this.entries.delete(key);
+    this.entries.set(key, entry);
+    this.hits++;
+    return entry.value;
+  }
+
+  set(key: K, value: V) {
+    this.delete(key);
+    const bytes = this.sizeOf(value);
+    if (bytes > this.maxBytes) {
+      this.rejections++;
+      return;
+    }
+
+    this.entries.set(key, { value, bytes, expiresAt: Date.now() + this.ttlMs });
+    this.bytes += bytes;
+    while (this.entries.size > this.maxEntries || this.bytes > this.maxBytes) {
+      this.delete(this.entries.keys().next().value as K);
+      this.evictions++;
+    }
+  }
+
+  private delete(key: K) {
+    const entry = this.entries.get(key);
+    if (entry) {
+      this.entries.delete(key);
+      this.bytes -= entry.bytes;
+    }
+  }
+
+  get size() {
+    return this.entries.size;
+  }
+
+  stats() {
+    const lookups = this.hits + this.misses;
+    return {
+      size: this.entries.size,
+      maxEntries: this.maxEntries,
+      bytes: this.bytes,
+      maxBytes: this.maxBytes,
+      ttlMs: this.ttlMs,
+      hits: this.hits,
+      misses: this.misses,
+      hitRate: lookups ? this.hits / lookups : null,
+      evictions: this.evictions,
+      rejections: this.rejections,
+    };
+  }
+}
@@ -1,7 +1,7 @@
 import { getClient } from "@/lib/clickhouse-client";
 import { kv } from "@vercel/kv";
 
-type Station = {
+export type Station = {
   stationId: string;
   currentStationId: string;
   stationName: string;
@@ -11,7 +11,35 @@ type Station = {
 
 export const runtime = "edge";
 
-export const getStationsById = async () => {
+const STATIONS_TTL_MS = 1000 * 60 * 60;
+
+let memoizedStations:
+  | { stationsById: Promise<Record<string, Station>>; expiresAt: number }
+  | undefined;
+
+/**
+ * Gets stations keyed by id, memoized in process so that concurrent and repeated
+ * requests share one lookup
+ */
+export const getStationsById = () => {
+  if (!memoizedStations || memoizedStations.expiresAt <= Date.now()) {
+    const stationsById = fetchStationsById();
+    memoizedStations = {
+      stationsById,
+      expiresAt: Date.now() + STATIONS_TTL_MS,
+    };
+    // failed lookups are retried by the next request
+    stationsById.catch(() => {
+      if (memoizedStations?.stationsById === stationsById) {
+        memoizedStations = undefined;
+      }
+    });
+  }
+
+  return memoizedStations.stationsById;
+};
+
+const fetchStationsById = async () => {
   const map = (await kv.get("station-map")) as Record<string, Station>;
   if (map) {
     return map;
@@ -1,42 +1,81 @@
+import hashlib
+import json
+import math
 import os
+import threading
+import time
+import typing
 from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from concurrent.futures import Future
 import psutil
 
+from instrumentation import report
 from log import log
 
 
 class ArchiveExtractor:
     BUCKET_NAME = "tripdata"
     DOWNLOAD_STATE_FILE = "download_progress.json"
+    MAX_WORKERS = 10
 
-    def __init__(self, out_dir: str):
+    # objects above the threshold are fetched as concurrent ranged GETs whose
+    # progress is checkpointed, so an interrupted download resumes mid-file
+    TRANSFER_CONFIG = TransferConfig(
+        multipart_threshold=64 * 1024 * 1024,
+        multipart_chunksize=16 * 1024 * 1024,
+        max_concurrency=8,
+        io_chunksize=1024 * 1024,
+    )
+
+    def __init__(self, out_dir: str, endpoint_url: typing.Optional[str] = None):
         self.out_dir = out_dir
         self.archive_dir = os.path.join(out_dir, "archives")
 
-        self.s3 = boto3.client("s3")
+        # an endpoint can be given to run against a local S3 stand-in (e.g. MinIO)
+        self.s3 = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url or os.environ.get("S3_ENDPOINT_URL"),
+            # every ranged GET of every concurrent download gets a connection
+            config=Config(
+                max_pool_connections=ArchiveExtractor.MAX_WORKERS
+                * ArchiveExtractor.TRANSFER_CONFIG.max_concurrency
+            ),
+        )
 
         self.tmp_file_dir = os.path.join(self.archive_dir, ".tmp")
         os.makedirs(self.tmp_file_dir, exist_ok=True)
 
+        self.state_path = os.path.join(
+            self.archive_dir, ArchiveExtractor.DOWNLOAD_STATE_FILE
+        )
+        self.state_lock = threading.Lock()
+        self.state: dict[str, dict] = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r") as f:
+                self.state = json.load(f)
+
     def extract(self) -> None:
         os.makedirs(self.out_dir, exist_ok=True)
         os.makedirs(self.archive_dir, exist_ok=True)
 
-        bucket_contents = self.s3.list_objects_v2(Bucket=ArchiveExtractor.BUCKET_NAME)
+        objects = self.list_objects()
 
-        log("Downloading files", {"files": bucket_contents["Contents"]})
-        n_workers = min(psutil.cpu_count(logical=False), 10)
-        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        log("Downloading files", {"files": [obj["Key"] for obj in objects]})
+        n_workers = min(psutil.cpu_count(logical=False), ArchiveExtractor.MAX_WORKERS)
+        with report.stage("download"), ThreadPoolExecutor(
+            max_workers=n_workers
+        ) as executor:
             future_to_key: dict[Future, str] = {}
-            for obj in bucket_contents["Contents"]:
+            for obj in objects:
                 file_key = obj["Key"]
                 future_to_key[
                     executor.submit(
                         self.download_file,
-                        file_key,
+                        obj,
                     )
                 ] = file_key
 
@@ -52,23 +91,159 @@ class ArchiveExtractor:
                         {"file_key": file_key, "exception": e},
                     )
 
-    def download_file(self, file_key: str) -> None:
+    def list_objects(self) -> typing.List[dict]:
+        paginator = self.s3.get_paginator("list_objects_v2")
+        objects = []
+        for page in paginator.paginate(Bucket=ArchiveExtractor.BUCKET_NAME):
+            objects.extend(page.get("Contents", []))
+        return objects
+
+    def download_file(self, obj: dict) -> typing.Optional[str]:
+        file_key = obj["Key"]
         if file_key.endswith(".zip"):
-            return self.download_zip(file_key)
+            return self.download_zip(obj)
         elif file_key == "index.html":
             return None
         else:
             raise Exception("Unsupported file type", file_key)
 
-    def download_zip(self, file_key: str) -> None:
-        if os.path.exists(os.path.join(self.archive_dir, file_key)):
-            log("File already present, skipping download", {"file_key": file_key})
-            return None
+    def download_zip(self, obj: dict) -> typing.Optional[str]:
+        file_key, size, etag = obj["Key"], obj["Size"], obj["ETag"]
+        archive_path = os.path.join(self.archive_dir, file_key)
+        state = self.state.get(file_key, {})
+
+        if os.path.exists(archive_path):
+            if os.path.getsize(archive_path) == size and state.get("etag") in (
+                None,
+                etag,
+            ):
+                log("File already present, skipping download", {"file_key": file_key})
+                report.record_file("download", file_key, skipped=True)
+                if not state.get("complete"):
+                    self.update_state(
+                        file_key, {"etag": etag, "size": size, "complete": True}
+                    )
+                return None
+
+            log("File changed in bucket, downloading again", {"file_key": file_key})
 
-        log("Downloading", {"file_key": file_key})
+        log("Downloading", {"file_key": file_key, "size": size})
+        start_time = time.perf_counter()
         tmpfile = os.path.join(self.tmp_file_dir, file_key)
-        with open(tmpfile, "wb") as f:
-            self.s3.download_fileobj(ArchiveExtractor.BUCKET_NAME, file_key, f)
+        if size < ArchiveExtractor.TRANSFER_CONFIG.multipart_threshold:
+            self.s3.download_file(
+                ArchiveExtractor.BUCKET_NAME,
+                file_key,
+                tmpfile,
+                Config=ArchiveExtractor.TRANSFER_CONFIG,
+            )
+        else:
+            self.download_ranges(file_key, size, etag, tmpfile)
 
-        os.rename(tmpfile, os.path.join(self.archive_dir, file_key))
+        try:
+            self.verify(file_key, tmpfile, size, etag)
+        except Exception:
+            # the recorded parts hold the bad bytes, so resuming would only
+            # verify them again; the next attempt starts from scratch
+            log("Discarding corrupt download", {"file_key": file_key})
+            os.remove(tmpfile)
+            self.clear_state(file_key)
+            raise
+        os.replace(tmpfile, archive_path)
+        self.update_state(file_key, {"etag": etag, "size": size, "complete": True})
+        report.record_file(
+            "download",
+            file_key,
+            elapsed=time.perf_counter() - start_time,
+            bytes_in=size,
+            skipped=False,
+        )
         return file_key
+
+    def download_ranges(self, file_key: str, size: int, etag: str, tmpfile: str):
+        """
+        Downloads an object as concurrent ranged GETs into a preallocated file,
+        recording completed parts so that a restarted download only fetches the
+        parts that are missing.
+        """
+        part_size = ArchiveExtractor.TRANSFER_CONFIG.multipart_chunksize
+        n_parts = math.ceil(size / part_size)
+
+        state = self.state.get(file_key, {})
+        resumable = (
+            state.get("etag") == etag
+            and state.get("part_size") == part_size
+            and os.path.exists(tmpfile)
+            and os.path.getsize(tmpfile) == size
+        )
+        completed_parts = set(state.get("parts", [])) if resumable else set()
+        if resumable:
+            log(
+                "Resuming download",
+                {"file_key": file_key, "parts": len(completed_parts), "of": n_parts},
+            )
+        else:
+            with open(tmpfile, "wb") as f:
+                f.truncate(size)
+            self.update_state(
+                file_key,
+                {"etag": etag, "size": size, "part_size": part_size, "parts": []},
+            )
+
+        def download_part(part: int):
+            start = part * part_size
+            end = min(start + part_size, size) - 1
+            # IfMatch guards against mixing parts of different object versions
+            response = self.s3.get_object(
+                Bucket=ArchiveExtractor.BUCKET_NAME,
+                Key=file_key,
+                Range=f"bytes={start}-{end}",
+                IfMatch=etag,
+            )
+            with open(tmpfile, "r+b") as f:
+                f.seek(start)
+                for chunk in response["Body"].iter_chunks(
+                    ArchiveExtractor.TRANSFER_CONFIG.io_chunksize
+                ):
+                    f.write(chunk)
+
+            with self.state_lock:
+                self.state[file_key]["parts"].append(part)
+                self.save_state()
+
+        remaining = [part for part in range(n_parts) if part not in completed_parts]
+        with ThreadPoolExecutor(
+            max_workers=ArchiveExtractor.TRANSFER_CONFIG.max_concurrency
+        ) as executor:
+            for future in [executor.submit(download_part, part) for part in remaining]:
+                future.result()
+
+    def verify(self, file_key: str, path: str, size: int, etag: str):
+        if os.path.getsize(path) != size:
+            raise Exception("Downloaded file size mismatch", file_key)
+
+        # ETags of multipart uploads aren't a digest of the content
+        etag = etag.strip('"')
+        if "-" not in etag:
+            md5 = hashlib.md5()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    md5.update(chunk)
+            if md5.hexdigest() != etag:
+                raise Exception("Downloaded file checksum mismatch", file_key)
+
+    def update_state(self, file_key: str, file_state: dict):
+        with self.state_lock:
+            self.state[file_key] = file_state
+            self.save_state()
+
+    def clear_state(self, file_key: str):
+        with self.state_lock:
+            self.state.pop(file_key, None)
+            self.save_state()
+
+    def save_state(self):
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.state_path)
@@ -0,0 +1,51 @@
+import os
+import re
+import typing
+import zipfile
+
+from log import debug
+
+IGNORE_FILES = re.compile(r".*__MACOSX/.*|.*/\.DS_Store")
+CHUNK_PATTERN = re.compile(r"(.*)_[0-9]+\.csv$")
+
+
+def select_members(
+    infolist: typing.List[zipfile.ZipInfo],
+) -> typing.List[zipfile.ZipInfo]:
+    """
+    Gets the data members of an archive (CSVs and nested archives). Ignores
+    non-data files and directories, skips over chunked files where the full file
+    is present.
+    """
+    selected: typing.List[zipfile.ZipInfo] = []
+    member_basenames = {os.path.basename(x.filename) for x in infolist}
+    for zipinfo in infolist:
+        if IGNORE_FILES.match(zipinfo.filename):
+            debug("Ignoring file", {"filename": zipinfo.filename})
+            continue
+
+        if zipinfo.is_dir():
+            debug("Ignoring directory", {"directory": zipinfo.filename})
+            continue
+
+        if not zipinfo.filename.endswith(".zip"):
+            chunk = CHUNK_PATTERN.match(os.path.basename(zipinfo.filename))
+            if chunk and f"{chunk.group(1)}.csv" in member_basenames:
+                debug("Ignoring chunked file", {"filename": zipinfo.filename})
+                continue
+
+        selected.append(zipinfo)
+
+    return selected
+
+
+def get_system(file_name):
+    return "JC" if os.path.basename(file_name).startswith("JC-") else "NYC"
+
+
+def output_name(source: str):
+    """
+    Gets the prefix of the Parquet files written for a source, given its path
+    relative to the extracted directory or within its archive.
+    """
+    return re.sub(r"[^A-Za-z0-9_-]+", "_", os.path.splitext(source)[0])
@@ -0,0 +1,187 @@
+import os
+import shutil
+import tempfile
+import typing
+import zipfile
+
+from archive_members import get_system, output_name, select_members
+from arrow_csv_transformer import ArrowCSVTransformer
+from bulk_csv_transformer import BulkCSVTransformer, get_header_version
+from header_classifier import read_header
+from instrumentation import increment
+from log import log
+from manifest import member_fingerprint
+from parquet_writer import PartitionedParquetWriter
+from parse_cache import ParseCache
+
+# CSV parsing engines, selectable from the CLI
+TRANSFORMERS = {"dask": BulkCSVTransformer, "arrow": ArrowCSVTransformer}
+
+
+class ArchiveStreamer:
+    """
+    Transforms CSV members straight out of their archives, reading them in
+    bounded chunks and appending row groups to the output as it goes, so that
+    extracted CSVs never hit the disk.
+    """
+
+    CHUNK_ROWS = 500_000
+
+    def __init__(
+        self,
+        writer: PartitionedParquetWriter,
+        tmp_dir: str,
+        chunk_rows: int = CHUNK_ROWS,
+        engine: str = "dask",
+        cache: typing.Optional[ParseCache] = None,
+    ):
+        self.writer = writer
+        self.tmp_dir = tmp_dir
+        self.chunk_rows = chunk_rows
+        self.engine = engine
+        self.transformer_class = TRANSFORMERS[engine]
+        self.cache = cache
+
+    def stream_member(
+        self,
+        archive_path: str,
+        member: str,
+        header_version: typing.Optional[str] = None,
+    ) -> typing.List[str]:
+        """
+        Transforms a top-level member of an archive, which is either a CSV or a
+        nested archive of CSVs. Returns the written output paths.
+        """
+        archive_name = os.path.splitext(os.path.basename(archive_path))[0]
+        with open(archive_path, "rb") as f, zipfile.ZipFile(f) as zip_ref:
+            return self.stream(zip_ref, member, archive_name, header_version)
+
+    def stream(
+        self,
+        zip_ref: zipfile.ZipFile,
+        member: str,
+        prefix: str,
+        header_version: typing.Optional[str] = None,
+    ) -> typing.List[str]:
+        if not member.endswith(".zip"):
+            return self.stream_csv(zip_ref, member, prefix, header_version)
+
+        outputs = []
+        with self.open_nested(zip_ref, member) as f, zipfile.ZipFile(f) as nested_ref:
+            nested_prefix = f"{prefix}/{os.path.splitext(member)[0]}"
+            for zipinfo in select_members(nested_ref.infolist()):
+                outputs.extend(self.stream(nested_ref, zipinfo.filename, nested_prefix))
+        return outputs
+
+    def stream_csv(
+        self,
+        zip_ref: zipfile.ZipFile,
+        member: str,
+        prefix: str,
+        header_version: typing.Optional[str] = None,
+    ) -> typing.List[str]:
+        if header_version is None:
+            with zip_ref.open(member) as f:
+                header_version = get_header_version(read_header(f))
+
+        log(
+            "Streaming member",
+            {"member": member, "archive": prefix, "header_version": header_version},
+        )
+        with zip_ref.open(member) as f:
+            return self.write_chunks(
+                f,
+                header_version,
+                get_system(member),
+                output_name(f"{prefix}/{member}"),
+                member_fingerprint(zip_ref.getinfo(member)),
+            )
+
+    def stream_file(
+        self,
+        path: str,
+        name: str,
+        header_version: typing.Optional[str] = None,
+        fingerprint: typing.Optional[dict] = None,
+    ) -> typing.List[str]:
+        """
+        Transforms an extracted CSV in chunks. Returns the written output paths.
+        Parses are only cached for files with a fingerprint.
+        """
+        with open(path, "rb") as f:
+            if header_version is None:
+                header_version = get_header_version(read_header(f))
+                f.seek(0)
+            return self.write_chunks(
+                f, header_version, get_system(path), name, fingerprint
+            )
+
+    def write_chunks(
+        self,
+        f: typing.BinaryIO,
+        header_version: str,
+        system: str,
+        name: str,
+        fingerprint: typing.Optional[dict] = None,
+    ) -> typing.List[str]:
+        transformer = self.transformer_class([name], header_version)
+        stream = self.writer.open_stream(system, name)
+        unparseable_rows = 0
+        try:
+            for chunk in self.parse_chunks(transformer, f, fingerprint):
+                unparseable_rows += transformer.unparseable_rows(chunk)
+                stream.write(transformer.normalize(chunk))
+        finally:
+            outputs = stream.close()
+
+        if unparseable_rows:
+            log(
+                "Read rows with unparseable timestamps",
+                {"name": name, "rows": unparseable_rows},
+            )
+        increment(unparseable_rows=unparseable_rows)
+        return outputs
+
+    def parse_chunks(
+        self, transformer, f: typing.BinaryIO, fingerprint: typing.Optional[dict]
+    ) -> typing.Iterator:
+        """
+        Parses a CSV in chunks, or reads its chunks from the parse cache. Chunks
+        parsed on a miss go through the cache's Arrow representation too, so
+        that the output is the same either way.
+        """
+        if self.cache is None or fingerprint is None:
+            yield from transformer.load_chunks(f, self.chunk_rows)
+            return
+
+        key = self.cache.key(
+            fingerprint,
+            self.engine,
+            transformer.header_version,
+            transformer.PARSER_VERSION,
+        )
+        tables = self.cache.read(key)
+        if tables is None:
+            tables = self.cache.write(
+                key,
+                map(transformer.to_arrow, transformer.load_chunks(f, self.chunk_rows)),
+            )
+        for table in tables:
+            yield transformer.from_arrow(table)
+
+    def open_nested(self, zip_ref: zipfile.ZipFile, member: str) -> typing.IO[bytes]:
+        """
+        Opens a nested archive. Stored members are seekable in place; compressed
+        ones are spooled to a temporary file since reading an archive's central
+        directory requires random access, which would otherwise mean
+        decompressing the member from the start on every seek.
+        """
+        if zip_ref.getinfo(member).compress_type == zipfile.ZIP_STORED:
+            return zip_ref.open(member)
+
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        tmp_file = tempfile.TemporaryFile(dir=self.tmp_dir)
+        with zip_ref.open(member) as f:
+            shutil.copyfileobj(f, tmp_file)
+        tmp_file.seek(0)
+        return tmp_file
@@ -1,16 +1,35 @@
 import glob
+import heapq
+import multiprocessing
 import os
 import re
+import resource
+import shutil
+import time
 import typing
 import zipfile
-from concurrent.futures import Future, ThreadPoolExecutor, as_completed
-
-import dask.dataframe as dd
-from dask.distributed import Client
-
-from log import log
-from schemas import normalized_schema
-from bulk_csv_transformer import BulkCSVTransformer, get_header_version
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+
+import dask
+from dask.distributed import Client, get_task_stream
+
+from archive_members import get_system, output_name, select_members
+from archive_streamer import ArchiveStreamer
+from log import debug, log
+from manifest import TransformManifest, member_fingerprint
+from parquet_writer import PartitionedParquetWriter
+from parse_cache import ParseCache, get_cache_stats, reset_cache_stats
+from bulk_csv_transformer import BulkCSVTransformer
+from cluster_config import ClusterConfig
+from dedup import TripDeduplicator
+from header_classifier import HeaderClassifier, header_inventory
+from instrumentation import get_worker_counters, report, reset_worker_counters
+from rollup import RollupWriter
+from sampling import SampleWriter
+from station_resolver import StationIndex
+from validation import QuarantineWriter
+
+ZIP_COPY_BUFFER_SIZE = 1 << 20
 
 # there are several types of archives in the dataset:
 # 1. year archives with the filename YYYY-citibike-tripdata.zip
@@ -41,177 +60,709 @@ def normalize_file_name(file_path):
     return f"{'NYC' if is_nyc else 'JC'}-{year}-{month.zfill(2)}-{part}.csv"
 
 
-class ArchiveTransformer:
-    IGNORE_FILES = [r".*__MACOSX/.*", r".*/.DS_Store"]
+def extract_member(archive_path: str, member: str, extracted_dir: str) -> float:
+    """
+    Extracts a single member of an archive, returning the time it took. The
+    member is written under a temporary name first so that an interrupted run
+    doesn't leave a truncated file that would be skipped as already extracted.
+    """
+    start_time = time.perf_counter()
+    target = os.path.join(extracted_dir, member)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(archive_path, "rb") as f, zipfile.ZipFile(f) as zip_ref:
+        with zip_ref.open(member) as source, open(f"{target}.tmp", "wb") as dest:
+            shutil.copyfileobj(source, dest, ZIP_COPY_BUFFER_SIZE)
+    os.replace(f"{target}.tmp", target)
+    return time.perf_counter() - start_time
+
+
+def get_peak_rss():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
 
-    def __init__(self, out_dir: str):
+
+class ArchiveTransformer:
+    def __init__(
+        self,
+        out_dir: str,
+        full_refresh: bool = False,
+        streaming: bool = False,
+        chunk_rows: int = ArchiveStreamer.CHUNK_ROWS,
+        engine: str = "dask",
+        profile: str = "normalized",
+        compression: str = "snappy",
+        compression_level: typing.Optional[int] = None,
+        row_group_size: int = PartitionedParquetWriter.ROW_GROUP_SIZE,
+        stations: typing.Optional[StationIndex] = None,
+        rollups: bool = False,
+        samples: typing.Optional[typing.List[float]] = None,
+        parse_cache: bool = False,
+        parse_cache_bytes: int = ParseCache.MAX_BYTES,
+        dedup: bool = False,
+        validate: bool = False,
+        auto_tune: bool = False,
+        scheduler: typing.Optional[str] = None,
+    ):
         self.out_dir = out_dir
         self.archive_dir = os.path.join(out_dir, "archives")
         self.extracted_dir = os.path.join(out_dir, "extracted")
+        self.parquet_dir = os.path.join(out_dir, "parquet")
+        self.rollup_dir = os.path.join(out_dir, "rollups")
+        self.rollups = RollupWriter(self.rollup_dir, compression) if rollups else None
+        self.quarantine_dir = os.path.join(out_dir, QuarantineWriter.DIR)
+        self.quarantine = QuarantineWriter(out_dir, compression) if validate else None
+        self.sample_dir = os.path.join(out_dir, SampleWriter.DIR)
+        self.samples = (
+            SampleWriter(self.sample_dir, samples, compression) if samples else None
+        )
+        self.writer = PartitionedParquetWriter(
+            self.parquet_dir,
+            profile,
+            compression,
+            compression_level,
+            row_group_size,
+            stations,
+            self.rollups,
+            self.quarantine,
+            self.samples,
+        )
 
-        self.trips_df = None
+        self.dedup = dedup
+        self.deduplicator = TripDeduplicator(self.writer, out_dir) if dedup else None
+        self.streaming = streaming
+        self.engine = engine
+        # parses don't depend on the output settings, so the cache outlives a
+        # full refresh
+        self.parse_cache = (
+            ParseCache(os.path.join(out_dir, ParseCache.DIR), parse_cache_bytes)
+            if parse_cache
+            else None
+        )
+        self.streamer = ArchiveStreamer(
+            self.writer,
+            os.path.join(self.archive_dir, ".tmp"),
+            chunk_rows,
+            engine,
+            self.parse_cache,
+        )
 
-        # instantiating the distributed client to make Dask use the distributed scheduler
-        n_workers_str = os.environ.get("DASK_N_WORKERS", "0")
-        n_workers = int(n_workers_str)
-        self.client = Client(
-            n_workers=n_workers if n_workers else None,
-            threads_per_worker=1,
-            memory_limit=os.environ.get("DASK_MEMORY_PER_WORKER"),
-            local_directory=os.path.join(out_dir, "dask-worker-space"),
+        self.classifier = HeaderClassifier(
+            os.path.join(out_dir, HeaderClassifier.CACHE_FILE)
+        )
+        self.manifest = TransformManifest(
+            os.path.join(out_dir, TransformManifest.FILE_NAME)
         )
-        log("Dask client started", {"dashboard": self.client.dashboard_link})
+        # partitions whose outputs were written or removed in this run
+        self.touched_partitions: typing.Set[str] = set()
+        if full_refresh or not self.manifest.exists():
+            # without a manifest, files already in the output directory can't be
+            # attributed to a source, so start from a clean slate
+            self.clear_output()
+        elif self.manifest.settings != self.settings():
+            log(
+                "Output settings changed, transforming every file",
+                {"previous": self.manifest.settings, "current": self.settings()},
+            )
+            self.clear_output()
+
+        # the client is started once the input to transform is known, so that
+        # an auto-tuned cluster can be sized for it
+        self.auto_tune = auto_tune
+        self.scheduler = scheduler
+        self.client: typing.Optional[Client] = None
+        self.cluster: typing.Optional[ClusterConfig] = None
+
+    def start_client(self, total_bytes: int) -> Client:
+        """
+        Connects to the given scheduler, or starts a local cluster that is
+        either auto-tuned for the input or sized by DASK_N_WORKERS and
+        DASK_MEMORY_PER_WORKER. Creating the client makes Dask use the
+        distributed scheduler.
+        """
+        if self.client is not None:
+            return self.client
+
+        local_directory = os.path.join(self.out_dir, "dask-worker-space")
+        config = None
+        if self.scheduler:
+            self.client = Client(self.scheduler)
+        elif self.auto_tune:
+            config = ClusterConfig.auto(total_bytes, self.engine)
+            with dask.config.set(config.dask_config()):
+                self.client = Client(
+                    n_workers=config.n_workers,
+                    threads_per_worker=config.threads_per_worker,
+                    memory_limit=config.memory_per_worker,
+                    local_directory=local_directory,
+                )
+        else:
+            n_workers_str = os.environ.get("DASK_N_WORKERS", "0")
+            n_workers = int(n_workers_str)
+            self.client = Client(
+                n_workers=n_workers if n_workers else None,
+                threads_per_worker=1,
+                memory_limit=os.environ.get("DASK_MEMORY_PER_WORKER"),
+                local_directory=local_directory,
+            )
+
+        self.cluster = config or ClusterConfig.from_client(self.client)
+        # workers of a remote scheduler may have counted earlier runs
+        self.client.run(reset_worker_counters)
+        if self.parse_cache:
+            self.client.run(reset_cache_stats)
+        log(
+            "Dask client started",
+            {
+                "dashboard": self.client.dashboard_link,
+                "scheduler": self.client.scheduler.address,
+                "input_bytes": total_bytes,
+                "cluster": self.cluster.to_dict(),
+            },
+        )
+        return self.client
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def clear_output(self):
+        log("Clearing transform output", {"parquet_dir": self.parquet_dir})
+        shutil.rmtree(self.parquet_dir, ignore_errors=True)
+        shutil.rmtree(self.rollup_dir, ignore_errors=True)
+        shutil.rmtree(self.quarantine_dir, ignore_errors=True)
+        shutil.rmtree(self.sample_dir, ignore_errors=True)
+        shutil.rmtree(
+            os.path.join(self.out_dir, TripDeduplicator.DROPPED_DIR), ignore_errors=True
+        )
+        for source in list(self.manifest.sources):
+            self.manifest.remove(source)
+        self.manifest.settings = self.settings()
+        self.manifest.save()
+
+    def settings(self) -> dict:
+        return {**self.writer.settings(), "dedup": self.dedup}
 
     def transform_archives(self):
+        start_time = time.time()
+        if self.streaming:
+            self.stream_archives()
+        else:
+            self.transform_extracted()
+
+        self.deduplicate()
+        self.reweight_samples()
+        self.log_cache_stats()
+
+        log(
+            "Transformed archives",
+            {
+                "engine": self.engine,
+                "streaming": self.streaming,
+                "elapsed": time.time() - start_time,
+                "output_bytes": self.get_output_bytes(),
+                "worker_peak_rss": self.client.run(get_peak_rss) if self.client else {},
+            },
+        )
+
+    def transform_extracted(self):
         self.extract_csvs()
 
-        extracted_csvs = glob.glob(
-            os.path.join(self.extracted_dir, "**/*.csv"), recursive=True
+        extracted_csvs = sorted(
+            glob.glob(os.path.join(self.extracted_dir, "**/*.csv"), recursive=True)
         )
 
-        files_by_header: dict[str, typing.List[str]] = {}
+        pending: dict[str, typing.Tuple[str, dict]] = {}
         for file in extracted_csvs:
-            with open(file, "r") as f:
-                header_version = get_header_version(f.readline().replace("\r", ""))
-                files_for_header = files_by_header.get(header_version, [])
-                files_for_header.append(file)
-                files_by_header[header_version] = files_for_header
+            source = os.path.relpath(file, self.extracted_dir)
+            fingerprint = self.manifest.fingerprint(source, file)
+            if self.manifest.is_current(source, fingerprint):
+                continue
+            pending[file] = (source, fingerprint)
+
+        self.prune_sources(
+            {os.path.relpath(file, self.extracted_dir) for file in extracted_csvs}
+        )
+        log(
+            "Found new or changed files",
+            {"pending": len(pending), "unchanged": len(extracted_csvs) - len(pending)},
+        )
+        if not pending:
+            return 0
+
+        with report.stage("classify"):
+            versions = self.classifier.classify_files(list(pending))
+        sizes = {
+            file: fingerprint["size"] for file, (_, fingerprint) in pending.items()
+        }
+        inventory = header_inventory(versions, sizes)
+        self.start_client(sum(sizes.values()))
+
+        files_by_header: dict[str, typing.List[str]] = {}
+        for file, header_version in versions.items():
+            files_for_header = files_by_header.get(header_version, [])
+            files_for_header.append(file)
+            files_by_header[header_version] = files_for_header
 
         log("Transforming files", {"files_by_header": files_by_header})
+        writes: dict[str, typing.List] = {}
         for header_version, files in files_by_header.items():
-            df = BulkCSVTransformer(files, header_version).transform()
-            self.trips_df = dd.concat(
-                list(filter(lambda x: x is not None, [self.trips_df, df])), axis=0
-            )
+            blocksize = self.cluster.blocksize(inventory[header_version]["bytes"])
+            for file in files:
+                source, _ = pending[file]
+                self.remove_outputs(source)
+
+                # each source is written to its own set of files so that it can
+                # be replaced without touching the output of any other source.
+                # partitions are written as they are, without a global shuffle,
+                # and split into the system/year/month layout by the writer
+                name = output_name(source)
+                # cached parses are read per file, so with the parse cache the
+                # Dask engine transforms files in chunks like the Arrow engine
+                # rather than as blocks of a Dask frame
+                if self.engine == "arrow" or self.parse_cache:
+                    writes[file] = [
+                        dask.delayed(self.streamer.stream_file)(
+                            file,
+                            name,
+                            header_version,
+                            pending[file][1],
+                            dask_key_name=("stream", source),
+                        )
+                    ]
+                    continue
 
-        log("Repartitioning df")
-        repartitioned_df = self.trips_df.repartition(npartitions=50)
+                df = BulkCSVTransformer([file], header_version, blocksize).transform()
+                writes[file] = [
+                    dask.delayed(self.writer.write)(
+                        part,
+                        get_system(file),
+                        f"{name}.{i}",
+                        dask_key_name=("write", source, i),
+                    )
+                    for i, part in enumerate(df.to_delayed())
+                ]
 
         log(
             "Writing df to parquet (visit the dask dashboard to see progress)",
-            {"dashboard": self.client.dashboard_link},
+            {"dashboard": self.client.dashboard_link, "files": len(writes)},
+        )
+        written = self.compute(writes)
+
+        for file, partition_outputs in written.items():
+            source, fingerprint = pending[file]
+            outputs = [output for outputs in partition_outputs for output in outputs]
+            self.record_outputs(source, fingerprint, outputs)
+        self.manifest.save()
+
+        log("Wrote df to parquet")
+        return len(written)
+
+    def stream_archives(self):
+        archive_paths = [
+            os.path.join(self.archive_dir, file)
+            for file in sorted(os.listdir(self.archive_dir))
+            if file.endswith(".zip")
+        ]
+
+        sources: typing.Set[str] = set()
+        pending: dict[str, typing.Tuple[str, str, dict]] = {}
+        versions: dict[str, str] = {}
+        # listing members and classifying their headers both only read archive
+        # metadata and prologues, so they're timed together
+        with report.stage("classify"):
+            for archive_path in archive_paths:
+                self.list_archive(archive_path, sources, pending, versions)
+
+        self.prune_sources(sources)
+        log(
+            "Found new or changed members",
+            {"pending": len(pending), "unchanged": len(sources) - len(pending)},
         )
-        repartitioned_df.to_parquet(
-            os.path.join(self.out_dir, "parquet"),
-            schema=normalized_schema,
-            write_index=False,
-            overwrite=True,
+        if not pending:
+            return 0
+
+        return self.stream_pending(pending, versions)
+
+    def stream_archive(self, archive_path: str) -> typing.Set[str]:
+        """
+        Streams the new or changed members of a single archive, e.g. as one
+        unit of an orchestrated run. Returns the sources of the archive.
+        """
+        sources: typing.Set[str] = set()
+        pending: dict[str, typing.Tuple[str, str, dict]] = {}
+        versions: dict[str, str] = {}
+        with report.stage("classify"):
+            self.list_archive(archive_path, sources, pending, versions)
+
+        log(
+            "Found new or changed members",
+            {
+                "archive": archive_path,
+                "pending": len(pending),
+                "unchanged": len(sources) - len(pending),
+            },
         )
+        if pending:
+            self.stream_pending(pending, versions)
+        return sources
+
+    def list_archive(
+        self,
+        archive_path: str,
+        sources: typing.Set[str],
+        pending: dict[str, typing.Tuple[str, str, dict]],
+        versions: dict[str, str],
+    ):
+        """
+        Adds the members of an archive to `sources`, those that aren't current
+        to `pending` and the header versions of pending CSVs to `versions`.
+        """
+        try:
+            with open(archive_path, "rb") as f, zipfile.ZipFile(f) as zip_ref:
+                members = select_members(zip_ref.infolist())
+        except zipfile.BadZipFile as e:
+            log("Failed to read archive", {"archive": archive_path, "exception": e})
+            return
+
+        pending_csvs: typing.List[zipfile.ZipInfo] = []
+        for zipinfo in members:
+            source = f"{os.path.basename(archive_path)}!{zipinfo.filename}"
+            sources.add(source)
+            fingerprint = member_fingerprint(zipinfo)
+            if not self.manifest.is_current(source, fingerprint):
+                pending[source] = (archive_path, zipinfo.filename, fingerprint)
+                if not zipinfo.filename.endswith(".zip"):
+                    pending_csvs.append(zipinfo)
+
+        # members of nested archives are classified by the task streaming them
+        if pending_csvs:
+            for member, version in self.classifier.classify_members(
+                archive_path, pending_csvs
+            ).items():
+                versions[f"{os.path.basename(archive_path)}!{member}"] = version
+
+    def stream_pending(
+        self,
+        pending: dict[str, typing.Tuple[str, str, dict]],
+        versions: dict[str, str],
+    ) -> int:
+        header_inventory(
+            versions,
+            {source: pending[source][2]["size"] for source in versions},
+        )
+        self.start_client(
+            sum(fingerprint["size"] for _, _, fingerprint in pending.values())
+        )
+        writes: dict[str, typing.Any] = {}
+        for source, (archive_path, member, _) in pending.items():
+            self.remove_outputs(source)
+            writes[source] = dask.delayed(self.streamer.stream_member)(
+                archive_path,
+                member,
+                versions.get(source),
+                dask_key_name=("stream", source),
+            )
+
+        log(
+            "Streaming members to parquet (visit the dask dashboard to see progress)",
+            {"dashboard": self.client.dashboard_link, "members": len(writes)},
+        )
+        written = self.compute(writes)
+
+        for source, outputs in written.items():
+            _, _, fingerprint = pending[source]
+            self.record_outputs(source, fingerprint, outputs)
+        self.manifest.save()
 
         log("Wrote df to parquet")
+        return len(written)
 
-    def extract_all_archives(self):
-        archives = sorted(os.listdir(self.archive_dir))
-        for file in archives:
-            if not file.endswith(".zip"):
-                log("Skipping non-archive file", {"file": file})
-                continue
+    def compute(self, writes: dict) -> dict:
+        """
+        Computes the write tasks of the pending sources as the transform stage,
+        recording the Dask task stream, the compute time of each source's
+        write tasks, which are keyed by (kind, source, ...), and the counters
+        of the workers, e.g. of rows with unparseable timestamps.
+        """
+        with report.stage("transform"), get_task_stream(self.client) as task_stream:
+            (written,) = dask.compute(writes)
+
+        report.record_tasks("transform", task_stream.data)
+        for task in task_stream.data:
+            key = task["key"]
+            if isinstance(key, tuple) and key[0] in ("stream", "write"):
+                report.record_file(
+                    "transform",
+                    key[1],
+                    task_seconds=sum(
+                        startstop["stop"] - startstop["start"]
+                        for startstop in task["startstops"]
+                        if startstop["action"] == "compute"
+                    ),
+                )
 
-            archive_path = os.path.join(self.archive_dir, file)
-            self.extract(archive_path)
+        counters: dict[str, int] = {"unparseable_rows": 0}
+        for worker_counters in self.client.run(get_worker_counters).values():
+            for metric, value in worker_counters.items():
+                counters[metric] = counters.get(metric, 0) + value
+        report.record_stage("transform", **counters)
+        if counters["unparseable_rows"]:
+            log("Read rows with unparseable timestamps", counters)
+        return written
 
-    def extract_csvs(self):
-        archive_paths = sorted(os.listdir(self.archive_dir))
+    def log_cache_stats(self):
+        """
+        Logs the parse cache counters of this run, summed over the workers,
+        and records them in the run report.
+        """
+        if self.parse_cache is None or self.client is None:
+            return
+
+        stats: dict[str, float] = {}
+        for worker_stats in self.client.run(get_cache_stats).values():
+            for metric, value in worker_stats.items():
+                stats[metric] = stats.get(metric, 0) + value
+        lookups = stats.get("hits", 0) + stats.get("misses", 0)
+        entries, cache_bytes = self.parse_cache.size()
+        stats.update(
+            hit_rate=stats.get("hits", 0) / lookups if lookups else None,
+            entries=entries,
+            cache_bytes=cache_bytes,
+            max_bytes=self.parse_cache.max_bytes,
+        )
+        report.record_stage("parse_cache", **stats)
+        log("Parse cache stats", stats)
+
+    def record_outputs(self, source: str, fingerprint: dict, outputs: typing.List[str]):
+        """
+        Records the trip and quarantine outputs of a source in the manifest,
+        and their stats in the run report.
+        """
+        quarantined = [
+            output for output in outputs if QuarantineWriter.is_output(output)
+        ]
+        outputs = [output for output in outputs if output not in quarantined]
+        self.manifest.record(source, fingerprint, outputs, quarantined)
+        self.touched_partitions.update(os.path.dirname(output) for output in outputs)
+
+        output_bytes, rows = self.writer.output_stats(outputs)
+        report.record_file(
+            "transform",
+            source,
+            bytes_in=fingerprint["size"],
+            bytes_out=output_bytes,
+            rows=rows,
+            outputs=len(outputs),
+        )
+        if self.quarantine:
+            reasons = self.quarantine.stats(quarantined)
+            report.record_file(
+                "validate",
+                source,
+                rows=rows,
+                rejected=sum(reasons.values()),
+                **{f"rejected_{reason}": count for reason, count in reasons.items()},
+            )
+
+    def get_outputs(self) -> typing.List[str]:
+        return [
+            output
+            for source in self.manifest.sources
+            for output in self.manifest.outputs(source)
+        ]
+
+    def get_touched_outputs(self) -> typing.List[str]:
+        """
+        Returns every output of the partitions touched in this run.
+        """
+        return [
+            output
+            for output in self.get_outputs()
+            if os.path.dirname(output) in self.touched_partitions
+        ]
+
+    def get_output_bytes(self) -> int:
+        return sum(
+            os.path.getsize(os.path.join(self.parquet_dir, output))
+            for output in self.get_outputs()
+        )
+
+    def deduplicate(self) -> int:
+        """
+        Deduplicates the partitions touched in this run when enabled, as new
+        sources can overlap any other source in their partitions and removed
+        sources can leave trips without their kept copy. Returns the number of
+        outputs rewritten.
+        """
+        if not self.deduplicator or not self.touched_partitions:
+            return 0
+        return self.deduplicator.deduplicate(self.get_touched_outputs())
 
-        archives_to_extract = [
+    def reweight_samples(self):
+        """
+        Weights the samples of the partitions touched in this run by the trips
+        of each stratum, once their outputs are final.
+        """
+        if not self.samples or not self.touched_partitions:
+            return
+        with report.stage("sample"):
+            self.samples.reweight(self.parquet_dir, self.get_touched_outputs())
+
+    def prune_sources(self, sources: typing.Set[str]):
+        """
+        Removes the output of sources in the manifest that are no longer
+        present, e.g. after switching between extracted and streaming modes.
+        """
+        for source in list(self.manifest.sources):
+            if source not in sources:
+                log("Removing output of missing source", {"source": source})
+                self.remove_outputs(source)
+
+    def remove_outputs(self, source: str):
+        for output in self.manifest.outputs(source):
+            self.touched_partitions.add(os.path.dirname(output))
+            try:
+                os.remove(os.path.join(self.parquet_dir, output))
+            except FileNotFoundError:
+                pass
+            if self.rollups:
+                self.rollups.remove(output)
+            if self.samples:
+                self.samples.remove(output)
+            if self.deduplicator:
+                self.deduplicator.remove(output)
+        for output in self.manifest.quarantined(source):
+            try:
+                os.remove(os.path.join(self.out_dir, output))
+            except FileNotFoundError:
+                pass
+        self.manifest.remove(source)
+
+    def extract_csvs(self):
+        """
+        Extracts the members of every archive on a process pool. Members are
+        scheduled largest first so that the biggest DEFLATE streams don't end up
+        running alone at the tail, and members of nested archives are scheduled
+        as soon as their parent has been extracted.
+        """
+        archive_paths = [
             os.path.join(self.archive_dir, file)
-            for file in archive_paths
+            for file in sorted(os.listdir(self.archive_dir))
             if file.endswith(".zip")
         ]
 
-        with ThreadPoolExecutor(max_workers=8) as executor:
-            while archives_to_extract:
-                future_map: dict[Future, str] = {
-                    executor.submit(self.extract, archive_path): archive_path
-                    for archive_path in archives_to_extract
-                }
-
-                archives_to_extract.clear()
+        pending: typing.List[typing.Tuple[int, str, str]] = []
+        timings: dict[str, dict] = {}
+        for archive_path in archive_paths:
+            self.schedule_members(archive_path, pending, timings)
+
+        n_workers = os.cpu_count() or 1
+        start_time = time.perf_counter()
+        extracted_bytes = 0
+        with report.stage("extract"), ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            running: dict[Future, typing.Tuple[str, str, int]] = {}
+            while pending or running:
+                while pending and len(running) < n_workers:
+                    negative_size, archive_path, member = heapq.heappop(pending)
+                    future = executor.submit(
+                        extract_member, archive_path, member, self.extracted_dir
+                    )
+                    running[future] = (archive_path, member, -negative_size)
 
-                for future in as_completed(future_map):
-                    archive_path = future_map[future]
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    archive_path, member, size = running.pop(future)
+                    timing = timings[archive_path]
                     try:
-                        log(f"Extracted archive", {"archive": archive_path})
-                        nested_archives = future.result()
-                        if nested_archives:
-                            archives_to_extract.extend(nested_archives)
+                        member_seconds = future.result()
+                        report.record_file(
+                            "extract", member, elapsed=member_seconds, bytes_out=size
+                        )
+                        timing["member_seconds"] += member_seconds
+                        timing["bytes"] += size
+                        extracted_bytes += size
+                        if member.endswith(".zip"):
+                            self.schedule_members(
+                                os.path.join(self.extracted_dir, member),
+                                pending,
+                                timings,
+                            )
                     except Exception as e:
                         log(
-                            f"Failed to extract archive",
-                            {"archive": archive_path, "exception": e},
+                            "Failed to extract member",
+                            {"archive": archive_path, "member": member, "exception": e},
+                        )
+
+                    timing["remaining"] -= 1
+                    if not timing["remaining"]:
+                        log(
+                            "Extracted archive",
+                            {
+                                "archive": archive_path,
+                                "members": timing["members"],
+                                "bytes": timing["bytes"],
+                                "member_seconds": timing["member_seconds"],
+                                "elapsed": time.perf_counter() - timing["start"],
+                            },
                         )
 
-    def extract(
+        elapsed = time.perf_counter() - start_time
+        log(
+            "Extracted archives",
+            {
+                "workers": n_workers,
+                "bytes": extracted_bytes,
+                "elapsed": elapsed,
+                "mb_per_second": extracted_bytes / 1e6 / elapsed if elapsed else None,
+            },
+        )
+
+    def schedule_members(
         self,
         archive_path: str,
+        pending: typing.List[typing.Tuple[int, str, str]],
+        timings: dict[str, dict],
     ):
         try:
             with open(archive_path, "rb") as f, zipfile.ZipFile(f) as zip_ref:
                 infolist = zip_ref.infolist()
-                members = self.get_files_to_extract(infolist)
-
-                log(
-                    f"Extracting members from archive",
-                    {"members": members, "archive": archive_path},
-                )
-                zip_ref.extractall(self.extracted_dir, members)
-
-                nested_zip_files = filter(lambda x: x.endswith(".zip"), members)
-                return (
-                    list(
-                        map(
-                            lambda x: os.path.join(self.extracted_dir, x),
-                            nested_zip_files,
-                        )
-                    )
-                    if nested_zip_files
-                    else None
-                )
         except zipfile.BadZipFile as e:
             log("Failed to extract archive", {"archive": archive_path, "exception": e})
+            return
+
+        sizes = {zipinfo.filename: zipinfo.file_size for zipinfo in infolist}
+        members = self.get_files_to_extract(infolist)
+        if not members:
+            return
+
+        log(
+            "Extracting members from archive",
+            {"members": members, "archive": archive_path},
+        )
+        timings[archive_path] = {
+            "start": time.perf_counter(),
+            "members": len(members),
+            "remaining": len(members),
+            "bytes": 0,
+            "member_seconds": 0.0,
+        }
+        for member in members:
+            heapq.heappush(pending, (-sizes[member], archive_path, member))
 
     def get_files_to_extract(self, infolist: typing.List[zipfile.ZipInfo]):
         """
-        Gets the members in the archive to extract. Ignores non-data files and
-        directories, skips over chunked files where the full file is present.
+        Gets the members in the archive to extract, skipping members that have
+        already been extracted.
         """
         extract_members: typing.List[str] = []
-        all_members = list(map(lambda x: x.filename, infolist))
-        for zipinfo in infolist:
-            if any(
-                map(
-                    lambda x: re.match(x, zipinfo.filename),
-                    ArchiveTransformer.IGNORE_FILES,
-                )
-            ):
-                log("Ignoring file", {"filename": zipinfo.filename})
-                continue
-
-            if zipinfo.is_dir():
-                log("Ignoring directory", {"directory": zipinfo.filename})
+        for zipinfo in select_members(infolist):
+            if os.path.exists(os.path.join(self.extracted_dir, zipinfo.filename)):
+                debug("Skipping extracted file", {"filename": zipinfo.filename})
                 continue
 
-            if zipinfo.filename.endswith(".zip"):
-                if os.path.exists(os.path.join(self.extracted_dir, zipinfo.filename)):
-                    log("Skipping extracted file", {"filename": zipinfo.filename})
-                    continue
-                extract_members.append(zipinfo.filename)
-            else:
-                file_basename = os.path.basename(zipinfo.filename)
-                if re.search("_[0-9]+.csv$", file_basename):
-                    unchunked_file_name = (
-                        re.match("(.*)_[0-9]+.csv$", file_basename).group(1) + ".csv"
-                    )
-                    if any(
-                        map(lambda x: re.search(unchunked_file_name, x), all_members)
-                    ):
-                        log("Ignoring chunked file", {"filename": zipinfo.filename})
-                        continue
-
-                if os.path.exists(os.path.join(self.extracted_dir, zipinfo.filename)):
-                    log("Skipping extracted file", {"filename": zipinfo.filename})
-                    continue
-
-                extract_members.append(zipinfo.filename)
+            extract_members.append(zipinfo.filename)
 
         return extract_members
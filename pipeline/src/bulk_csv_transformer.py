@@ -1,30 +1,83 @@
+import typing
+
 import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from instrumentation import increment
+from log import log
+from schemas import ISO8601_PATTERN, TIMESTAMP_FORMATS, schemas
+
+# the attr (or schema metadata, for Arrow chunks) of parsed chunks holding the
+# number of rows with a timestamp that failed to parse, which is kept with
+# cached parses
+UNPARSEABLE_ROWS = "unparseable_rows"
 
-from schemas import schemas
+# the set of headers of each version, computed once rather than for every file
+HEADER_SIGNATURES = {
+    version: frozenset(schema["dtypes"].keys()) for version, schema in schemas.items()
+}
 
 
 def get_header_version(unparsed_headers: str):
     headers = set(unparsed_headers.replace('"', "").strip("\n").split(","))
     max_score, likely_header = 0, None
-    for version, schema in schemas.items():
-        if headers.issubset(set(schema["dtypes"].keys())):
+    for version, signature in HEADER_SIGNATURES.items():
+        if headers.issubset(signature):
             return version
-        score = len(headers.intersection(set(schema["dtypes"].keys()))) / len(headers)
+        score = len(headers.intersection(signature)) / len(headers)
         if score > max_score:
             max_score = score
             likely_header = version
 
     if max_score > 0:
-        print(
+        log(
             "Could not strictly determine header version for file",
             {"max_score": max_score, "likely_header": likely_header},
         )
         return likely_header
 
-    print("Could not determine header version for file", {"headers": headers})
+    log("Could not determine header version for file", {"headers": headers})
     return "unk"
 
 
+def parse_timestamp_array(array: pa.Array) -> pa.Array:
+    """
+    Parses ISO 8601 timestamps, then each of TIMESTAMP_FORMATS in turn, so that
+    a file mixing them is read whole. Each format only parses the values no
+    earlier format could.
+    """
+    iso = pc.match_substring_regex(array, ISO8601_PATTERN)
+    parsed = pc.if_else(iso, array, pa.scalar(None, pa.string())).cast(
+        pa.timestamp("ns")
+    )
+    for timestamp_format in TIMESTAMP_FORMATS:
+        remaining = pc.and_(pc.is_null(parsed), pc.is_valid(array))
+        if not pc.any(remaining).as_py():
+            break
+        parsed = pc.replace_with_mask(
+            parsed,
+            remaining,
+            pc.strptime(
+                array.filter(remaining), timestamp_format, "ns", error_is_null=True
+            ),
+        )
+    return parsed
+
+
+def parse_timestamps(series: pd.Series) -> pd.Series:
+    """
+    Parses timestamps with the Arrow kernels ArrowCSVTransformer uses, rather
+    than pandas inferring one format and reading the rest as NaT.
+    """
+    parsed = parse_timestamp_array(pa.array(series, pa.string(), from_pandas=True))
+    return pd.Series(
+        parsed.to_numpy(zero_copy_only=False), index=series.index, name=series.name
+    )
+
+
 class BulkCSVTransformer:
     HEADERS = [
         "ride_id",
@@ -44,19 +97,38 @@ class BulkCSVTransformer:
         "gender",
         "birth_year",
     ]
+    # bumped whenever load_chunks parses differently, to invalidate cached parses
+    PARSER_VERSION = 3
 
-    def __init__(self, paths, header_version):
+    def __init__(self, paths, header_version, blocksize="default"):
         self.paths = paths
         self.header_version = header_version
+        self.blocksize = blocksize
 
     def transform(self) -> dd.DataFrame:
-        df = None
+        return self.normalize(self.load_df())
+
+    def transform_chunks(
+        self, f: typing.BinaryIO, chunk_rows: int
+    ) -> typing.Iterator[pd.DataFrame]:
+        """
+        Transforms a single CSV read from a file object in chunks of at most
+        `chunk_rows` rows, so that memory use is bounded regardless of file size.
+        """
+        for df in self.load_chunks(f, chunk_rows):
+            yield self.normalize(df)
+
+    def normalize(self, df):
+        """
+        Maps a frame in this transformer's header version to the normalized
+        headers. Works on both Dask and pandas frames.
+        """
         if self.header_version == "v11":
-            df = self.transform_v11()
+            df = self.transform_v11(df)
         elif self.header_version == "v12":
-            df = self.transform_v12()
+            df = self.transform_v12(df)
         elif self.header_version == "v2":
-            df = self.transform_v2()
+            df = self.transform_v2(df)
         else:
             raise ValueError("Unknown header version")
 
@@ -66,13 +138,84 @@ class BulkCSVTransformer:
     def load_df(self) -> dd.DataFrame:
         dtypes = schemas[self.header_version]["dtypes"]
         dt_cols = schemas[self.header_version]["dt_cols"]
-        df = dd.read_csv(self.paths, dtype=dtypes, na_values=["\\N", ""])
-        for col in dt_cols:
-            df[col] = dd.to_datetime(df[col])
+        df = dd.read_csv(
+            self.paths,
+            dtype=dtypes,
+            na_values=["\\N", ""],
+            blocksize=self.blocksize,
+        )
+        # unparseable timestamps are read as NaT for validation to quarantine,
+        # rather than failing the whole graph, and counted
+        meta = df._meta.astype({col: "datetime64[ns]" for col in dt_cols})
+        return df.map_partitions(self.parse_partition, meta=meta)
+
+    def parse_partition(self, df: pd.DataFrame) -> pd.DataFrame:
+        df = self.parse_dt_cols(df)
+        increment(unparseable_rows=self.unparseable_rows(df))
+        return df
+
+    def parse_dt_cols(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Parses the timestamp columns of a frame, recording the number of rows
+        with a timestamp that failed to parse in its attrs.
+        """
+        unparseable = pd.Series(False, index=df.index)
+        for col in schemas[self.header_version]["dt_cols"]:
+            parsed = parse_timestamps(df[col])
+            unparseable |= df[col].notna() & parsed.isna()
+            df[col] = parsed
+        df.attrs[UNPARSEABLE_ROWS] = int(unparseable.sum())
+        return df
+
+    def unparseable_rows(self, df: pd.DataFrame) -> int:
+        return df.attrs.get(UNPARSEABLE_ROWS, 0)
+
+    def load_chunks(
+        self, f: typing.BinaryIO, chunk_rows: int
+    ) -> typing.Iterator[pd.DataFrame]:
+        dtypes = schemas[self.header_version]["dtypes"]
+        with pd.read_csv(
+            f, dtype=dtypes, na_values=["\\N", ""], chunksize=chunk_rows
+        ) as reader:
+            for df in reader:
+                yield self.parse_dt_cols(df)
+
+    def to_arrow(self, df: pd.DataFrame) -> pa.Table:
+        """
+        Converts a parsed chunk to Arrow with the types of its header version,
+        so that every chunk of a file has the same schema. Other columns are
+        left out, as normalize drops them.
+        """
+        dtypes = schemas[self.header_version]["dtypes"]
+        dt_cols = schemas[self.header_version]["dt_cols"]
+        fields = []
+        for column in df.columns:
+            if column in dt_cols:
+                fields.append((column, pa.timestamp("ns")))
+            elif column in dtypes:
+                dtype = dtypes[column]
+                if dtype is str:
+                    fields.append((column, pa.string()))
+                elif dtype is np.double:
+                    fields.append((column, pa.float64()))
+                else:
+                    fields.append((column, pa.int64()))
+        table = pa.Table.from_pandas(df, schema=pa.schema(fields), preserve_index=False)
+        return table.replace_schema_metadata(
+            {
+                **table.schema.metadata,
+                UNPARSEABLE_ROWS.encode(): str(self.unparseable_rows(df)).encode(),
+            }
+        )
+
+    def from_arrow(self, table: pa.Table) -> pd.DataFrame:
+        df = table.to_pandas()
+        df.attrs[UNPARSEABLE_ROWS] = int(
+            (table.schema.metadata or {}).get(UNPARSEABLE_ROWS.encode(), 0)
+        )
         return df
 
-    def transform_v11(self) -> dd.DataFrame:
-        df = self.load_df()
+    def transform_v11(self, df):
         df["usertype"] = df["usertype"].replace(
             {"Subscriber": "member", "Customer": "casual"}
         )
@@ -97,8 +240,7 @@ class BulkCSVTransformer:
             },
         )
 
-    def transform_v12(self) -> dd.DataFrame:
-        df = self.load_df()
+    def transform_v12(self, df):
         df["User Type"] = df["User Type"].replace(
             {"Subscriber": "member", "Customer": "casual"}
         )
@@ -124,6 +266,5 @@ class BulkCSVTransformer:
             },
         )
 
-    def transform_v2(self) -> dd.DataFrame:
-        df = self.load_df()
+    def transform_v2(self, df):
         return df.assign(bike_id=None, gender=None, birth_year=None)
@@ -0,0 +1,290 @@
+import os
+import time
+import typing
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from instrumentation import report
+from log import log
+from manifest import TransformManifest
+
+# the columns of raw_trips, as created by 1_create_raw_trips_table.sql, which
+# isn't shipped with the pipeline; a test checks that the two match
+RAW_TRIPS_COLUMNS = """
+    ride_id String,
+    rideable_type String,
+    started_at DateTime,
+    ended_at DateTime,
+    start_station_id String,
+    start_station_name String,
+    start_lat Decimal(7, 5),
+    start_lng Decimal(8, 5),
+    end_station_id String,
+    end_station_name String,
+    end_lat Decimal(7, 5),
+    end_lng Decimal(8, 5),
+    member_casual String,
+    bike_id String,
+    gender String,
+    birth_year Int64,
+    start_current_station_id String,
+    end_current_station_id String
+"""
+
+
+class ClickHouseLoader:
+    """
+    Loads the transform output into a ClickHouse table over the HTTP
+    interface, streaming Parquet row groups to it as ArrowStream inserts
+    instead of having ClickHouse read the files with file(). The load goes
+    into a staging table that is swapped with the target once every insert
+    has succeeded, so queries never see a partial load.
+
+    Inserts are retried with the same insert_deduplication_token, so an
+    insert that succeeded but whose response was lost isn't written twice.
+    The staging table is created with the load's id as its comment, so that
+    an exchange that may or may not have gone through can be checked before
+    it's re-issued, as re-issuing it would swap the tables back.
+    """
+
+    URL = "http://localhost:8123"
+    BATCH_ROWS = 1_000_000
+    CONNECTIONS = 4
+    RETRIES = 5
+    RETRY_DELAY = 1.0
+    TIMEOUT = 300
+    # inserts remembered for deduplication by the staging table, which only
+    # needs to cover the inserts of a single load
+    DEDUPLICATION_WINDOW = 10_000
+
+    def __init__(
+        self,
+        out_dir: str,
+        url: str = URL,
+        table: str = "raw_trips",
+        batch_rows: int = BATCH_ROWS,
+        connections: int = CONNECTIONS,
+        user: typing.Optional[str] = None,
+        password: typing.Optional[str] = None,
+    ):
+        self.parquet_dir = os.path.join(out_dir, "parquet")
+        self.manifest = TransformManifest(
+            os.path.join(out_dir, TransformManifest.FILE_NAME)
+        )
+        self.url = url
+        self.table = table
+        self.staging_table = f"{table}_loading"
+        self.batch_rows = batch_rows
+        self.connections = connections
+        self.headers = {"X-ClickHouse-User": user or "default"}
+        if password:
+            self.headers["X-ClickHouse-Key"] = password
+
+    def load(self):
+        outputs = sorted(
+            output
+            for source in self.manifest.sources
+            for output in self.manifest.outputs(source)
+        )
+        # tokens are unique to the load, so reloading the same files into a
+        # fresh staging table is never mistaken for a retry
+        load_id = uuid.uuid4().hex
+        log(
+            "Loading trips into ClickHouse",
+            {"url": self.url, "table": self.table, "files": len(outputs)},
+        )
+
+        self.query(f"DROP TABLE IF EXISTS {self.staging_table}")
+        self.query(self.create_table_query(self.staging_table, load_id))
+        start_time = time.perf_counter()
+        rows = 0
+        with report.stage("load"), ThreadPoolExecutor(
+            max_workers=self.connections
+        ) as executor:
+            running: dict[Future, str] = {}
+            for i, batch in enumerate(self.batches(outputs)):
+                # bounds the batches held in memory to those being inserted
+                if len(running) >= self.connections:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        rows += self.record_insert(running.pop(future), future)
+
+                token = f"{load_id}-{i}"
+                running[executor.submit(self.insert, batch, token)] = token
+            for future in list(running):
+                rows += self.record_insert(running.pop(future), future)
+
+        self.query(self.create_table_query(self.table))
+        self.exchange(load_id)
+        # the staging table now holds the previous load, and dropping it again
+        # after a lost response is a no-op
+        self.query(f"DROP TABLE IF EXISTS {self.staging_table}")
+
+        elapsed = time.perf_counter() - start_time
+        log(
+            "Loaded trips into ClickHouse",
+            {
+                "table": self.table,
+                "rows": rows,
+                "elapsed": elapsed,
+                "rows_per_second": rows / elapsed if elapsed else None,
+            },
+        )
+
+    def create_table_query(self, table: str, load_id: str = "") -> str:
+        return (
+            f"CREATE TABLE IF NOT EXISTS {table} ({RAW_TRIPS_COLUMNS}) "
+            "ENGINE = MergeTree() ORDER BY tuple() "
+            f"SETTINGS non_replicated_deduplication_window = "
+            f"{ClickHouseLoader.DEDUPLICATION_WINDOW} "
+            f"COMMENT '{load_id}'"
+        )
+
+    def exchange(self, load_id: str):
+        """
+        Swaps the staging table, which holds the load, with the target. A
+        failed exchange is only re-issued once the target is known not to
+        hold the load.
+        """
+        for attempt in range(1, ClickHouseLoader.RETRIES + 1):
+            try:
+                self.query(
+                    f"EXCHANGE TABLES {self.staging_table} AND {self.table}",
+                    retries=1,
+                )
+                return
+            except RuntimeError as e:
+                if not self.is_retryable(e.__cause__):
+                    raise
+                if self.table_comment(self.table) == load_id:
+                    log("ClickHouse exchange went through", {"table": self.table})
+                    return
+                if attempt == ClickHouseLoader.RETRIES:
+                    raise
+                log(
+                    "Retrying ClickHouse exchange",
+                    {"attempt": attempt, "exception": str(e)},
+                )
+                time.sleep(ClickHouseLoader.RETRY_DELAY * 2 ** (attempt - 1))
+
+    def table_comment(self, table: str) -> str:
+        response, _ = self.request(
+            "SELECT comment FROM system.tables "
+            f"WHERE database = currentDatabase() AND name = '{table}' "
+            "FORMAT TabSeparatedRaw"
+        )
+        return response.decode().strip()
+
+    def batches(self, outputs: typing.List[str]) -> typing.Iterator[pa.Table]:
+        """
+        Reads the outputs as tables of batch_rows rows, combining small files
+        so that ClickHouse isn't left with a part per file to merge.
+        """
+        buffered: typing.List[pa.RecordBatch] = []
+        buffered_rows = 0
+        for output in outputs:
+            parquet_file = pq.ParquetFile(os.path.join(self.parquet_dir, output))
+            for batch in parquet_file.iter_batches(batch_size=self.batch_rows):
+                buffered.append(batch)
+                buffered_rows += batch.num_rows
+                if buffered_rows >= self.batch_rows:
+                    yield pa.Table.from_batches(buffered)
+                    buffered, buffered_rows = [], 0
+        if buffered:
+            yield pa.Table.from_batches(buffered)
+
+    def insert(self, table: pa.Table, token: str) -> typing.Tuple[int, int, int]:
+        """
+        Inserts a table into the staging table as an Arrow IPC stream.
+        Returns the rows and bytes sent and the attempts it took.
+        """
+        # chunks read from different files carry their own dictionaries
+        table = table.unify_dictionaries()
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        body = sink.getvalue().to_pybytes()
+
+        columns = ", ".join(table.column_names)
+        attempts = self.query(
+            f"INSERT INTO {self.staging_table} ({columns}) FORMAT ArrowStream",
+            body,
+            {"insert_deduplicate": 1, "insert_deduplication_token": token},
+        )
+        return table.num_rows, len(body), attempts
+
+    def record_insert(self, token: str, future: Future) -> int:
+        rows, size, attempts = future.result()
+        report.record_file("load", token, rows=rows, bytes_out=size, attempts=attempts)
+        return rows
+
+    def query(
+        self,
+        query: str,
+        body: typing.Optional[bytes] = None,
+        settings: typing.Optional[dict] = None,
+        retries: int = RETRIES,
+    ) -> int:
+        """
+        Runs a query, retrying failed requests with a backoff. Only queries
+        that are safe to run twice may be retried. Returns the number of
+        attempts it took.
+        """
+        _, attempts = self.request(query, body, settings, retries)
+        return attempts
+
+    def request(
+        self,
+        query: str,
+        body: typing.Optional[bytes] = None,
+        settings: typing.Optional[dict] = None,
+        retries: int = RETRIES,
+    ) -> typing.Tuple[bytes, int]:
+        """
+        Sends a query, passed as a URL parameter so that the body can carry
+        insert data. Returns the response and the number of attempts it took.
+        """
+        params = urllib.parse.urlencode({"query": query, **(settings or {})})
+        for attempt in range(1, retries + 1):
+            request = urllib.request.Request(
+                f"{self.url}/?{params}",
+                data=body if body is not None else b"",
+                headers=self.headers,
+                method="POST",
+            )
+            try:
+                with urllib.request.urlopen(
+                    request, timeout=ClickHouseLoader.TIMEOUT
+                ) as response:
+                    return response.read(), attempt
+            except (urllib.error.URLError, ConnectionError, TimeoutError) as e:
+                if not self.is_retryable(e) or attempt == retries:
+                    raise RuntimeError(
+                        f"ClickHouse query failed: {self.describe_error(e)}"
+                    ) from e
+                log(
+                    "Retrying ClickHouse query",
+                    {"attempt": attempt, "exception": self.describe_error(e)},
+                )
+                time.sleep(ClickHouseLoader.RETRY_DELAY * 2 ** (attempt - 1))
+        raise RuntimeError("ClickHouse query was never sent")
+
+    @staticmethod
+    def is_retryable(e: typing.Optional[BaseException]) -> bool:
+        # ClickHouse rejects invalid queries and data with 4xx codes, which
+        # retrying won't fix
+        if isinstance(e, urllib.error.HTTPError):
+            return e.code >= 500
+        return isinstance(e, (urllib.error.URLError, ConnectionError, TimeoutError))
+
+    @staticmethod
+    def describe_error(e: Exception) -> str:
+        if isinstance(e, urllib.error.HTTPError):
+            return f"{e.code}: {e.read().decode(errors='replace').strip()}"
+        return repr(e)
@@ -0,0 +1,136 @@
+import math
+
+import dask
+from dask.distributed import Client
+from dask.system import CPU_COUNT
+from distributed.system import MEMORY_LIMIT
+
+# worker memory fractions at which stored results are spilled to disk, at which
+# workers stop starting tasks and at which the nanny restarts them
+MEMORY_THRESHOLDS = {"target": 0.6, "spill": 0.7, "pause": 0.85, "terminate": 0.95}
+
+
+def get_memory_thresholds() -> dict[str, float]:
+    return {
+        name: dask.config.get(f"distributed.worker.memory.{name}")
+        for name in MEMORY_THRESHOLDS
+    }
+
+
+class ClusterConfig:
+    """
+    Sizes Dask workers and CSV blocks from the bytes to transform and the cores
+    and memory available (both as limited by cgroups in a container), so that
+    partitions of the largest files fit in worker memory and small inputs
+    don't start more workers than they have partitions.
+    """
+
+    # parsed pandas partitions take several times the bytes of their CSV text
+    MEMORY_EXPANSION = 6
+    # share of memory left to the client process, the scheduler and the OS
+    RESERVED_MEMORY = 0.15
+    # pyarrow parses with its own threads outside the GIL, so the arrow engine
+    # shares each worker's memory between a few threads
+    ARROW_THREADS_PER_WORKER = 4
+    PARTITIONS_PER_THREAD = 4
+    MIN_BLOCKSIZE = 16 * 1024 * 1024
+    MAX_BLOCKSIZE = 256 * 1024 * 1024
+
+    def __init__(
+        self,
+        n_workers: int,
+        threads_per_worker: int,
+        memory_per_worker: int,
+        memory_thresholds: dict[str, float] = MEMORY_THRESHOLDS,
+    ):
+        self.n_workers = n_workers
+        self.threads_per_worker = threads_per_worker
+        self.memory_per_worker = memory_per_worker
+        self.memory_thresholds = memory_thresholds
+
+    @staticmethod
+    def auto(
+        total_bytes: int,
+        engine: str = "dask",
+        cores: int = CPU_COUNT,
+        memory: int = MEMORY_LIMIT,
+    ) -> "ClusterConfig":
+        """
+        Runs a thread per core, as long as each thread has the memory to
+        transform a block of the minimum size and there are enough blocks of
+        input to keep it busy.
+        """
+        usable_memory = int(memory * (1 - ClusterConfig.RESERVED_MEMORY))
+        thread_memory = (
+            ClusterConfig.MIN_BLOCKSIZE
+            * ClusterConfig.MEMORY_EXPANSION
+            / MEMORY_THRESHOLDS["target"]
+        )
+        threads = min(
+            cores,
+            int(usable_memory // thread_memory),
+            math.ceil(total_bytes / ClusterConfig.MIN_BLOCKSIZE),
+        )
+        threads = max(threads, 1)
+
+        threads_per_worker = (
+            min(threads, ClusterConfig.ARROW_THREADS_PER_WORKER)
+            if engine == "arrow"
+            else 1
+        )
+        n_workers = math.ceil(threads / threads_per_worker)
+        return ClusterConfig(n_workers, threads_per_worker, usable_memory // n_workers)
+
+    @staticmethod
+    def from_client(client: Client) -> "ClusterConfig":
+        """
+        Describes the workers of a running cluster, e.g. one started by
+        another process. Workers without a memory limit are assumed to share
+        the memory of this host.
+        """
+        workers = client.scheduler_info()["workers"].values()
+        n_workers = max(len(workers), 1)
+        threads = [worker["nthreads"] for worker in workers] or [1]
+        memory = [worker.get("memory_limit") or 0 for worker in workers] or [0]
+        return ClusterConfig(
+            n_workers,
+            max(threads),
+            min(memory) if min(memory) else MEMORY_LIMIT // n_workers,
+            next(iter(client.run(get_memory_thresholds).values()), MEMORY_THRESHOLDS),
+        )
+
+    def blocksize(self, version_bytes: int) -> int:
+        """
+        Sizes CSV blocks so that files of a header version are split into a few
+        partitions per worker thread, within bounds that keep partitions from
+        being dominated by overhead or exhausting worker memory.
+        """
+        threads = self.n_workers * self.threads_per_worker
+        blocksize = version_bytes / (threads * ClusterConfig.PARTITIONS_PER_THREAD)
+        memory_bound = (
+            self.memory_per_worker
+            / self.threads_per_worker
+            * (self.memory_thresholds["target"] or MEMORY_THRESHOLDS["target"])
+            / ClusterConfig.MEMORY_EXPANSION
+        )
+        return int(
+            min(
+                max(blocksize, ClusterConfig.MIN_BLOCKSIZE),
+                ClusterConfig.MAX_BLOCKSIZE,
+                memory_bound,
+            )
+        )
+
+    def dask_config(self) -> dict[str, float]:
+        return {
+            f"distributed.worker.memory.{name}": fraction
+            for name, fraction in self.memory_thresholds.items()
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            "n_workers": self.n_workers,
+            "threads_per_worker": self.threads_per_worker,
+            "memory_per_worker": self.memory_per_worker,
+            "memory_thresholds": self.memory_thresholds,
+        }
@@ -0,0 +1,275 @@
+import math
+import os
+import shutil
+import typing
+
+import dask
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from instrumentation import report
+from log import log
+from parquet_writer import PartitionedParquetWriter
+from rollup import DIRECTIONS, rollup
+
+# columns a trip's fingerprint is computed from: the ride id where there is
+# one, otherwise its start time, start station and bike
+FINGERPRINT_COLUMNS = ["ride_id", "started_at", "start_station_id", "bike_id"]
+
+# two independently keyed 64-bit hashes make up a 128-bit fingerprint, so that
+# collisions are negligible even across the whole corpus
+HASH_KEYS = ["citibike-dedup-1", "citibike-dedup-2"]
+
+spill_schema = pa.schema(
+    [
+        ("hash1", pa.uint64()),
+        ("hash2", pa.uint64()),
+        ("file", pa.int32()),
+        ("row", pa.int64()),
+    ]
+)
+
+
+def fingerprint(batch: pa.RecordBatch, hash_key: str) -> np.ndarray:
+    df = batch.to_pandas()
+    ride_ids = df["ride_id"].astype(object)
+    by_ride_id = pd.util.hash_array(ride_ids.to_numpy(), hash_key=hash_key)
+    by_trip = pd.util.hash_pandas_object(
+        df[["started_at", "start_station_id", "bike_id"]],
+        index=False,
+        hash_key=hash_key,
+    ).to_numpy()
+    return np.where(ride_ids.notna().to_numpy(), by_ride_id, ~by_trip)
+
+
+def spill_file(path: str, file_id: int, spill_path: str, buckets: int) -> int:
+    """
+    Writes the fingerprints of a file's rows to an Arrow IPC file holding one
+    record batch per bucket, so that a bucket can be read from every spill file
+    without reading the rest. Returns the number of rows.
+    """
+    hashes1, hashes2, rows = [], [], 0
+    for batch in pq.ParquetFile(path).iter_batches(columns=FINGERPRINT_COLUMNS):
+        hashes1.append(fingerprint(batch, HASH_KEYS[0]))
+        hashes2.append(fingerprint(batch, HASH_KEYS[1]))
+        rows += batch.num_rows
+
+    hash1 = np.concatenate(hashes1) if hashes1 else np.empty(0, np.uint64)
+    hash2 = np.concatenate(hashes2) if hashes2 else np.empty(0, np.uint64)
+    bucket = hash1 % np.uint64(buckets)
+    order = np.argsort(bucket, kind="stable")
+    bounds = np.searchsorted(bucket[order], np.arange(buckets + 1))
+
+    with pa.OSFile(spill_path, "wb") as f, pa.ipc.new_file(f, spill_schema) as writer:
+        for i in range(buckets):
+            rows_in_bucket = order[bounds[i] : bounds[i + 1]]
+            writer.write_batch(
+                pa.record_batch(
+                    [
+                        pa.array(hash1[rows_in_bucket]),
+                        pa.array(hash2[rows_in_bucket]),
+                        pa.array(np.full(len(rows_in_bucket), file_id, np.int32)),
+                        pa.array(rows_in_bucket.astype(np.int64)),
+                    ],
+                    schema=spill_schema,
+                )
+            )
+    return rows
+
+
+def find_duplicates(spill_paths: typing.List[str], bucket: int) -> pa.Table:
+    """
+    Finds the duplicate rows of a bucket across every spill file. The first
+    occurrence of a fingerprint, in file and row order, is kept.
+    """
+    batches = [
+        pa.ipc.open_file(pa.memory_map(path)).get_batch(bucket) for path in spill_paths
+    ]
+    table = pa.Table.from_batches(batches, schema=spill_schema)
+    hash1 = table.column("hash1").to_numpy()
+    hash2 = table.column("hash2").to_numpy()
+    file = table.column("file").to_numpy()
+    row = table.column("row").to_numpy()
+
+    order = np.lexsort((row, file, hash2, hash1))
+    hash1, hash2 = hash1[order], hash2[order]
+    duplicate = np.zeros(len(order), dtype=bool)
+    duplicate[1:] = (hash1[1:] == hash1[:-1]) & (hash2[1:] == hash2[:-1])
+    return pa.table(
+        {"file": file[order][duplicate], "row": row[order][duplicate]},
+    )
+
+
+class TripDeduplicator:
+    """
+    Drops trips that appear more than once across the written dataset, e.g.
+    when a chunked CSV and the whole file it was split from are both
+    transformed. Fingerprints are spilled to disk in hash buckets that are
+    each small enough to deduplicate in a worker's memory, and only files
+    that contain duplicates are rewritten.
+
+    Copies of a trip share its start time, so only the partitions a run
+    touched need deduplicating. The rows dropped from an output are kept
+    aside, and restored before its partition is deduplicated again, so that
+    a trip reappears once the copy it was deduplicated against is removed.
+    """
+
+    SPILL_DIR = "dedup-spill"
+    DROPPED_DIR = "dedup-dropped"
+    # rows of a bucket, at 24 bytes per fingerprint, file and row
+    BUCKET_ROWS = 16_000_000
+
+    def __init__(
+        self,
+        writer: PartitionedParquetWriter,
+        work_dir: str,
+        bucket_rows: int = BUCKET_ROWS,
+    ):
+        self.writer = writer
+        self.spill_dir = os.path.join(work_dir, TripDeduplicator.SPILL_DIR)
+        self.dropped_dir = os.path.join(work_dir, TripDeduplicator.DROPPED_DIR)
+        self.bucket_rows = bucket_rows
+
+    def deduplicate(self, outputs: typing.List[str]) -> int:
+        """
+        Restores the rows previously dropped from the given outputs of the
+        writer and deduplicates them, which must be every output of their
+        partitions. Returns the number of outputs rewritten.
+        """
+        if not outputs:
+            return 0
+
+        outputs = sorted(outputs)
+        with report.stage("dedup"):
+            restored = [output for output in outputs if self.has_dropped(output)]
+            dask.compute([dask.delayed(self.restore)(output) for output in restored])
+
+        paths = [os.path.join(self.writer.out_dir, output) for output in outputs]
+        total_rows = sum(pq.read_metadata(path).num_rows for path in paths)
+        buckets = max(1, math.ceil(total_rows / self.bucket_rows))
+
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+        os.makedirs(self.spill_dir)
+        try:
+            with report.stage("dedup"):
+                spill_paths = [
+                    os.path.join(self.spill_dir, f"{i}.arrow")
+                    for i in range(len(paths))
+                ]
+                dask.compute(
+                    [
+                        dask.delayed(spill_file)(path, i, spill_path, buckets)
+                        for i, (path, spill_path) in enumerate(zip(paths, spill_paths))
+                    ]
+                )
+
+                (duplicates,) = dask.compute(
+                    [
+                        dask.delayed(find_duplicates)(spill_paths, bucket)
+                        for bucket in range(buckets)
+                    ]
+                )
+                duplicates = pa.concat_tables(duplicates)
+                file = duplicates.column("file").to_numpy()
+                order = np.argsort(file, kind="stable")
+                files, starts = np.unique(file[order], return_index=True)
+                rows_by_file = dict(
+                    zip(
+                        files.tolist(),
+                        np.split(
+                            duplicates.column("row").to_numpy()[order], starts[1:]
+                        ),
+                    )
+                )
+
+                dask.compute(
+                    [
+                        dask.delayed(self.drop_rows)(outputs[file], rows)
+                        for file, rows in rows_by_file.items()
+                    ]
+                )
+                for file, rows in rows_by_file.items():
+                    report.record_file("dedup", outputs[file], duplicates=len(rows))
+        finally:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+        rewritten = set(restored) | {outputs[file] for file in rows_by_file}
+        log(
+            "Deduplicated trips",
+            {
+                "files": len(outputs),
+                "rows": total_rows,
+                "buckets": buckets,
+                "duplicates": duplicates.num_rows,
+                "restored_files": len(restored),
+                "rewritten_files": len(rewritten),
+            },
+        )
+        return len(rewritten)
+
+    def dropped_path(self, output: str) -> str:
+        return os.path.join(self.dropped_dir, output)
+
+    def has_dropped(self, output: str) -> bool:
+        return os.path.exists(self.dropped_path(output))
+
+    def drop_rows(self, output: str, rows: np.ndarray):
+        """
+        Rewrites an output without the given rows, keeping the dropped rows
+        aside.
+        """
+        path = os.path.join(self.writer.out_dir, output)
+        table = pq.ParquetFile(path).read().cast(self.writer.output_schema)
+        keep = np.ones(table.num_rows, dtype=bool)
+        keep[rows] = False
+
+        dropped_path = self.dropped_path(output)
+        os.makedirs(os.path.dirname(dropped_path), exist_ok=True)
+        with pq.ParquetWriter(
+            f"{dropped_path}.tmp",
+            self.writer.output_schema,
+            compression=self.writer.compression,
+            store_decimal_as_integer=True,
+        ) as writer:
+            writer.write_table(table.filter(pa.array(~keep)))
+        os.replace(f"{dropped_path}.tmp", dropped_path)
+
+        self.rewrite(output, table.filter(pa.array(keep)))
+
+    def restore(self, output: str):
+        """
+        Rewrites an output with the rows previously dropped from it.
+        """
+        path = os.path.join(self.writer.out_dir, output)
+        dropped_path = self.dropped_path(output)
+        table = pa.concat_tables(
+            [
+                pq.ParquetFile(path).read().cast(self.writer.output_schema),
+                pq.ParquetFile(dropped_path).read().cast(self.writer.output_schema),
+            ]
+        ).sort_by("started_at")
+        self.rewrite(output, table)
+        os.remove(dropped_path)
+
+    def rewrite(self, output: str, table: pa.Table):
+        """
+        Replaces an output, along with its rollups and samples.
+        """
+        path = os.path.join(self.writer.out_dir, output)
+        self.writer.write_table(table, f"{output}.tmp")
+        os.replace(f"{path}.tmp", path)
+        if self.writer.rollups:
+            self.writer.rollups.write(
+                output,
+                {direction: rollup(table, direction) for direction in DIRECTIONS},
+            )
+        if self.writer.samples:
+            self.writer.samples.write(output, table)
+
+    def remove(self, output: str):
+        try:
+            os.remove(self.dropped_path(output))
+        except FileNotFoundError:
+            pass
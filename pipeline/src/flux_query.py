@@ -0,0 +1,241 @@
+import datetime
+import json
+import os
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from instrumentation import report
+from log import log
+from station_resolver import STATIONS_FILE
+
+# the station and time each direction of flux is counted by, as in the
+# outbound_trips and inbound_trips tables
+DIRECTIONS = {
+    "outbound": ("start_current_station_id", "started_at"),
+    "inbound": ("end_current_station_id", "ended_at"),
+}
+
+COLUMNS = [column for columns in DIRECTIONS.values() for column in columns]
+
+counts_schema = pa.schema([("station_id", pa.string()), ("trips", pa.int64())])
+
+
+def parse_date(date: str) -> datetime.datetime:
+    return datetime.datetime.strptime(date, "%Y%m%d")
+
+
+class FluxQuery:
+    """
+    Counts the inbound and outbound trips of each station straight from the
+    transform output, with the same filters as the map's flux query: trips
+    from the start date through the end date, within a time of day window
+    and on some days of the week. Stations are keyed by their short name and
+    only trips with both stations resolved are counted, as in the trips table.
+
+    Only the partitions and row groups whose statistics can hold trips in the
+    date range are read, and of those only the columns the counts need. Files
+    are scanned and counted in parallel.
+    """
+
+    def __init__(
+        self,
+        out_dir: str,
+        start_date: str,
+        end_date: str,
+        start_time: typing.Optional[str] = None,
+        end_time: typing.Optional[str] = None,
+        days_of_week: typing.Optional[typing.List[int]] = None,
+        threads: typing.Optional[int] = None,
+    ):
+        self.parquet_dir = os.path.join(out_dir, "parquet")
+        self.stations_path = os.path.join(out_dir, STATIONS_FILE)
+        self.start = parse_date(start_date)
+        # the end date is included whole
+        self.end = parse_date(end_date) + datetime.timedelta(days=1)
+        self.start_time = int(start_time) if start_time else None
+        self.end_time = int(end_time) if end_time else None
+        self.days_of_week = days_of_week
+        self.threads = threads or os.cpu_count() or 1
+
+    def date_filter(self, column: str) -> ds.Expression:
+        timestamp = pa.timestamp("ns")
+        return (ds.field(column) >= pa.scalar(self.start, timestamp)) & (
+            ds.field(column) < pa.scalar(self.end, timestamp)
+        )
+
+    def scan_filter(self) -> ds.Expression:
+        """
+        Matches trips that started or ended in the date range. Partitions are by
+        start time, so trips that end in the range never start after it, other
+        than those without a start time, which are in the null partition.
+        """
+        last = self.end - datetime.timedelta(days=1)
+        partition_filter = (
+            (ds.field("year") < last.year)
+            | ((ds.field("year") == last.year) & (ds.field("month") <= last.month))
+            | ds.field("year").is_null()
+        )
+        return partition_filter & (
+            self.date_filter("started_at") | self.date_filter("ended_at")
+        )
+
+    def time_mask(self, times: pa.Array) -> pa.Array:
+        """
+        Applies the date range, time of day and day of week filters. Windows
+        where the start time is after the end time wrap around midnight.
+        """
+        mask = pc.and_(
+            pc.greater_equal(times, pa.scalar(self.start, times.type)),
+            pc.less(times, pa.scalar(self.end, times.type)),
+        )
+        if self.start_time is not None and self.end_time is not None:
+            time_of_day = pc.add(
+                pc.add(
+                    pc.multiply(pc.hour(times), 10000),
+                    pc.multiply(pc.minute(times), 100),
+                ),
+                pc.second(times),
+            )
+            if self.start_time > self.end_time:
+                window = pc.or_(
+                    pc.greater(time_of_day, self.start_time),
+                    pc.less(time_of_day, self.end_time),
+                )
+            else:
+                window = pc.and_(
+                    pc.greater_equal(time_of_day, self.start_time),
+                    pc.less_equal(time_of_day, self.end_time),
+                )
+            mask = pc.and_(mask, window)
+        if self.days_of_week is not None:
+            # 0 is Monday, as in ClickHouse's toDayOfWeek(t, 1)
+            day_of_week = pc.day_of_week(times, count_from_zero=True, week_start=1)
+            mask = pc.and_(
+                mask, pc.is_in(day_of_week, pa.array(self.days_of_week, pa.int64()))
+            )
+        return mask
+
+    def count_fragment(
+        self, fragment: ds.ParquetFileFragment, schema: pa.Schema, short_names: dict
+    ) -> typing.Tuple[dict[str, pa.Table], dict]:
+        """
+        Counts trips per station and direction in the row groups of a file that
+        can match the filters.
+        """
+        scan_filter = self.scan_filter()
+        row_groups = fragment.split_by_row_group(scan_filter, schema=schema)
+        tables = [
+            row_group.to_table(
+                schema=schema, columns=COLUMNS, filter=scan_filter, use_threads=False
+            )
+            for row_group in row_groups
+        ]
+        table = (
+            pa.concat_tables(tables) if tables else schema.empty_table().select(COLUMNS)
+        )
+
+        # stations are looked up by current id, as trips are joined to
+        # current_stations, and both must resolve
+        station_ids = {}
+        for direction, (station, _) in DIRECTIONS.items():
+            station_ids[direction] = pc.take(
+                short_names["short_names"],
+                pc.index_in(
+                    table.column(station).cast(pa.string()), short_names["ids"]
+                ),
+            )
+        resolved = pc.and_(
+            pc.is_valid(station_ids["outbound"]), pc.is_valid(station_ids["inbound"])
+        )
+
+        counts = {}
+        for direction, (_, timestamp) in DIRECTIONS.items():
+            mask = pc.and_(resolved, self.time_mask(table.column(timestamp)))
+            trips = pa.table({"station_id": station_ids[direction]}).filter(mask)
+            counts[direction] = (
+                trips.group_by("station_id")
+                .aggregate([([], "count_all")])
+                .rename_columns(counts_schema.names)
+            )
+
+        stats = {
+            "row_groups": fragment.num_row_groups,
+            "row_groups_read": len(row_groups),
+            "rows_read": table.num_rows,
+        }
+        return counts, stats
+
+    def load_short_names(self) -> dict[str, pa.Array]:
+        with open(self.stations_path, "r") as f:
+            stations = json.load(f)
+        if isinstance(stations, dict):
+            stations = stations["data"]["stations"]
+        return {
+            "ids": pa.array([str(station["station_id"]) for station in stations]),
+            "short_names": pa.array(
+                [station.get("short_name") for station in stations], pa.string()
+            ),
+        }
+
+    def run(self) -> pa.Table:
+        """
+        Returns the inbound and outbound trips of each station with trips in
+        both directions.
+        """
+        start_time = time.perf_counter()
+        dataset = ds.dataset(self.parquet_dir, format="parquet", partitioning="hive")
+        fragments = list(dataset.get_fragments(filter=self.scan_filter()))
+        short_names = self.load_short_names()
+
+        with report.stage("query"), ThreadPoolExecutor(
+            max_workers=self.threads
+        ) as executor:
+            results = list(
+                executor.map(
+                    lambda fragment: self.count_fragment(
+                        fragment, dataset.schema, short_names
+                    ),
+                    fragments,
+                )
+            )
+            for fragment, (_, stats) in zip(fragments, results):
+                report.record_file(
+                    "query", os.path.relpath(fragment.path, self.parquet_dir), **stats
+                )
+
+        totals = {}
+        for direction in DIRECTIONS:
+            partial = [counts[direction] for counts, _ in results]
+            combined = (
+                pa.concat_tables(partial) if partial else counts_schema.empty_table()
+            )
+            totals[direction] = (
+                combined.group_by("station_id")
+                .aggregate([("trips", "sum")])
+                .rename_columns(["station_id", direction])
+            )
+
+        flux = (
+            totals["inbound"]
+            .join(totals["outbound"], "station_id", join_type="inner")
+            .sort_by("station_id")
+        )
+        log(
+            "Queried station flux",
+            {
+                "files": len(fragments),
+                "row_groups": sum(stats["row_groups"] for _, stats in results),
+                "row_groups_read": sum(
+                    stats["row_groups_read"] for _, stats in results
+                ),
+                "rows_read": sum(stats["rows_read"] for _, stats in results),
+                "stations": flux.num_rows,
+                "elapsed": time.perf_counter() - start_time,
+            },
+        )
+        return flux
@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+import typing
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from bulk_csv_transformer import get_header_version
+from log import log
+from manifest import member_fingerprint
+
+
+class HeaderClassifier:
+    """
+    Classifies CSVs by header version from the first bytes of each file or
+    archive member. Files are read concurrently and results are cached by file
+    fingerprint, so unchanged files are never reopened.
+    """
+
+    CACHE_FILE = "header_cache.json"
+    PROLOGUE_BYTES = 4096
+    MAX_WORKERS = 16
+
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path
+        self.cache_lock = threading.Lock()
+        self.cache: dict[str, dict] = {}
+        if os.path.exists(cache_path):
+            with open(cache_path, "r") as f:
+                self.cache = json.load(f)
+
+    def classify_files(self, paths: typing.List[str]) -> dict[str, str]:
+        def classify(path: str) -> str:
+            stat = os.stat(path)
+            fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime}
+            return self.classify(path, fingerprint, lambda: open(path, "rb"))
+
+        with ThreadPoolExecutor(max_workers=HeaderClassifier.MAX_WORKERS) as executor:
+            versions = dict(zip(paths, executor.map(classify, paths)))
+
+        self.save()
+        return versions
+
+    def classify_members(
+        self, archive_path: str, zipinfos: typing.List[zipfile.ZipInfo]
+    ) -> dict[str, str]:
+        archive_name = os.path.basename(archive_path)
+        with open(archive_path, "rb") as f, zipfile.ZipFile(f) as zip_ref:
+
+            def classify(zipinfo: zipfile.ZipInfo) -> str:
+                return self.classify(
+                    f"{archive_name}!{zipinfo.filename}",
+                    member_fingerprint(zipinfo),
+                    lambda: zip_ref.open(zipinfo),
+                )
+
+            with ThreadPoolExecutor(
+                max_workers=HeaderClassifier.MAX_WORKERS
+            ) as executor:
+                versions = dict(
+                    zip(
+                        [zipinfo.filename for zipinfo in zipinfos],
+                        executor.map(classify, zipinfos),
+                    )
+                )
+
+        self.save()
+        return versions
+
+    def classify(
+        self,
+        key: str,
+        fingerprint: dict,
+        open_file: typing.Callable[[], typing.BinaryIO],
+    ) -> str:
+        cached = self.cache.get(key)
+        if cached and cached["fingerprint"] == fingerprint:
+            return cached["version"]
+
+        with open_file() as f:
+            version = get_header_version(read_header(f))
+
+        with self.cache_lock:
+            self.cache[key] = {"fingerprint": fingerprint, "version": version}
+        return version
+
+    def save(self):
+        tmp_path = f"{self.cache_path}.tmp"
+        with self.cache_lock, open(tmp_path, "w") as f:
+            json.dump(self.cache, f)
+        os.replace(tmp_path, self.cache_path)
+
+
+def read_header(f: typing.BinaryIO) -> str:
+    prologue = f.read(HeaderClassifier.PROLOGUE_BYTES)
+    return prologue.split(b"\n", 1)[0].decode("utf-8-sig").replace("\r", "")
+
+
+def header_inventory(
+    versions: dict[str, str], sizes: dict[str, int]
+) -> dict[str, dict[str, int]]:
+    """
+    Counts the files and bytes of each header version.
+    """
+    inventory: dict[str, dict[str, int]] = {}
+    for key, version in versions.items():
+        counts = inventory.setdefault(version, {"files": 0, "bytes": 0})
+        counts["files"] += 1
+        counts["bytes"] += sizes[key]
+
+    log("Classified files by header version", {"inventory": inventory})
+    return inventory
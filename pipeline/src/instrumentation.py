@@ -0,0 +1,200 @@
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import typing
+
+import psutil
+from dask.utils import key_split
+
+from log import log
+
+
+def get_tree_rss() -> int:
+    """
+    Resident memory of this process and all of its children, which includes
+    extraction pool processes and local Dask workers.
+    """
+    process = psutil.Process()
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return rss
+
+
+# counters incremented by tasks, e.g. of rows that failed to parse. Tasks run on
+# Dask workers, so the counts of a run are summed over the workers'
+# get_worker_counters
+counters_lock = threading.Lock()
+worker_counters: dict[str, int] = {}
+
+
+def increment(**metrics):
+    with counters_lock:
+        for metric, value in metrics.items():
+            worker_counters[metric] = worker_counters.get(metric, 0) + value
+
+
+def get_worker_counters() -> dict:
+    with counters_lock:
+        return dict(worker_counters)
+
+
+def reset_worker_counters():
+    with counters_lock:
+        worker_counters.clear()
+
+
+def summarize_tasks(tasks: typing.List[dict]) -> dict:
+    """
+    Aggregates a Dask task stream into task counts and time spent per action
+    (compute, transfer, disk-read, ...) for each task prefix.
+    """
+    prefixes: dict[str, dict] = {}
+    workers = set()
+    for task in tasks:
+        prefix = prefixes.setdefault(key_split(task["key"]), {"tasks": 0})
+        prefix["tasks"] += 1
+        workers.add(task.get("worker"))
+        for startstop in task["startstops"]:
+            action = startstop["action"]
+            prefix[action] = prefix.get(action, 0.0) + (
+                startstop["stop"] - startstop["start"]
+            )
+
+    return {"tasks": len(tasks), "workers": len(workers), "prefixes": prefixes}
+
+
+class RunReport:
+    """
+    Collects wall time, peak memory, per-file bytes and rows and Dask task
+    stats for each stage of a run, and writes them to a JSON report.
+    """
+
+    REPORT_DIR = "reports"
+    SAMPLE_INTERVAL = 0.2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active: typing.List[dict] = []
+        self.sampler: typing.Optional[threading.Thread] = None
+        self.reset()
+
+    def reset(self):
+        """
+        Starts a new report, e.g. between runs of a benchmark.
+        """
+        self.started_at = time.time()
+        self.stages: dict[str, dict] = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> typing.Iterator[dict]:
+        with self.lock:
+            stage = self.stages.setdefault(
+                name, {"elapsed": 0.0, "peak_rss": 0, "files": {}}
+            )
+            self.active.append(stage)
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self.sample_loop, daemon=True)
+                self.sampler.start()
+
+        self.sample()
+        start_time = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage["elapsed"] += time.perf_counter() - start_time
+            self.sample()
+            with self.lock:
+                self.active.remove(stage)
+            log(
+                "Finished stage",
+                {
+                    "stage": name,
+                    "elapsed": stage["elapsed"],
+                    "peak_rss": stage["peak_rss"],
+                },
+            )
+
+    def sample_loop(self):
+        while True:
+            time.sleep(RunReport.SAMPLE_INTERVAL)
+            if self.active:
+                self.sample()
+
+    def sample(self):
+        rss = get_tree_rss()
+        with self.lock:
+            for stage in self.active:
+                stage["peak_rss"] = max(stage["peak_rss"], rss)
+
+    def record_file(self, stage: str, file: str, **metrics):
+        """
+        Records metrics of a file processed by a stage, e.g. elapsed, bytes_in,
+        bytes_out and rows. Metrics recorded for the same file are summed.
+        """
+        with self.lock:
+            stage_files = self.stages.setdefault(
+                stage, {"elapsed": 0.0, "peak_rss": 0, "files": {}}
+            )["files"]
+            file_metrics = stage_files.setdefault(file, {})
+            for metric, value in metrics.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    value += file_metrics.get(metric, 0)
+                file_metrics[metric] = value
+
+    def record_stage(self, stage: str, **metrics):
+        """
+        Records metrics of a stage as a whole, e.g. cache hits, replacing any
+        recorded before.
+        """
+        with self.lock:
+            self.stages.setdefault(
+                stage, {"elapsed": 0.0, "peak_rss": 0, "files": {}}
+            ).update(metrics)
+
+    def record_tasks(self, stage: str, tasks: typing.List[dict]):
+        with self.lock:
+            self.stages[stage]["dask"] = summarize_tasks(tasks)
+
+    def to_dict(self) -> dict:
+        stages = {}
+        with self.lock:
+            for name, stage in self.stages.items():
+                totals: dict[str, float] = {}
+                for metrics in stage["files"].values():
+                    for metric in ("bytes_in", "bytes_out", "rows"):
+                        if metric in metrics:
+                            totals[metric] = totals.get(metric, 0) + metrics[metric]
+                stages[name] = {"file_count": len(stage["files"]), **totals, **stage}
+
+        return {
+            "started_at": time.strftime(
+                "%Y-%m-%dT%H:%M:%S%z", time.localtime(self.started_at)
+            ),
+            "elapsed": time.time() - self.started_at,
+            "argv": sys.argv,
+            "stages": stages,
+        }
+
+    def save(self, out_dir: str) -> str:
+        report_dir = os.path.join(out_dir, RunReport.REPORT_DIR)
+        os.makedirs(report_dir, exist_ok=True)
+        path = os.path.join(
+            report_dir,
+            f"run-{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at))}.json",
+        )
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+        log("Wrote run report", {"path": path})
+        return path
+
+
+# the report of the current run, shared by every stage of the pipeline
+report = RunReport()
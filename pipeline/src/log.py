@@ -1,27 +1,163 @@
+import atexit
+import datetime
+import json
 import logging
-import threading
+import os
 import queue
+import threading
+import time
+import typing
 
 logging.basicConfig(
     level=logging.INFO, format="[%(asctime)s] %(message)s", datefmt="%d/%m/%Y %H:%M:%S"
 )
 
-log_queue = queue.Queue()
+# DEBUG enables the per-item messages logged in hot loops
+LOG_LEVEL = getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO)
+# "json" emits an object per line, "text" the message followed by its metadata
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10_000))
+# emits one in every LOG_SAMPLE_EVERY occurrences of each per-item message
+SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", 1))
+# lists in metadata are emitted up to this many items, followed by their length
+MAX_ITEMS = int(os.getenv("LOG_MAX_ITEMS", 20))
+
+Meta = typing.Optional[typing.Union[dict, typing.Callable[[], dict]]]
+
+
+def truncate(value):
+    if isinstance(value, dict):
+        return {key: truncate(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        items = [truncate(item) for item in list(value)[:MAX_ITEMS]]
+        if len(value) > MAX_ITEMS:
+            items.append(f"... {len(value)} items")
+        return items
+    return value
+
+
+class AsyncLogger:
+    """
+    Emits log messages from a background thread, so that logging never waits
+    on formatting or the terminal. Messages are queued with a reference to
+    their metadata, which is only truncated and serialized when emitted.
+
+    The queue is bounded: messages block when it is full, while per-item
+    messages are sampled and dropped instead, with the number dropped
+    reported with the next message emitted. Queued messages are flushed when
+    the process exits.
+    """
+
+    FLUSH_TIMEOUT = 5.0
 
+    def __init__(
+        self,
+        level: int = LOG_LEVEL,
+        log_format: str = LOG_FORMAT,
+        queue_size: int = QUEUE_SIZE,
+        sample_every: int = SAMPLE_EVERY,
+    ):
+        self.level = level
+        self.log_format = log_format
+        self.sample_every = max(sample_every, 1)
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.occurrences: dict[str, int] = {}
+        self.dropped = 0
+        self.logger = logging.getLogger("pipeline")
+        self.logger.setLevel(level)
+        if log_format == "json":
+            # lines carry their own time and level
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(handler)
+            self.logger.propagate = False
+        self.thread = threading.Thread(target=self.process_queue, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
 
-def log(msg, meta=None):
-    log_queue.put((msg, meta))
+    def is_enabled(self, level: int) -> bool:
+        return level >= self.level
 
+    def log(self, level: int, msg: str, meta: Meta = None, per_item: bool = False):
+        if not self.is_enabled(level):
+            return
+        entry = (time.time(), level, msg, meta)
+        if not per_item:
+            self.queue.put(entry)
+            return
 
-def process_log_queue():
-    while True:
+        with self.lock:
+            occurrences = self.occurrences.get(msg, 0)
+            self.occurrences[msg] = occurrences + 1
+        if occurrences % self.sample_every:
+            return
         try:
-            log_entry, meta = log_queue.get()
-            logging.info(f"{log_entry} {meta}")
-            log_queue.task_done()
-        except Exception as e:
-            logging.error(f"Error processing log entry: {e}")
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def process_queue(self):
+        while True:
+            entry = self.queue.get()
+            try:
+                if entry is None:
+                    return
+                self.emit(*entry)
+            except Exception as e:
+                logging.error(f"Error processing log entry: {e!r}")
+            finally:
+                self.queue.task_done()
+
+    def emit(self, created: float, level: int, msg: str, meta: Meta):
+        if callable(meta):
+            meta = meta()
+        meta = truncate(meta or {})
+        with self.lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            meta["dropped_messages"] = dropped
+
+        if self.log_format == "json":
+            line = json.dumps(
+                {
+                    "time": datetime.datetime.fromtimestamp(created).isoformat(),
+                    "level": logging.getLevelName(level),
+                    "msg": msg,
+                    **meta,
+                },
+                default=repr,
+            )
+        else:
+            line = f"{msg} {meta}" if meta else msg
+        self.logger.log(level, line)
+
+    def flush(self):
+        """
+        Emits the queued messages and stops the logging thread.
+        """
+        if not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join(AsyncLogger.FLUSH_TIMEOUT)
+
+
+logger = AsyncLogger()
+
+
+def log(msg: str, meta: Meta = None, level: int = logging.INFO):
+    """
+    Logs a message with metadata, which may be given as a function to defer
+    building it until the message is emitted. Metadata is emitted as it is at
+    that time, so it shouldn't be mutated after it is logged.
+    """
+    logger.log(level, msg, meta)
 
 
-log_thread = threading.Thread(target=process_log_queue, daemon=True)
-log_thread.start()
+def debug(msg: str, meta: Meta = None):
+    """
+    Logs a per-item message, e.g. once per archive member. These are only
+    emitted at the DEBUG level, and are sampled and dropped under load.
+    """
+    logger.log(logging.DEBUG, msg, meta, per_item=True)
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import typing
+import zipfile
+
+from log import log
+
+
+class TransformManifest:
+    """
+    Persistent record of the source files that have been transformed and the
+    Parquet files each of them produced. Lets a transform run skip sources whose
+    fingerprint (size, mtime, content hash) is unchanged since the last run.
+    """
+
+    FILE_NAME = "transform_manifest.json"
+    VERSION = 1
+    HASH_CHUNK_SIZE = 1 << 20
+
+    def __init__(self, path: str):
+        self.path = path
+        self.sources: dict[str, dict] = {}
+        # the writer settings the recorded outputs were written with
+        self.settings: dict = {}
+
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                manifest = json.load(f)
+            if manifest.get("version") == TransformManifest.VERSION:
+                self.sources = manifest["sources"]
+                self.settings = manifest.get("settings", {})
+            else:
+                log("Ignoring manifest with unknown version", {"path": path})
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def fingerprint(self, source: str, file_path: str) -> dict:
+        """
+        Fingerprints a file on disk. The content hash is only recomputed when the
+        size or mtime differ from the recorded entry.
+        """
+        stat = os.stat(file_path)
+        previous = self.sources.get(source)
+        if (
+            previous
+            and previous["size"] == stat.st_size
+            and previous["mtime"] == stat.st_mtime
+        ):
+            content_hash = previous["hash"]
+        else:
+            content_hash = hash_file(file_path)
+
+        return {"size": stat.st_size, "mtime": stat.st_mtime, "hash": content_hash}
+
+    def is_current(self, source: str, fingerprint: dict) -> bool:
+        previous = self.sources.get(source)
+        return bool(
+            previous
+            and previous["size"] == fingerprint["size"]
+            and previous["hash"] == fingerprint["hash"]
+        )
+
+    def outputs(self, source: str) -> typing.List[str]:
+        return self.sources.get(source, {}).get("outputs", [])
+
+    def quarantined(self, source: str) -> typing.List[str]:
+        return self.sources.get(source, {}).get("quarantined", [])
+
+    def record(
+        self,
+        source: str,
+        fingerprint: dict,
+        outputs: typing.List[str],
+        quarantined: typing.Optional[typing.List[str]] = None,
+    ):
+        self.sources[source] = {
+            **fingerprint,
+            "outputs": outputs,
+            "quarantined": quarantined or [],
+        }
+
+    def remove(self, source: str):
+        self.sources.pop(source, None)
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "version": TransformManifest.VERSION,
+                    "settings": self.settings,
+                    "sources": self.sources,
+                },
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+        os.replace(tmp_path, self.path)
+
+
+def hash_file(file_path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(TransformManifest.HASH_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def member_fingerprint(zipinfo: zipfile.ZipInfo) -> dict:
+    """
+    Fingerprints an archive member from its central directory entry, using the
+    CRC-32 recorded in the archive as the content hash.
+    """
+    return {
+        "size": zipinfo.file_size,
+        "mtime": "{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}".format(*zipinfo.date_time),
+        "hash": f"crc32:{zipinfo.CRC:08x}",
+    }
@@ -0,0 +1,209 @@
+import json
+import os
+import threading
+import time
+import typing
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from archive_extractor import ArchiveExtractor
+from archive_transformer import ArchiveTransformer
+from instrumentation import report
+from log import log
+from uploader import Uploader
+
+
+class PipelineOrchestrator:
+    """
+    Runs each archive through download, transform and upload as a unit of
+    work, overlapping the stages of consecutive units: while one archive is
+    transformed, the next ones download and the previous ones upload. Members
+    are streamed straight out of their archive, which fuses extracting,
+    transforming and writing into the transform stage.
+
+    The stage each unit has completed is checkpointed, so a killed run
+    resumes with the units and stages it hadn't finished.
+    """
+
+    STATE_FILE = "pipeline_state.json"
+    STAGES = ["downloaded", "transformed", "uploaded"]
+    # archives downloaded ahead of the one being transformed
+    PREFETCH = 2
+    UPLOAD_WORKERS = 2
+
+    def __init__(
+        self,
+        transformer: ArchiveTransformer,
+        extractor: typing.Optional[ArchiveExtractor] = None,
+        uploader: typing.Optional[Uploader] = None,
+        prefetch: int = PREFETCH,
+    ):
+        if not transformer.streaming:
+            raise ValueError("Orchestrated runs stream members out of archives")
+
+        self.transformer = transformer
+        self.extractor = extractor
+        self.uploader = uploader
+        self.prefetch = prefetch
+        self.archive_dir = transformer.archive_dir
+
+        self.state_path = os.path.join(
+            transformer.out_dir, PipelineOrchestrator.STATE_FILE
+        )
+        self.state_lock = threading.Lock()
+        self.state: dict[str, dict] = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r") as f:
+                self.state = json.load(f)
+
+    def run(self):
+        units = self.list_units()
+        log("Running archives", {"archives": [unit["Key"] for unit in units]})
+        if self.uploader:
+            self.uploader.ensure_bucket()
+
+        start_time = time.perf_counter()
+        failed: typing.List[str] = []
+        transformed = 0
+        sources: typing.Set[str] = set()
+        with ThreadPoolExecutor(
+            max_workers=self.prefetch
+        ) as downloads, ThreadPoolExecutor(
+            max_workers=PipelineOrchestrator.UPLOAD_WORKERS
+        ) as uploads:
+            downloading: dict[int, Future] = {}
+            uploading: dict[str, Future] = {}
+            for i, unit in enumerate(units):
+                for ahead in range(i, min(i + self.prefetch + 1, len(units))):
+                    if ahead not in downloading:
+                        downloading[ahead] = downloads.submit(
+                            self.download, units[ahead]
+                        )
+
+                key = unit["Key"]
+                try:
+                    downloading.pop(i).result()
+                    if not self.is_done(unit, "transformed"):
+                        self.transform(unit)
+                        transformed += 1
+                    sources.update(self.state[key]["sources"])
+                except Exception as e:
+                    log("Failed to run archive", {"archive": key, "exception": e})
+                    failed.append(key)
+                    continue
+
+                if self.uploader and not self.is_done(unit, "uploaded"):
+                    uploading[key] = uploads.submit(
+                        self.upload, unit, self.get_outputs(unit)
+                    )
+
+            for key, future in uploading.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    log("Failed to upload archive", {"archive": key, "exception": e})
+                    failed.append(key)
+
+        # sources of failed archives are unknown, so nothing can be pruned
+        if not failed:
+            self.transformer.prune_sources(sources)
+            self.transformer.manifest.save()
+        if self.transformer.deduplicate() and self.uploader:
+            # deduplication rewrites outputs of any archive in the touched
+            # partitions; unchanged files are skipped by the uploader
+            self.uploader.upload_files(self.transformer.get_touched_outputs())
+        if self.uploader and not failed:
+            # outputs of pruned or changed sources were removed locally
+            self.uploader.delete_stale()
+        self.transformer.reweight_samples()
+        self.transformer.log_cache_stats()
+
+        log(
+            "Ran archives",
+            {
+                "archives": len(units),
+                "transformed": transformed,
+                "failed": failed,
+                "elapsed": time.perf_counter() - start_time,
+            },
+        )
+        if failed:
+            raise RuntimeError(f"Failed to run archives: {failed}")
+
+    def list_units(self) -> typing.List[dict]:
+        """
+        Lists the archives in the bucket, or without an extractor those
+        already downloaded.
+        """
+        if self.extractor:
+            return [
+                obj
+                for obj in self.extractor.list_objects()
+                if obj["Key"].endswith(".zip")
+            ]
+
+        units = []
+        for file in sorted(os.listdir(self.archive_dir)):
+            if file.endswith(".zip"):
+                stat = os.stat(os.path.join(self.archive_dir, file))
+                units.append({"Key": file, "ETag": f"{stat.st_size}-{stat.st_mtime}"})
+        return units
+
+    def is_done(self, unit: dict, stage: str) -> bool:
+        """
+        Whether a unit has completed a stage for its current version. Units are
+        only done transforming while the manifest still holds their sources,
+        which a full refresh or a change of output settings clears.
+        """
+        with self.state_lock:
+            unit_state = self.state.get(unit["Key"])
+        if not unit_state or unit_state["etag"] != unit["ETag"]:
+            return False
+        if PipelineOrchestrator.STAGES.index(
+            unit_state["stage"]
+        ) < PipelineOrchestrator.STAGES.index(stage):
+            return False
+        return stage == "downloaded" or all(
+            source in self.transformer.manifest.sources
+            for source in unit_state["sources"]
+        )
+
+    def download(self, unit: dict):
+        if self.is_done(unit, "transformed") or not self.extractor:
+            return
+        with report.stage("download"):
+            self.extractor.download_zip(unit)
+        self.checkpoint(unit, "downloaded")
+
+    def transform(self, unit: dict):
+        sources = self.transformer.stream_archive(
+            os.path.join(self.archive_dir, unit["Key"])
+        )
+        self.checkpoint(unit, "transformed", sources=sorted(sources))
+
+    def get_outputs(self, unit: dict) -> typing.List[str]:
+        with self.state_lock:
+            sources = self.state[unit["Key"]]["sources"]
+        return sorted(
+            output
+            for source in sources
+            for output in self.transformer.manifest.outputs(source)
+        )
+
+    def upload(self, unit: dict, outputs: typing.List[str]):
+        self.uploader.upload_files(outputs)
+        self.checkpoint(unit, "uploaded")
+
+    def checkpoint(self, unit: dict, stage: str, **unit_state):
+        with self.state_lock:
+            previous = self.state.get(unit["Key"], {})
+            self.state[unit["Key"]] = {
+                "sources": previous.get("sources", []),
+                **unit_state,
+                "etag": unit["ETag"],
+                "stage": stage,
+            }
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.state, f)
+            os.replace(tmp_path, self.state_path)
+        log("Checkpointed archive", {"archive": unit["Key"], "stage": stage})
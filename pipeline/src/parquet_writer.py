@@ -0,0 +1,279 @@
+import os
+import typing
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from rollup import DIRECTIONS, RollupWriter, combine, rollup
+from sampling import SampleWriter
+from schemas import normalized_schema, output_schemas
+from log import log
+from station_resolver import StationIndex
+from validation import QuarantineWriter, count_reasons, validate
+
+# trips as produced by either of the CSV transformers
+TripData = typing.Union[pd.DataFrame, pa.Table]
+
+
+def cast_column(column: pa.ChunkedArray, to: pa.DataType) -> pa.ChunkedArray:
+    if pa.types.is_dictionary(to):
+        return pc.dictionary_encode(column)
+    if pa.types.is_decimal(to):
+        # values that can't be represented at the decimal's precision are nulled
+        # rather than failing the whole write
+        rounded = pc.round(column, to.scale)
+        in_range = pc.less(pc.abs(rounded), 10 ** (to.precision - to.scale))
+        return pc.if_else(in_range, rounded, pa.scalar(None, rounded.type)).cast(to)
+    return column.cast(to)
+
+
+# the year and month of trips without a start time, which hive partitioning
+# (e.g. pyarrow's) reads back as null
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+
+def partition_dir(
+    system: str, year: typing.Optional[int], month: typing.Optional[int]
+) -> str:
+    if year is None or month is None:
+        return os.path.join(
+            f"system={system}", f"year={NULL_PARTITION}", f"month={NULL_PARTITION}"
+        )
+    return os.path.join(f"system={system}", f"year={year:04d}", f"month={month:02d}")
+
+
+class PartitionedParquetWriter:
+    """
+    Writes normalized trips to a hive-style dataset partitioned by system and the
+    year/month of `started_at`, with rows sorted by `started_at` so that readers
+    can prune both files and row groups.
+    """
+
+    ROW_GROUP_SIZE = 1_000_000
+
+    def __init__(
+        self,
+        out_dir: str,
+        profile: str = "normalized",
+        compression: str = "snappy",
+        compression_level: typing.Optional[int] = None,
+        row_group_size: int = ROW_GROUP_SIZE,
+        stations: typing.Optional[StationIndex] = None,
+        rollups: typing.Optional[RollupWriter] = None,
+        quarantine: typing.Optional[QuarantineWriter] = None,
+        samples: typing.Optional[SampleWriter] = None,
+    ):
+        self.out_dir = out_dir
+        self.profile = profile
+        self.compression = compression
+        self.compression_level = compression_level
+        self.row_group_size = row_group_size
+        self.stations = stations
+        self.rollups = rollups
+        self.quarantine = quarantine
+        self.samples = samples
+        self.schema = pa.schema(normalized_schema)
+        self.output_schema = pa.schema(output_schemas[profile])
+
+    def settings(self) -> dict:
+        """
+        The settings that determine the content of the written files.
+        """
+        return {
+            "profile": self.profile,
+            "compression": self.compression,
+            "compression_level": self.compression_level,
+            "row_group_size": self.row_group_size,
+            "stations": self.stations.fingerprint if self.stations else None,
+            "rollups": self.rollups.VERSION if self.rollups else False,
+            "validate": self.quarantine is not None,
+            "samples": self.samples.rates if self.samples else [],
+        }
+
+    def write(self, data: TripData, system: str, name: str) -> typing.List[str]:
+        """
+        Writes trips as one file per partition they span, and rows that fail
+        validation to quarantine. Returns the paths of the written files
+        relative to the output directory, or for quarantined rows relative to
+        the quarantine directory's parent.
+        """
+        outputs = []
+        table, rejected = self.to_table(data, system, name)
+        if rejected.num_rows:
+            output = self.quarantine.output(system, name)
+            with self.quarantine.open_file(output) as writer:
+                writer.write_table(rejected)
+            outputs.append(output)
+
+        for output, table in self.split(table, system, name):
+            self.write_table(table, output)
+            if self.rollups:
+                self.rollups.write(
+                    output,
+                    {direction: rollup(table, direction) for direction in DIRECTIONS},
+                )
+            if self.samples:
+                self.samples.write(output, table)
+            outputs.append(output)
+
+        return outputs
+
+    def output_stats(self, outputs: typing.List[str]) -> typing.Tuple[int, int]:
+        """
+        Returns the total bytes and rows of written outputs, read from the
+        Parquet footers.
+        """
+        paths = [os.path.join(self.out_dir, output) for output in outputs]
+        return (
+            sum(os.path.getsize(path) for path in paths),
+            sum(pq.read_metadata(path).num_rows for path in paths),
+        )
+
+    def open_stream(self, system: str, name: str) -> "PartitionedParquetStream":
+        return PartitionedParquetStream(self, system, name)
+
+    def to_table(
+        self, data: TripData, system: str, name: str
+    ) -> typing.Tuple[pa.Table, pa.Table]:
+        """
+        Converts trips to a table of the normalized schema and, when a
+        quarantine is set, separates the rows that fail validation.
+        """
+        if isinstance(data, pa.Table):
+            table = data.select(self.schema.names).cast(self.schema)
+        else:
+            table = pa.Table.from_pandas(data, schema=self.schema, preserve_index=False)
+
+        if not self.quarantine:
+            return table, table.schema.empty_table()
+
+        table, rejected = validate(table)
+        if rejected.num_rows:
+            log(
+                "Quarantined rows",
+                {"system": system, "name": name, "reasons": count_reasons(rejected)},
+            )
+        return table, rejected
+
+    def split(
+        self, table: pa.Table, system: str, name: str
+    ) -> typing.Iterator[typing.Tuple[str, pa.Table]]:
+        if self.stations:
+            table = self.stations.resolve(table)
+        else:
+            for column in ("start_current_station_id", "end_current_station_id"):
+                table = table.append_column(
+                    column, pa.nulls(table.num_rows, pa.string())
+                )
+
+        if self.output_schema != table.schema:
+            table = pa.Table.from_arrays(
+                [
+                    cast_column(table.column(field.name), field.type)
+                    for field in self.output_schema
+                ],
+                schema=self.output_schema,
+            )
+
+        started_at = table.column("started_at")
+        keys = pc.add(pc.multiply(pc.year(started_at), 100), pc.month(started_at))
+        for key in sorted(pc.unique(keys).drop_null().to_pylist()):
+            year, month = divmod(key, 100)
+            output = os.path.join(partition_dir(system, year, month), f"{name}.parquet")
+            yield output, table.filter(pc.equal(keys, key)).sort_by("started_at")
+
+        # trips without a start time can't be placed in a month, but are kept
+        # in a partition of their own rather than dropped
+        missing = pc.is_null(keys)
+        null_rows = pc.sum(missing).as_py() or 0
+        if null_rows:
+            log(
+                "Writing trips without a start time to the null partition",
+                {"system": system, "name": name, "rows": null_rows},
+            )
+            output = os.path.join(partition_dir(system, None, None), f"{name}.parquet")
+            yield output, table.filter(missing)
+
+    def open_file(self, output: str) -> pq.ParquetWriter:
+        path = os.path.join(self.out_dir, output)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return pq.ParquetWriter(
+            path,
+            self.output_schema,
+            compression=self.compression,
+            compression_level=self.compression_level,
+            store_decimal_as_integer=True,
+        )
+
+    def write_table(self, table: pa.Table, output: str):
+        with self.open_file(output) as writer:
+            writer.write_table(table, row_group_size=self.row_group_size)
+
+
+class PartitionedParquetStream:
+    """
+    Incrementally writes chunks of a single source, appending each chunk as row
+    groups to the files of the partitions it spans.
+    """
+
+    def __init__(self, writer: PartitionedParquetWriter, system: str, name: str):
+        self.writer = writer
+        self.system = system
+        self.name = name
+        self.files: dict[str, pq.ParquetWriter] = {}
+        self.quarantine_file: typing.Optional[pq.ParquetWriter] = None
+        # sample files of each output, by rate
+        self.sample_files: dict[str, dict[float, pq.ParquetWriter]] = {}
+        # partial rollups of each file's chunks, by direction
+        self.rollups: dict[str, dict[str, typing.List[pa.Table]]] = {}
+
+    def write(self, data: TripData):
+        table, rejected = self.writer.to_table(data, self.system, self.name)
+        if rejected.num_rows:
+            if self.quarantine_file is None:
+                self.quarantine_file = self.writer.quarantine.open_file(
+                    self.writer.quarantine.output(self.system, self.name)
+                )
+            self.quarantine_file.write_table(rejected)
+
+        for output, table in self.writer.split(table, self.system, self.name):
+            if output not in self.files:
+                self.files[output] = self.writer.open_file(output)
+                self.rollups[output] = {direction: [] for direction in DIRECTIONS}
+            self.files[output].write_table(
+                table, row_group_size=self.writer.row_group_size
+            )
+            if self.writer.rollups:
+                for direction, partials in self.rollups[output].items():
+                    partials.append(rollup(table, direction))
+            if self.writer.samples:
+                samples = self.writer.samples.sample(table)
+                if output not in self.sample_files:
+                    self.sample_files[output] = self.writer.samples.open_files(
+                        output, samples[self.writer.samples.rates[0]].schema
+                    )
+                for rate, sample in samples.items():
+                    self.sample_files[output][rate].write_table(sample)
+
+    def close(self) -> typing.List[str]:
+        for file in self.files.values():
+            file.close()
+        for files in self.sample_files.values():
+            for file in files.values():
+                file.close()
+        outputs = list(self.files)
+        if self.quarantine_file is not None:
+            self.quarantine_file.close()
+            outputs.append(self.writer.quarantine.output(self.system, self.name))
+        if self.writer.rollups:
+            for output, partials in self.rollups.items():
+                self.writer.rollups.write(
+                    output,
+                    {
+                        direction: combine(tables)
+                        for direction, tables in partials.items()
+                    },
+                )
+        return outputs
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import threading
+import typing
+
+import pyarrow as pa
+
+from log import debug, log
+
+# counters of the cache in this process. Tasks run on Dask workers, so the
+# counters of a run are collected from each worker with get_cache_stats
+stats_lock = threading.Lock()
+cache_stats = {
+    "hits": 0,
+    "misses": 0,
+    "bytes_read": 0,
+    "bytes_written": 0,
+    "evictions": 0,
+    "bytes_evicted": 0,
+}
+
+
+def count(**metrics):
+    with stats_lock:
+        for metric, value in metrics.items():
+            cache_stats[metric] += value
+
+
+def get_cache_stats() -> dict:
+    with stats_lock:
+        return dict(cache_stats)
+
+
+def reset_cache_stats():
+    with stats_lock:
+        for metric in cache_stats:
+            cache_stats[metric] = 0
+
+
+class ParseCache:
+    """
+    Caches the parsed, typed columns of each CSV as an Arrow IPC stream, one
+    record batch per chunk with the chunk's schema metadata, so that reruns
+    after a change to the transform logic skip CSV parsing. Entries are keyed by the fingerprint of the CSV and
+    the engine, header version and parser version it was parsed with, and are
+    read back zero-copy from a memory map.
+
+    Entries are written under a temporary name and renamed into place, so
+    concurrent tasks never read a partial entry. Once the cache holds more than
+    `max_bytes`, the least recently used entries are evicted.
+    """
+
+    DIR = "parse-cache"
+    MAX_BYTES = 20 * 2**30
+    SUFFIX = ".arrow"
+
+    def __init__(self, cache_dir: str, max_bytes: int = MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def key(
+        self, fingerprint: dict, engine: str, header_version: str, parser_version: int
+    ) -> str:
+        # the mtime is left out, as re-extracting a file doesn't change its parse
+        parts = {
+            "size": fingerprint["size"],
+            "hash": fingerprint["hash"],
+            "engine": engine,
+            "header_version": header_version,
+            "parser_version": parser_version,
+        }
+        return hashlib.sha256(
+            json.dumps(parts, sort_keys=True).encode("utf-8")
+        ).hexdigest()[:32]
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}{ParseCache.SUFFIX}")
+
+    def read(self, key: str) -> typing.Optional[typing.Iterator[pa.Table]]:
+        """
+        Returns the chunks of a cached parse, or None on a miss.
+        """
+        path = self.path(key)
+        try:
+            source = pa.memory_map(path)
+        except FileNotFoundError:
+            count(misses=1)
+            return None
+
+        try:
+            reader = pa.ipc.open_stream(source)
+        except pa.ArrowInvalid as e:
+            source.close()
+            log(
+                "Discarding unreadable parse cache entry",
+                {"path": path, "exception": e},
+            )
+            self.remove(path)
+            count(misses=1)
+            return None
+
+        # entries are evicted by mtime, so reading one marks it as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        count(hits=1, bytes_read=source.size())
+        debug("Reading parse cache entry", {"key": key})
+        return self.read_chunks(source, reader)
+
+    def read_chunks(
+        self, source: pa.MemoryMappedFile, reader: pa.ipc.RecordBatchStreamReader
+    ) -> typing.Iterator[pa.Table]:
+        with source:
+            while True:
+                try:
+                    batch, metadata = reader.read_next_batch_with_custom_metadata()
+                except StopIteration:
+                    return
+                table = pa.Table.from_batches([batch])
+                if metadata is not None:
+                    table = table.replace_schema_metadata(metadata)
+                yield table
+
+    def write(
+        self, key: str, chunks: typing.Iterator[pa.Table]
+    ) -> typing.Iterator[pa.Table]:
+        """
+        Passes chunks through while caching them. The entry is only added once
+        every chunk has been consumed.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        writer: typing.Optional[pa.ipc.RecordBatchStreamWriter] = None
+        schema: typing.Optional[pa.Schema] = None
+        try:
+            for chunk in chunks:
+                if schema is None:
+                    schema = chunk.schema
+                    writer = pa.ipc.new_stream(tmp_path, schema)
+                elif writer is not None and not chunk.schema.equals(schema):
+                    # an entry holds a single schema, so a file whose chunks
+                    # were parsed to different types isn't cached
+                    log("Not caching parse with varying schema", {"key": key})
+                    writer.close()
+                    writer = None
+                    self.remove(tmp_path)
+                if writer is not None:
+                    # a chunk is written as a single batch that keeps the
+                    # chunk's schema metadata, e.g. its count of unparseable
+                    # rows
+                    for batch in chunk.combine_chunks().to_batches():
+                        writer.write_batch(batch, custom_metadata=chunk.schema.metadata)
+                yield chunk
+
+            if writer is not None:
+                writer.close()
+                writer = None
+                os.replace(tmp_path, path)
+                count(bytes_written=os.path.getsize(path))
+                self.evict()
+        finally:
+            if writer is not None:
+                writer.close()
+                self.remove(tmp_path)
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in
+        `max_bytes`.
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(ParseCache.SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            # open memory maps of an evicted entry stay readable
+            if self.remove(path):
+                count(evictions=1, bytes_evicted=size)
+            total_bytes -= size
+
+    def size(self) -> typing.Tuple[int, int]:
+        """
+        Returns the number of entries in the cache and their total size.
+        """
+        if not os.path.isdir(self.cache_dir):
+            return 0, 0
+        sizes = [
+            entry.stat().st_size
+            for entry in os.scandir(self.cache_dir)
+            if entry.name.endswith(ParseCache.SUFFIX)
+        ]
+        return len(sizes), sum(sizes)
+
+    @staticmethod
+    def remove(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
@@ -1,8 +1,21 @@
 import argparse
 import os
+import sys
+import typing
 
+import pyarrow.csv as csv
+
+from archive_streamer import TRANSFORMERS, ArchiveStreamer
 from archive_transformer import ArchiveTransformer
+from parquet_writer import PartitionedParquetWriter
+from parse_cache import ParseCache
+from schemas import output_schemas
+from station_resolver import STATION_INFORMATION_URL, StationIndex, fetch_stations
 from archive_extractor import ArchiveExtractor
+from clickhouse_loader import ClickHouseLoader
+from flux_query import FluxQuery
+from instrumentation import report
+from orchestrator import PipelineOrchestrator
 from uploader import Uploader
 
 
@@ -28,22 +41,255 @@ def parse_args():
         action="store_true",
         help="Upload data to S3",
     )
+    parser.add_argument(
+        "-o",
+        "--orchestrate",
+        action="store_true",
+        help="Run the selected stages archive by archive, overlapping the "
+        "download, transform and upload of consecutive archives and resuming "
+        "from the last checkpointed stage of each (implies --streaming)",
+    )
+    parser.add_argument(
+        "-l",
+        "--load",
+        action="store_true",
+        help="Load the transformed trips into ClickHouse over HTTP",
+    )
+    parser.add_argument(
+        "--full_refresh",
+        action="store_true",
+        help="Discard previous transform output and transform every file",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Transform CSVs straight out of the archives without extracting them",
+    )
+    parser.add_argument(
+        "--chunk_rows",
+        type=int,
+        default=ArchiveStreamer.CHUNK_ROWS,
+        help="Rows per chunk read in streaming mode",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=list(TRANSFORMERS),
+        default="dask",
+        help="CSV parsing engine",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=list(output_schemas),
+        default="normalized",
+        help="Output schema; optimized uses dictionary encoding and narrower types",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=["snappy", "zstd", "gzip", "brotli", "lz4", "none"],
+        default="snappy",
+        help="Parquet compression codec",
+    )
+    parser.add_argument(
+        "--compression_level",
+        type=int,
+        help="Parquet compression level, for codecs that support one",
+    )
+    parser.add_argument(
+        "--row_group_size",
+        type=int,
+        default=PartitionedParquetWriter.ROW_GROUP_SIZE,
+        help="Maximum rows per Parquet row group",
+    )
+    parser.add_argument(
+        "--stations",
+        default=STATION_INFORMATION_URL,
+        help="GBFS station_information URL or file that trips are resolved against. "
+        "If the URL can't be fetched and there's no snapshot, trips are left "
+        "unresolved",
+    )
+    parser.add_argument(
+        "--refresh_stations",
+        action="store_true",
+        help="Refetch station information, re-resolving every file",
+    )
+    parser.add_argument(
+        "--rollups",
+        action="store_true",
+        help="Also write inbound/outbound station flux rollups to <out_dir>/rollups",
+    )
+    parser.add_argument(
+        "--samples",
+        type=lambda rates: [float(rate) for rate in rates.split(",")],
+        help="Comma-separated rates, e.g. 0.01,0.1, to also write deterministic "
+        "samples of trips at, stratified by start station and month and weighted, "
+        "to <out_dir>/samples/rate=<rate>",
+    )
+    parser.add_argument(
+        "--parse_cache",
+        action="store_true",
+        help="Cache the parsed columns of each CSV as Arrow IPC files in "
+        "<out_dir>/parse-cache, so that reruns skip parsing unchanged CSVs",
+    )
+    parser.add_argument(
+        "--parse_cache_gb",
+        type=float,
+        default=ParseCache.MAX_BYTES / 2**30,
+        help="Size of the parse cache, beyond which the least recently used "
+        "parses are evicted",
+    )
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="Check trips against data-quality rules and write rejected rows to "
+        "<out_dir>/quarantine with a reason code",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Drop trips that appear in more than one source, e.g. in both a "
+        "chunked and a full CSV",
+    )
+    parser.add_argument(
+        "--auto_tune",
+        action="store_true",
+        help="Size Dask workers, CSV blocks and memory thresholds from the input "
+        "and the available cores and memory, instead of DASK_N_WORKERS and "
+        "DASK_MEMORY_PER_WORKER",
+    )
+    parser.add_argument(
+        "--scheduler",
+        default=os.environ.get("DASK_SCHEDULER_ADDRESS"),
+        help="Address of an existing Dask scheduler to run the transform on; the "
+        "scheduler and its workers must be able to import the pipeline modules and see "
+        "the same output directory (default: "
+        "DASK_SCHEDULER_ADDRESS, else a local cluster)",
+    )
+    parser.add_argument(
+        "--clickhouse_url",
+        default=os.environ.get("CLICKHOUSE_URL", ClickHouseLoader.URL),
+        help="HTTP interface to load trips into, authenticated as CLICKHOUSE_USER "
+        "with CLICKHOUSE_PASSWORD (default: CLICKHOUSE_URL, else %(default)s)",
+    )
+    parser.add_argument(
+        "--load_table", default="raw_trips", help="Table to (re)load trips into"
+    )
+    parser.add_argument(
+        "--load_batch_rows",
+        type=int,
+        default=ClickHouseLoader.BATCH_ROWS,
+        help="Rows per insert",
+    )
+    parser.add_argument(
+        "--load_connections",
+        type=int,
+        default=ClickHouseLoader.CONNECTIONS,
+        help="Inserts to run in parallel",
+    )
     parser.add_argument("--out_dir", help="Output directory", default="./data")
+
+    subparsers = parser.add_subparsers(dest="command")
+    query_parser = subparsers.add_parser(
+        "query",
+        help="Count the inbound and outbound trips of each station in the transform "
+        "output, with the filters of the map's flux query",
+    )
+    query_parser.add_argument(
+        "--start_date", required=True, help="First day of trips, as YYYYMMDD"
+    )
+    query_parser.add_argument(
+        "--end_date", required=True, help="Last day of trips, as YYYYMMDD"
+    )
+    query_parser.add_argument("--start_time", help="Start of time of day, as HHMMSS")
+    query_parser.add_argument("--end_time", help="End of time of day, as HHMMSS")
+    query_parser.add_argument(
+        "--days_of_week",
+        type=lambda days: [int(day) for day in days.split(",")],
+        help="Comma-separated days of week, 0 being Monday",
+    )
+    query_parser.add_argument(
+        "--threads", type=int, help="Files to scan in parallel (default: cores)"
+    )
+    query_parser.add_argument(
+        "--output", help="CSV file to write counts to (default: stdout)"
+    )
+    query_parser.add_argument(
+        "--out_dir", help="Output directory", default=argparse.SUPPRESS
+    )
     return parser.parse_args()
 
 
+def get_uploader(out_dir: str) -> Uploader:
+    bucket_name = os.environ.get("BUCKET_NAME")
+    if not bucket_name:
+        raise ValueError("BUCKET_NAME environment variable is not set")
+    return Uploader(os.path.join(out_dir, "parquet"), bucket_name)
+
+
 if __name__ == "__main__":
     args = parse_args()
-    if args.extract:
-        downloader = ArchiveExtractor(args.out_dir)
-        downloader.extract()
-    if args.transform:
-        transformer = ArchiveTransformer(args.out_dir)
-        transformer.transform_archives()
-    if args.upload:
-        pq_dir = os.path.join(args.out_dir, "parquet")
-        bucket_name = os.environ.get("BUCKET_NAME")
-        if not bucket_name:
-            raise ValueError("BUCKET_NAME environment variable is not set")
-        uploader = Uploader(pq_dir, args.bucket_name)
-        uploader.upload()
+    transformer: typing.Optional[ArchiveTransformer] = None
+    try:
+        if args.command == "query":
+            flux = FluxQuery(
+                args.out_dir,
+                args.start_date,
+                args.end_date,
+                start_time=args.start_time,
+                end_time=args.end_time,
+                days_of_week=args.days_of_week,
+                threads=args.threads,
+            ).run()
+            csv.write_csv(flux, args.output or sys.stdout.buffer)
+        if args.extract and not args.orchestrate:
+            downloader = ArchiveExtractor(args.out_dir)
+            downloader.extract()
+        if args.transform or args.orchestrate:
+            stations = fetch_stations(
+                args.stations, args.out_dir, args.refresh_stations
+            )
+            transformer = ArchiveTransformer(
+                args.out_dir,
+                full_refresh=args.full_refresh,
+                streaming=args.streaming or args.orchestrate,
+                chunk_rows=args.chunk_rows,
+                engine=args.engine,
+                profile=args.profile,
+                compression=args.compression,
+                compression_level=args.compression_level,
+                row_group_size=args.row_group_size,
+                stations=StationIndex.from_file(stations) if stations else None,
+                rollups=args.rollups,
+                samples=args.samples,
+                parse_cache=args.parse_cache,
+                parse_cache_bytes=int(args.parse_cache_gb * 2**30),
+                validate=args.validate,
+                dedup=args.dedup,
+                auto_tune=args.auto_tune,
+                scheduler=args.scheduler,
+            )
+        if args.orchestrate:
+            PipelineOrchestrator(
+                transformer,
+                ArchiveExtractor(args.out_dir) if args.extract else None,
+                get_uploader(args.out_dir) if args.upload else None,
+            ).run()
+        elif args.transform:
+            transformer.transform_archives()
+        if args.load:
+            loader = ClickHouseLoader(
+                args.out_dir,
+                args.clickhouse_url,
+                table=args.load_table,
+                batch_rows=args.load_batch_rows,
+                connections=args.load_connections,
+                user=os.environ.get("CLICKHOUSE_USER"),
+                password=os.environ.get("CLICKHOUSE_PASSWORD"),
+            )
+            loader.load()
+        if args.upload and not args.orchestrate:
+            get_uploader(args.out_dir).upload()
+    finally:
+        if transformer:
+            # shuts down the local cluster the client started
+            transformer.close()
+        report.save(args.out_dir)
@@ -0,0 +1,186 @@
+import argparse
+import itertools
+import json
+import os
+import shutil
+import time
+import typing
+
+from archive_transformer import ArchiveTransformer
+from header_classifier import HeaderClassifier
+from instrumentation import report
+from log import log
+from schemas import output_schemas
+from station_resolver import STATIONS_FILE, StationIndex
+from synthetic_data import DEFAULT_SPECS, ArchiveSpec, SyntheticTripGenerator
+
+
+def stage_summary(stage: dict) -> dict:
+    summary = {
+        "elapsed": stage["elapsed"],
+        "peak_rss": stage["peak_rss"],
+        "files": len(stage["files"]),
+    }
+    for metric in ("bytes_in", "bytes_out", "rows"):
+        total = sum(metrics.get(metric, 0) for metrics in stage["files"].values())
+        if total:
+            summary[metric] = total
+
+    elapsed = stage["elapsed"]
+    if elapsed:
+        if "rows" in summary:
+            summary["rows_per_second"] = summary["rows"] / elapsed
+        if "bytes_in" in summary or "bytes_out" in summary:
+            summary["mb_per_second"] = (
+                summary.get("bytes_in", summary.get("bytes_out")) / 1e6 / elapsed
+            )
+    if "dask" in stage:
+        summary["dask"] = stage["dask"]
+    return summary
+
+
+class PipelineBenchmark:
+    """
+    Runs the extract, header detection, transform and write stages over
+    synthetic archives for each combination of settings, recording the time,
+    throughput and peak memory of each stage.
+    """
+
+    RESULTS_FILE = "benchmark-results.json"
+
+    def __init__(self, out_dir: str, repeat: int = 1):
+        self.out_dir = out_dir
+        self.repeat = repeat
+        self.stations = StationIndex.from_file(os.path.join(out_dir, STATIONS_FILE))
+
+    def run(
+        self,
+        expected_rows: int,
+        engines: typing.List[str],
+        modes: typing.List[str],
+        profiles: typing.List[str],
+        compressions: typing.List[str],
+    ) -> typing.List[dict]:
+        results = []
+        for engine, mode, profile, compression in itertools.product(
+            engines, modes, profiles, compressions
+        ):
+            for i in range(self.repeat):
+                result = self.run_once(engine, mode, profile, compression)
+                result["repetition"] = i
+                result["expected_rows"] = expected_rows
+                if result["rows"] != expected_rows:
+                    log(
+                        "Benchmark run wrote an unexpected number of rows",
+                        {"rows": result["rows"], "expected_rows": expected_rows},
+                    )
+                results.append(result)
+
+        path = os.path.join(self.out_dir, PipelineBenchmark.RESULTS_FILE)
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+        log("Wrote benchmark results", {"path": path, "runs": len(results)})
+        return results
+
+    def run_once(self, engine: str, mode: str, profile: str, compression: str) -> dict:
+        # every run starts cold: nothing extracted, no cached header versions and
+        # (through full_refresh) no previous output
+        shutil.rmtree(os.path.join(self.out_dir, "extracted"), ignore_errors=True)
+        cache_path = os.path.join(self.out_dir, HeaderClassifier.CACHE_FILE)
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+        report.reset()
+        transformer = ArchiveTransformer(
+            self.out_dir,
+            full_refresh=True,
+            streaming=mode == "streaming",
+            engine=engine,
+            profile=profile,
+            compression=compression,
+            stations=self.stations,
+        )
+        try:
+            start_time = time.perf_counter()
+            transformer.transform_archives()
+            elapsed = time.perf_counter() - start_time
+        finally:
+            transformer.close()
+
+        stages = {name: stage_summary(stage) for name, stage in report.stages.items()}
+        result = {
+            "engine": engine,
+            "mode": mode,
+            "profile": profile,
+            "compression": compression,
+            "elapsed": elapsed,
+            "rows": stages.get("transform", {}).get("rows", 0),
+            "output_bytes": transformer.get_output_bytes(),
+            "stages": stages,
+        }
+        log(
+            "Benchmark run",
+            {
+                **{key: value for key, value in result.items() if key != "stages"},
+                "stage_elapsed": {
+                    name: stage["elapsed"] for name, stage in stages.items()
+                },
+                "peak_rss": max(stage["peak_rss"] for stage in stages.values()),
+            },
+        )
+        return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline on synthetic archives"
+    )
+    parser.add_argument(
+        "--out_dir", help="Output directory", default="./pipeline-benchmark"
+    )
+    parser.add_argument(
+        "--archive",
+        action="append",
+        type=ArchiveSpec.parse,
+        help="Archive to generate as LAYOUT:YEAR:VERSION; may be repeated "
+        "(default: every layout and header version)",
+    )
+    parser.add_argument("--rows_per_month", type=int, default=10_000)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--chunk_rows", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--engines", nargs="+", choices=["dask", "arrow"], default=["dask", "arrow"]
+    )
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=["extracted", "streaming"],
+        default=["extracted", "streaming"],
+    )
+    parser.add_argument(
+        "--profiles",
+        nargs="+",
+        choices=list(output_schemas),
+        default=["normalized"],
+    )
+    parser.add_argument("--compressions", nargs="+", default=["snappy"])
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Runs of each combination"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    expected_rows = SyntheticTripGenerator(
+        args.out_dir,
+        rows_per_month=args.rows_per_month,
+        months=args.months,
+        chunk_rows=args.chunk_rows,
+        seed=args.seed,
+    ).generate(args.archive or DEFAULT_SPECS)
+
+    PipelineBenchmark(args.out_dir, args.repeat).run(
+        expected_rows, args.engines, args.modes, args.profiles, args.compressions
+    )
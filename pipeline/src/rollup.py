@@ -0,0 +1,98 @@
+import os
+import typing
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# the station and time each direction of flux is counted by
+DIRECTIONS = {
+    "outbound": ("start_current_station_id", "started_at"),
+    "inbound": ("end_current_station_id", "ended_at"),
+}
+
+KEYS = ["station_id", "date", "hour", "day_of_week"]
+
+rollup_schema = pa.schema(
+    [
+        ("station_id", pa.string()),
+        ("date", pa.date32()),
+        ("hour", pa.int8()),
+        ("day_of_week", pa.int8()),
+        ("trips", pa.int64()),
+    ]
+)
+
+
+def rollup(table: pa.Table, direction: str) -> pa.Table:
+    """
+    Counts the trips of a table per station, date, hour of day and day of week
+    (0 is Monday, as in ClickHouse's toDayOfWeek(t, 1)). Trips without a
+    resolved station are left out, as the trips table leaves them out.
+    """
+    station, timestamp = DIRECTIONS[direction]
+    times = table.column(timestamp)
+    keys = pa.table(
+        {
+            "station_id": table.column(station).cast(pa.string()),
+            "date": times.cast(pa.date32()),
+            "hour": pc.hour(times).cast(pa.int8()),
+            "day_of_week": pc.day_of_week(
+                times, count_from_zero=True, week_start=1
+            ).cast(pa.int8()),
+        }
+    )
+    keys = keys.filter(
+        pc.and_(pc.is_valid(keys.column("station_id")), pc.is_valid(times))
+    )
+    counts = keys.group_by(KEYS).aggregate([([], "count_all")])
+    return counts.select(KEYS + ["count_all"]).rename_columns(rollup_schema.names)
+
+
+def combine(rollups: typing.List[pa.Table]) -> pa.Table:
+    """
+    Sums partial rollups, e.g. of the chunks of a streamed file.
+    """
+    if len(rollups) == 1:
+        return rollups[0]
+
+    counts = pa.concat_tables(rollups).group_by(KEYS).aggregate([("trips", "sum")])
+    return counts.select(KEYS + ["trips_sum"]).rename_columns(rollup_schema.names)
+
+
+class RollupWriter:
+    """
+    Writes the inbound and outbound rollups of each trip output to the same
+    relative path under rollups/<direction>/, so that the rollups of a file can
+    always be found, replaced and removed along with it.
+    """
+
+    # part of the writer settings, so that rollups of an older version are
+    # rewritten. 2 counts days of the week from 0
+    VERSION = 2
+
+    def __init__(self, out_dir: str, compression: str = "snappy"):
+        self.out_dir = out_dir
+        self.compression = compression
+
+    def paths(self, output: str) -> typing.List[str]:
+        return [
+            os.path.join(self.out_dir, direction, output) for direction in DIRECTIONS
+        ]
+
+    def write(self, output: str, rollups: dict[str, pa.Table]):
+        for direction, table in rollups.items():
+            path = os.path.join(self.out_dir, direction, output)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            pq.write_table(
+                table.sort_by([("date", "ascending"), ("station_id", "ascending")]),
+                path,
+                compression=self.compression,
+            )
+
+    def remove(self, output: str):
+        for path in self.paths(output):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,227 @@
+import os
+import typing
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from log import log
+
+# columns a trip's sampling hash is computed from, which identify a trip in
+# every era of the archives, unlike the ride id
+HASH_COLUMNS = ["started_at", "ended_at", "start_station_id", "end_station_id"]
+
+# pandas hashes with a 16-byte key
+HASH_KEY = "citibike-samples"
+
+
+def sample_hashes(table: pa.Table) -> np.ndarray:
+    df = table.select(HASH_COLUMNS).to_pandas()
+    for column in ("start_station_id", "end_station_id"):
+        df[column] = df[column].astype(object)
+    return pd.util.hash_pandas_object(df, index=False, hash_key=HASH_KEY).to_numpy()
+
+
+def format_rate(rate: float) -> str:
+    return f"rate={rate:g}"
+
+
+def threshold(rate: float) -> np.uint64:
+    """
+    The hash below which a trip is kept at a rate, as hashes are uniform over
+    the 64-bit range.
+    """
+    return np.uint64(min(int(rate * 2**64), 2**64 - 1))
+
+
+def strata(table: pa.Table) -> pd.Series:
+    """
+    The stratum of each trip within its output's partition, its start station.
+    """
+    return table.column("start_station_id").cast(pa.string()).to_pandas().fillna("")
+
+
+class SampleWriter:
+    """
+    Writes stratified samples of each trip output at a set of rates, to the same
+    relative path under samples/rate=<rate>/ so that each sample is a dataset
+    with the layout of the full output.
+
+    A trip is kept at a rate when its hash is below the rate's share of the
+    hash range, so the realized rate matches the requested one however the
+    input is split into files and chunks. Hashes only depend on the trip, so
+    samples are the same on every run and each is a subset of the samples at
+    higher rates.
+
+    Samples are stratified by start station and month: once a run has written
+    its outputs, reweight adds the trip with the lowest hash of each station
+    without a kept trip across the outputs of its partition, and gives each
+    kept trip the weight n / kept of its station, so that every stratum is
+    represented and weights sum to its trips. Until then, trips carry the
+    weight 1 / rate.
+    """
+
+    DIR = "samples"
+
+    def __init__(
+        self, out_dir: str, rates: typing.List[float], compression: str = "snappy"
+    ):
+        if not all(0 < rate < 1 for rate in rates):
+            raise ValueError(f"Sample rates must be between 0 and 1: {rates}")
+
+        self.out_dir = out_dir
+        self.rates = sorted(rates)
+        self.compression = compression
+
+    def path(self, rate: float, output: str) -> str:
+        return os.path.join(self.out_dir, format_rate(rate), output)
+
+    def paths(self, output: str) -> typing.List[str]:
+        return [self.path(rate, output) for rate in self.rates]
+
+    def sample(self, table: pa.Table) -> dict[float, pa.Table]:
+        """
+        Samples a table of trips at each rate, appending the weight column.
+        """
+        hashes = sample_hashes(table)
+        samples = {}
+        for rate in self.rates:
+            keep = hashes < threshold(rate)
+            samples[rate] = table.filter(pa.array(keep)).append_column(
+                "weight", pa.array(np.full(keep.sum(), 1 / rate), pa.float64())
+            )
+        return samples
+
+    def reweight(self, trips_dir: str, outputs: typing.List[str]):
+        """
+        Completes the samples of the given outputs, which are read from
+        `trips_dir`, with a trip of each stratum of their partition that has
+        none, and weights them by the trips of each stratum. Every output of a
+        partition must be given.
+        """
+        filled = {rate: 0 for rate in self.rates}
+        by_partition: dict[str, typing.List[str]] = {}
+        for output in outputs:
+            by_partition.setdefault(os.path.dirname(output), []).append(output)
+
+        for partition_outputs in by_partition.values():
+            frames = []
+            for output in partition_outputs:
+                table = pq.ParquetFile(os.path.join(trips_dir, output)).read(
+                    columns=HASH_COLUMNS
+                )
+                frames.append(
+                    pd.DataFrame(
+                        {
+                            "output": output,
+                            "row": np.arange(table.num_rows),
+                            "stratum": strata(table).to_numpy(),
+                            "hash": sample_hashes(table),
+                        }
+                    )
+                )
+            trips = pd.concat(frames, ignore_index=True)
+            if trips.empty:
+                continue
+            population = trips["stratum"].value_counts()
+            # the trip with the lowest hash of a stratum is the first one kept
+            # as the rate grows, so filling with it keeps samples nested
+            lowest = trips.loc[trips.groupby("stratum")["hash"].idxmin()]
+
+            full_tables: dict[str, pa.Table] = {}
+            for rate in self.rates:
+                samples: dict[str, pa.Table] = {}
+                for output in partition_outputs:
+                    path = self.path(rate, output)
+                    if not os.path.exists(path):
+                        continue
+                    table = pq.ParquetFile(path).read()
+                    # drops the trips an earlier run filled strata with, as
+                    # the lowest hash of a stratum may have changed since
+                    samples[output] = table.filter(
+                        pa.array(sample_hashes(table) < threshold(rate))
+                    )
+
+                kept_strata = (
+                    set(pd.concat([strata(table) for table in samples.values()]))
+                    if samples
+                    else set()
+                )
+                missing = lowest[~lowest["stratum"].isin(kept_strata)]
+                filled[rate] += len(missing)
+                for output, rows in missing.groupby("output")["row"]:
+                    if output not in full_tables:
+                        full_tables[output] = pq.ParquetFile(
+                            os.path.join(trips_dir, output)
+                        ).read()
+                    fill = full_tables[output].take(rows.to_numpy())
+                    fill = fill.append_column(
+                        "weight", pa.array(np.full(fill.num_rows, 1.0), pa.float64())
+                    )
+                    if output in samples:
+                        fill = pa.concat_tables(
+                            [samples[output], fill.cast(samples[output].schema)]
+                        ).sort_by("started_at")
+                    samples[output] = fill
+
+                kept = pd.concat(
+                    [strata(table) for table in samples.values()]
+                ).value_counts()
+                weights = population.reindex(kept.index) / kept
+                for output, table in samples.items():
+                    weight = weights.reindex(strata(table)).to_numpy(np.float64)
+                    self.write_file(
+                        self.path(rate, output),
+                        table.set_column(
+                            table.schema.get_field_index("weight"),
+                            "weight",
+                            pa.array(weight, pa.float64()),
+                        ),
+                    )
+
+        log(
+            "Reweighted samples",
+            {
+                "partitions": len(by_partition),
+                "filled_strata": {
+                    format_rate(rate): count for rate, count in filled.items()
+                },
+            },
+        )
+
+    def open_files(
+        self, output: str, schema: pa.Schema
+    ) -> dict[float, pq.ParquetWriter]:
+        files = {}
+        for rate in self.rates:
+            files[rate] = self.open_file(self.path(rate, output), schema)
+        return files
+
+    def open_file(self, path: str, schema: pa.Schema) -> pq.ParquetWriter:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return pq.ParquetWriter(
+            path,
+            schema,
+            compression=self.compression,
+            store_decimal_as_integer=True,
+        )
+
+    def write_file(self, path: str, table: pa.Table):
+        with self.open_file(f"{path}.tmp", table.schema) as file:
+            file.write_table(table)
+        os.replace(f"{path}.tmp", path)
+
+    def write(self, output: str, table: pa.Table):
+        samples = self.sample(table)
+        files = self.open_files(output, samples[self.rates[0]].schema)
+        for rate, file in files.items():
+            with file:
+                file.write_table(samples[rate])
+
+    def remove(self, output: str):
+        for path in self.paths(output):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
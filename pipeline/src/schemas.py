@@ -65,6 +65,11 @@ v2 = {
     "dt_cols": ["started_at", "ended_at"],
 }
 
+# timestamps are ISO 8601 or in one of the given formats; anything else is
+# read as null rather than failing the whole file, as with pandas' coercion.
+# Both engines parse with these, so that they read the same timestamps
+ISO8601_PATTERN = r"^\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}(:\d{2}(\.\d{1,9})?)?$"
+TIMESTAMP_FORMATS = ["%m/%d/%Y %H:%M:%S", "%m/%d/%Y %H:%M"]
 
 schemas = {
     "v11": v11,
@@ -90,3 +95,39 @@ normalized_schema = {
     "gender": pa.string(),
     "birth_year": pa.int64(),
 }
+
+# a compact variant of the normalized schema: low-cardinality strings are
+# dictionary encoded, coordinates use the decimal types ClickHouse stores them
+# as and birth years fit in 16 bits
+dictionary_string = pa.dictionary(pa.int32(), pa.string())
+
+optimized_schema = {
+    "ride_id": pa.string(),
+    "rideable_type": dictionary_string,
+    "started_at": pa.timestamp("ns"),
+    "ended_at": pa.timestamp("ns"),
+    "start_station_id": dictionary_string,
+    "start_station_name": dictionary_string,
+    "start_lat": pa.decimal128(7, 5),
+    "start_lng": pa.decimal128(8, 5),
+    "end_station_id": dictionary_string,
+    "end_station_name": dictionary_string,
+    "end_lat": pa.decimal128(7, 5),
+    "end_lng": pa.decimal128(8, 5),
+    "member_casual": dictionary_string,
+    "bike_id": pa.string(),
+    "gender": dictionary_string,
+    "birth_year": pa.int16(),
+    "start_current_station_id": dictionary_string,
+    "end_current_station_id": dictionary_string,
+}
+
+# the written schemas add the current GBFS station ids trips are resolved to
+output_schemas = {
+    "normalized": {
+        **normalized_schema,
+        "start_current_station_id": pa.string(),
+        "end_current_station_id": pa.string(),
+    },
+    "optimized": optimized_schema,
+}
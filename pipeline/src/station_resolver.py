@@ -0,0 +1,215 @@
+import json
+import logging
+import math
+import os
+import typing
+import urllib.request
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from log import log
+from manifest import hash_file
+
+# the feed ClickHouse loads current_stations from (see 0_prepare_data.sh)
+STATION_INFORMATION_URL = (
+    "https://gbfs.lyft.com/gbfs/1.1/bkn/en/station_information.json"
+)
+
+STATIONS_FILE = "stations.json"
+
+# seconds to wait on the station feed before falling back
+FETCH_TIMEOUT = 30
+
+METERS_PER_DEGREE = 111_320.0
+
+
+def fetch_stations(
+    source: str, out_dir: str, refresh: bool = False
+) -> typing.Optional[str]:
+    """
+    Snapshots the stations of a GBFS station_information URL or file into the
+    output directory, so that every transform run resolves against the same
+    stations until the snapshot is refreshed. ClickHouse loads current_stations
+    from the same file.
+
+    When a URL can't be fetched, e.g. offline, an existing snapshot is kept,
+    and without one None is returned so that trips are left unresolved.
+    """
+    path = os.path.join(out_dir, STATIONS_FILE)
+    if os.path.exists(path) and not refresh:
+        return path
+
+    log("Fetching station information", {"source": source})
+    if source.startswith("http://") or source.startswith("https://"):
+        try:
+            with urllib.request.urlopen(source, timeout=FETCH_TIMEOUT) as response:
+                stations = json.load(response)
+        except OSError as e:
+            if os.path.exists(path):
+                log(
+                    "Failed to fetch station information, keeping snapshot",
+                    {"source": source, "path": path, "exception": e},
+                    logging.WARNING,
+                )
+                return path
+            log(
+                "Failed to fetch station information, trips won't be resolved",
+                {"source": source, "exception": e},
+                logging.WARNING,
+            )
+            return None
+    else:
+        with open(source, "r") as f:
+            stations = json.load(f)
+    if isinstance(stations, dict):
+        stations = stations["data"]["stations"]
+
+    os.makedirs(out_dir, exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(stations, f)
+    os.replace(f"{path}.tmp", path)
+    return path
+
+
+class StationIndex:
+    """
+    Resolves the stations of trips to current GBFS station ids, matching on
+    station name, then on short name against the trip's station id, then on
+    the nearest station within a tolerance of the trip's coordinates. Lookups
+    are vectorized over whole Arrow columns.
+    """
+
+    TOLERANCE_METERS = 25.0
+
+    def __init__(
+        self,
+        stations: typing.List[dict],
+        fingerprint: typing.Optional[str] = None,
+        tolerance_meters: float = TOLERANCE_METERS,
+    ):
+        self.fingerprint = fingerprint
+        self.tolerance = tolerance_meters
+        self.station_ids = pa.array(
+            [str(station["station_id"]) for station in stations], pa.string()
+        )
+        self.names = pa.array(
+            [station.get("name") for station in stations], pa.string()
+        )
+        self.short_names = pa.array(
+            [station.get("short_name") for station in stations], pa.string()
+        )
+
+        # coordinates are projected onto a local plane in meters and bucketed
+        # into a grid of tolerance-sized cells, so a match is always in the
+        # cell of the trip's coordinates or one of its neighbours
+        lat = np.array([station["lat"] for station in stations], dtype=np.float64)
+        lng = np.array([station["lon"] for station in stations], dtype=np.float64)
+        self.lng_scale = math.cos(math.radians(float(np.mean(lat)))) if len(lat) else 1
+        self.x, self.y = self.project(lat, lng)
+        cells = self.cell_keys(*self.cells(self.x, self.y))
+        self.order = np.argsort(cells, kind="stable")
+        self.sorted_cells = cells[self.order]
+        self.max_occupancy = (
+            int(np.unique(cells, return_counts=True)[1].max()) if len(cells) else 0
+        )
+
+    @staticmethod
+    def from_file(path: str) -> "StationIndex":
+        """
+        Loads a GBFS station_information feed, or the list of stations in it
+        as snapshotted by fetch_stations.
+        """
+        with open(path, "r") as f:
+            stations = json.load(f)
+        if isinstance(stations, dict):
+            stations = stations["data"]["stations"]
+
+        index = StationIndex(stations, hash_file(path))
+        log("Loaded station index", {"path": path, "stations": len(stations)})
+        return index
+
+    def project(
+        self, lat: np.ndarray, lng: np.ndarray
+    ) -> typing.Tuple[np.ndarray, np.ndarray]:
+        return lng * METERS_PER_DEGREE * self.lng_scale, lat * METERS_PER_DEGREE
+
+    def cells(
+        self, x: np.ndarray, y: np.ndarray
+    ) -> typing.Tuple[np.ndarray, np.ndarray]:
+        return (
+            np.floor(x / self.tolerance).astype(np.int64),
+            np.floor(y / self.tolerance).astype(np.int64),
+        )
+
+    @staticmethod
+    def cell_keys(cx: np.ndarray, cy: np.ndarray) -> np.ndarray:
+        return (cx << 32) + (cy & 0xFFFFFFFF)
+
+    def resolve(self, table: pa.Table) -> pa.Table:
+        """
+        Appends start_current_station_id and end_current_station_id to a table
+        of normalized trips. Unresolved stations are null.
+        """
+        for end in ("start", "end"):
+            table = table.append_column(
+                f"{end}_current_station_id",
+                self.resolve_ids(
+                    table.column(f"{end}_station_name").combine_chunks(),
+                    table.column(f"{end}_station_id").combine_chunks(),
+                    table.column(f"{end}_lat").combine_chunks(),
+                    table.column(f"{end}_lng").combine_chunks(),
+                ),
+            )
+        return table
+
+    def resolve_ids(
+        self, name: pa.Array, station_id: pa.Array, lat: pa.Array, lng: pa.Array
+    ) -> pa.Array:
+        matches = pc.coalesce(
+            pc.index_in(name, value_set=self.names, skip_nulls=True),
+            pc.index_in(station_id, value_set=self.short_names, skip_nulls=True),
+        )
+
+        unmatched = pc.is_null(matches)
+        if pc.any(unmatched).as_py():
+            positions = np.flatnonzero(unmatched.to_numpy(zero_copy_only=False))
+            nearest = np.full(len(matches), -1, dtype=np.int32)
+            nearest[positions] = self.nearest(
+                lat.filter(unmatched).to_numpy(zero_copy_only=False),
+                lng.filter(unmatched).to_numpy(zero_copy_only=False),
+            )
+            matches = pc.coalesce(matches, pa.array(nearest, mask=nearest < 0))
+
+        return pc.take(self.station_ids, matches)
+
+    def nearest(self, lat: np.ndarray, lng: np.ndarray) -> np.ndarray:
+        """
+        Returns the index of the nearest station within the tolerance of each
+        coordinate, or -1 where there is none.
+        """
+        best = np.full(len(lat), -1, dtype=np.int32)
+        if not self.max_occupancy:
+            return best
+
+        valid = ~(np.isnan(lat) | np.isnan(lng))
+        x, y = self.project(np.where(valid, lat, 0), np.where(valid, lng, 0))
+        cx, cy = self.cells(x, y)
+        best_distance = np.full(len(lat), self.tolerance**2)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                keys = self.cell_keys(cx + dx, cy + dy)
+                left = np.searchsorted(self.sorted_cells, keys, side="left")
+                right = np.searchsorted(self.sorted_cells, keys, side="right")
+                for i in range(self.max_occupancy):
+                    slot = left + i
+                    occupied = valid & (slot < right)
+                    candidate = self.order[np.minimum(slot, len(self.order) - 1)]
+                    distance = (self.x[candidate] - x) ** 2 + (
+                        self.y[candidate] - y
+                    ) ** 2
+                    closer = occupied & (distance <= best_distance)
+                    best[closer] = candidate[closer]
+                    best_distance[closer] = distance[closer]
+        return best
@@ -0,0 +1,366 @@
+import argparse
+import calendar
+import io
+import json
+import os
+import typing
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from log import log
+from station_resolver import STATIONS_FILE
+
+# the archive layouts found in the tripdata bucket (see archive_transformer.py)
+LAYOUTS = ["chunked_year", "nested_year", "monthly", "jc_monthly"]
+
+V11_HEADERS = [
+    "tripduration",
+    "starttime",
+    "stoptime",
+    "start station id",
+    "start station name",
+    "start station latitude",
+    "start station longitude",
+    "end station id",
+    "end station name",
+    "end station latitude",
+    "end station longitude",
+    "bikeid",
+    "usertype",
+    "birth year",
+    "gender",
+]
+
+V12_HEADERS = [
+    "Trip Duration",
+    "Start Time",
+    "Stop Time",
+    "Start Station ID",
+    "Start Station Name",
+    "Start Station Latitude",
+    "Start Station Longitude",
+    "End Station ID",
+    "End Station Name",
+    "End Station Latitude",
+    "End Station Longitude",
+    "Bike ID",
+    "User Type",
+    "Birth Year",
+    "Gender",
+]
+
+# timestamp formats used by the real files of each header version
+DATE_FORMATS = {
+    "v11": "%m/%d/%Y %H:%M:%S",
+    "v12": "%Y-%m-%d %H:%M:%S",
+    "v2": "%Y-%m-%d %H:%M:%S",
+}
+
+
+class ArchiveSpec(typing.NamedTuple):
+    layout: str
+    year: int
+    version: str
+
+    @staticmethod
+    def parse(spec: str) -> "ArchiveSpec":
+        layout, year, version = spec.split(":")
+        if layout not in LAYOUTS:
+            raise ValueError("Unknown archive layout", layout)
+        if version not in DATE_FORMATS:
+            raise ValueError("Unknown header version", version)
+        return ArchiveSpec(layout, int(year), version)
+
+
+# covers every layout and header version
+DEFAULT_SPECS = [
+    ArchiveSpec("chunked_year", 2015, "v11"),
+    ArchiveSpec("chunked_year", 2017, "v12"),
+    ArchiveSpec("nested_year", 2021, "v2"),
+    ArchiveSpec("monthly", 2024, "v2"),
+    ArchiveSpec("jc_monthly", 2016, "v11"),
+    ArchiveSpec("jc_monthly", 2024, "v2"),
+]
+
+
+class SyntheticTripGenerator:
+    """
+    Writes reproducible Citi Bike-like archives in each of the layouts of the
+    tripdata bucket, so that the pipeline can be run and benchmarked offline.
+    """
+
+    CONFIG_FILE = "synthetic.json"
+
+    def __init__(
+        self,
+        out_dir: str,
+        rows_per_month: int = 10_000,
+        months: int = 12,
+        chunk_rows: int = 1_000_000,
+        n_stations: int = 2_000,
+        seed: int = 0,
+    ):
+        self.out_dir = out_dir
+        self.archive_dir = os.path.join(out_dir, "archives")
+        self.rows_per_month = rows_per_month
+        self.months = months
+        self.chunk_rows = chunk_rows
+        self.n_stations = n_stations
+        self.seed = seed
+
+        rng = np.random.default_rng(seed)
+        self.stations = pd.DataFrame(
+            {
+                "id": [f"{5000 + i // 100}.{i % 100:02d}" for i in range(n_stations)],
+                "name": [f"Synthetic St & {i} Ave" for i in range(n_stations)],
+                "lat": np.round(rng.uniform(40.64, 40.88, n_stations), 6),
+                "lng": np.round(rng.uniform(-74.08, -73.88, n_stations), 6),
+            }
+        )
+
+    def config(self, specs: typing.List[ArchiveSpec]) -> dict:
+        return {
+            "rows_per_month": self.rows_per_month,
+            "months": self.months,
+            "chunk_rows": self.chunk_rows,
+            "n_stations": self.n_stations,
+            "seed": self.seed,
+            "specs": [list(spec) for spec in specs],
+        }
+
+    def generate(self, specs: typing.List[ArchiveSpec] = DEFAULT_SPECS) -> int:
+        """
+        Writes an archive (or, for monthly layouts, an archive per month) for
+        each spec. Returns the number of trips the pipeline should output, which
+        excludes the redundant chunks of chunked year archives. Data generated
+        with the same config is reused.
+        """
+        config_path = os.path.join(self.out_dir, SyntheticTripGenerator.CONFIG_FILE)
+        config = self.config(specs)
+        if os.path.exists(config_path):
+            with open(config_path, "r") as f:
+                previous = json.load(f)
+            if previous["config"] == config:
+                log("Reusing synthetic archives", {"out_dir": self.out_dir})
+                return previous["rows"]
+
+        if os.path.isdir(self.archive_dir):
+            for file in os.listdir(self.archive_dir):
+                if file.endswith(".zip"):
+                    os.remove(os.path.join(self.archive_dir, file))
+        os.makedirs(self.archive_dir, exist_ok=True)
+
+        self.write_stations()
+        rows = 0
+        for i, spec in enumerate(specs):
+            rng = np.random.default_rng([self.seed, i])
+            if spec.layout == "chunked_year":
+                rows += self.write_chunked_year(rng, spec)
+            elif spec.layout == "nested_year":
+                rows += self.write_nested_year(rng, spec)
+            else:
+                rows += self.write_monthly(rng, spec)
+
+        with open(config_path, "w") as f:
+            json.dump({"config": config, "rows": rows}, f, indent=2)
+
+        log("Generated synthetic archives", {"out_dir": self.out_dir, "rows": rows})
+        return rows
+
+    def write_stations(self):
+        """
+        Writes the stations in the form fetch_stations snapshots them, for
+        resolving the synthetic trips.
+        """
+        stations = [
+            {
+                "station_id": f"synthetic-{i}",
+                "short_name": station.id,
+                "name": station.name,
+                "lat": station.lat,
+                "lon": station.lng,
+            }
+            for i, station in enumerate(self.stations.itertuples())
+        ]
+        with open(os.path.join(self.out_dir, STATIONS_FILE), "w") as f:
+            json.dump(stations, f)
+
+    def write_chunked_year(self, rng: np.random.Generator, spec: ArchiveSpec) -> int:
+        """
+        Year archive with chunked monthly CSVs at the top level and the same
+        months as whole CSVs in month folders (2013-2018).
+        """
+        name = f"{spec.year}-citibike-tripdata"
+        with zipfile.ZipFile(
+            os.path.join(self.archive_dir, f"{name}.zip"), "w", zipfile.ZIP_DEFLATED
+        ) as zip_ref:
+            for month in range(1, self.months + 1):
+                df = self.trips(rng, spec.version, spec.year, month)
+                month_name = f"{spec.year}{month:02d}-citibike-tripdata"
+                self.write_chunks(zip_ref, df, spec.version, month_name)
+                self.write_csv(
+                    zip_ref,
+                    f"{name}/{month}_{calendar.month_name[month]}/{month_name}.csv",
+                    df,
+                    spec.version,
+                )
+        return self.months * self.rows_per_month
+
+    def write_nested_year(self, rng: np.random.Generator, spec: ArchiveSpec) -> int:
+        """
+        Year archive of monthly archives of chunked CSVs (2020-2023).
+        """
+        name = f"{spec.year}-citibike-tripdata"
+        with zipfile.ZipFile(
+            os.path.join(self.archive_dir, f"{name}.zip"), "w", zipfile.ZIP_DEFLATED
+        ) as zip_ref:
+            for month in range(1, self.months + 1):
+                month_name = f"{spec.year}{month:02d}-citibike-tripdata"
+                nested = io.BytesIO()
+                with zipfile.ZipFile(nested, "w", zipfile.ZIP_DEFLATED) as nested_ref:
+                    df = self.trips(rng, spec.version, spec.year, month)
+                    self.write_chunks(nested_ref, df, spec.version, month_name)
+                zip_ref.writestr(f"{name}/{month_name}.zip", nested.getvalue())
+        return self.months * self.rows_per_month
+
+    def write_monthly(self, rng: np.random.Generator, spec: ArchiveSpec) -> int:
+        """
+        An archive per month expanding to one or more chunk CSVs, prefixed with
+        JC- for Jersey City.
+        """
+        prefix = "JC-" if spec.layout == "jc_monthly" else ""
+        for month in range(1, self.months + 1):
+            df = self.trips(rng, spec.version, spec.year, month)
+            month_name = f"{prefix}{spec.year}{month:02d}-citibike-tripdata"
+            n_chunks = -(-len(df) // self.chunk_rows)
+            archive_name = (
+                f"{month_name}_{n_chunks}.csv.zip"
+                if n_chunks > 1
+                else f"{month_name}.csv.zip"
+            )
+            with zipfile.ZipFile(
+                os.path.join(self.archive_dir, archive_name),
+                "w",
+                zipfile.ZIP_DEFLATED,
+            ) as zip_ref:
+                if n_chunks > 1:
+                    self.write_chunks(zip_ref, df, spec.version, month_name)
+                else:
+                    self.write_csv(zip_ref, f"{month_name}.csv", df, spec.version)
+        return self.months * self.rows_per_month
+
+    def write_chunks(
+        self, zip_ref: zipfile.ZipFile, df: pd.DataFrame, version: str, name: str
+    ):
+        for i, start in enumerate(range(0, len(df), self.chunk_rows)):
+            self.write_csv(
+                zip_ref,
+                f"{name}_{i + 1}.csv",
+                df.iloc[start : start + self.chunk_rows],
+                version,
+            )
+
+    @staticmethod
+    def write_csv(
+        zip_ref: zipfile.ZipFile, member: str, df: pd.DataFrame, version: str
+    ):
+        with zip_ref.open(member, "w", force_zip64=True) as f:
+            text = io.TextIOWrapper(f, encoding="utf-8", newline="")
+            df.to_csv(text, index=False, date_format=DATE_FORMATS[version])
+            text.flush()
+            text.detach()
+
+    def trips(
+        self, rng: np.random.Generator, version: str, year: int, month: int
+    ) -> pd.DataFrame:
+        n = self.rows_per_month
+        month_start = pd.Timestamp(year=year, month=month, day=1)
+        month_seconds = int(
+            (month_start + pd.offsets.MonthBegin(1) - month_start).total_seconds()
+        )
+        started_at = month_start + pd.to_timedelta(
+            np.sort(rng.integers(0, month_seconds, n)), unit="s"
+        )
+        duration = rng.integers(60, 3_600, n)
+        ended_at = started_at + pd.to_timedelta(duration, unit="s")
+        start = self.stations.iloc[rng.integers(0, self.n_stations, n)]
+        end = self.stations.iloc[rng.integers(0, self.n_stations, n)]
+        member = rng.random(n) < 0.8
+
+        if version == "v2":
+            return pd.DataFrame(
+                {
+                    "ride_id": [f"{id:016X}" for id in rng.integers(0, 1 << 63, n)],
+                    "rideable_type": np.where(
+                        rng.random(n) < 0.6, "classic_bike", "electric_bike"
+                    ),
+                    "started_at": started_at,
+                    "ended_at": ended_at,
+                    "start_station_name": start["name"].values,
+                    "start_station_id": start["id"].values,
+                    "end_station_name": end["name"].values,
+                    "end_station_id": end["id"].values,
+                    "start_lat": start["lat"].values,
+                    "start_lng": start["lng"].values,
+                    "end_lat": end["lat"].values,
+                    "end_lng": end["lng"].values,
+                    "member_casual": np.where(member, "member", "casual"),
+                }
+            )
+
+        birth_year = pd.array(rng.integers(1940, 2005, n), dtype=pd.Int64Dtype())
+        birth_year[rng.random(n) < 0.05] = pd.NA
+        columns = [
+            duration,
+            started_at,
+            ended_at,
+            # station ids were integers before the 2020s
+            start.index.values + 72,
+            start["name"].values,
+            start["lat"].values,
+            start["lng"].values,
+            end.index.values + 72,
+            end["name"].values,
+            end["lat"].values,
+            end["lng"].values,
+            rng.integers(14_500, 50_000, n),
+            np.where(member, "Subscriber", "Customer"),
+            birth_year,
+            rng.integers(0, 3, n),
+        ]
+        headers = V11_HEADERS if version == "v11" else V12_HEADERS
+        return pd.DataFrame(dict(zip(headers, columns)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate synthetic trip archives")
+    parser.add_argument("--out_dir", help="Output directory", default="./synthetic")
+    parser.add_argument(
+        "--archive",
+        action="append",
+        type=ArchiveSpec.parse,
+        help=f"Archive to generate as LAYOUT:YEAR:VERSION, where LAYOUT is one of "
+        f"{', '.join(LAYOUTS)}; may be repeated (default: every layout and version)",
+    )
+    parser.add_argument("--rows_per_month", type=int, default=10_000)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument(
+        "--chunk_rows", type=int, default=1_000_000, help="Rows per chunk CSV"
+    )
+    parser.add_argument("--n_stations", type=int, default=2_000)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    SyntheticTripGenerator(
+        args.out_dir,
+        args.rows_per_month,
+        args.months,
+        args.chunk_rows,
+        args.n_stations,
+        args.seed,
+    ).generate(args.archive or DEFAULT_SPECS)
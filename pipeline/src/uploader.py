@@ -1,22 +1,64 @@
+import hashlib
 import os
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.config import Config
 
-from log import log
+from instrumentation import report
+from log import debug, log
 
 
 class Uploader:
-    def __init__(self, data_dir: str, bucket_name: str, region: str = "us-east-1"):
+    MAX_WORKERS = 8
+    # the most keys a DeleteObjects request accepts
+    DELETE_BATCH_SIZE = 1000
+
+    # ETags of existing objects are compared against ETags computed locally
+    # with the same part size, so this config is also what change detection
+    # relies on
+    TRANSFER_CONFIG = TransferConfig(
+        multipart_threshold=64 * 1024 * 1024,
+        multipart_chunksize=16 * 1024 * 1024,
+        max_concurrency=4,
+    )
+
+    def __init__(
+        self,
+        data_dir: str,
+        bucket_name: str,
+        region: str = "us-east-1",
+        endpoint_url: typing.Optional[str] = None,
+    ):
         self.data_dir = data_dir
         self.bucket_name = bucket_name
         self.client = boto3.client(
             "s3",
+            endpoint_url=endpoint_url or os.environ.get("S3_ENDPOINT_URL"),
             config=Config(
                 region_name=region,
+                max_pool_connections=Uploader.MAX_WORKERS
+                * Uploader.TRANSFER_CONFIG.max_concurrency,
             ),
         )
 
     def upload(self, region: str = "us-east-1"):
+        self.ensure_bucket(region)
+
+        files = []
+        for root, _, file_names in os.walk(self.data_dir):
+            for file_name in sorted(file_names):
+                files.append(
+                    os.path.relpath(os.path.join(root, file_name), self.data_dir)
+                )
+
+        self.upload_files(sorted(files))
+        self.delete_stale()
+
+    def ensure_bucket(self, region: str = "us-east-1"):
         if not self.bucket_name:
             raise ValueError("Bucket name is required")
 
@@ -32,8 +74,117 @@ class Uploader:
                     CreateBucketConfiguration=({"LocationConstraint": region}),
                 )
 
-        for file in os.listdir(self.data_dir):
-            with open(os.path.join(self.data_dir, file), "rb") as data:
-                log(f"Uploading file", {"file": file, "bucket": self.bucket_name})
-                self.client.upload_fileobj(data, self.bucket_name, file)
-                log(f"Uploaded file", {"file": file, "bucket": self.bucket_name})
+    def upload_files(self, files: typing.List[str]):
+        """
+        Uploads files given relative to the data directory, skipping those whose
+        size and ETag already match the object in the bucket.
+        """
+        existing = self.list_objects()
+
+        start_time = time.time()
+        with report.stage("upload"), ThreadPoolExecutor(
+            max_workers=Uploader.MAX_WORKERS
+        ) as executor:
+            uploaded = list(
+                executor.map(lambda file: self.upload_file(file, existing), files)
+            )
+
+        elapsed = time.time() - start_time
+        uploaded_bytes = sum(uploaded)
+        log(
+            "Uploaded files",
+            {
+                "bucket": self.bucket_name,
+                "uploaded": len([size for size in uploaded if size]),
+                "skipped": len([size for size in uploaded if not size]),
+                "bytes": uploaded_bytes,
+                "elapsed": elapsed,
+                "mb_per_second": uploaded_bytes / 1e6 / elapsed if elapsed else None,
+            },
+        )
+
+    def upload_file(self, file: str, existing: dict[str, dict]) -> int:
+        path = os.path.join(self.data_dir, file)
+        key = file.replace(os.sep, "/")
+        size = os.path.getsize(path)
+
+        obj = existing.get(key)
+        if obj and obj["Size"] == size and obj["ETag"].strip('"') == local_etag(path):
+            debug("Skipping unchanged file", {"file": file, "bucket": self.bucket_name})
+            report.record_file("upload", file, skipped=True)
+            return 0
+
+        debug("Uploading file", {"file": file, "bucket": self.bucket_name})
+        start_time = time.time()
+        self.client.upload_file(
+            path, self.bucket_name, key, Config=Uploader.TRANSFER_CONFIG
+        )
+        elapsed = time.time() - start_time
+        report.record_file(
+            "upload", file, elapsed=elapsed, bytes_out=size, skipped=False
+        )
+        log(
+            f"Uploaded file",
+            {
+                "file": file,
+                "bucket": self.bucket_name,
+                "mb_per_second": size / 1e6 / elapsed if elapsed else None,
+            },
+        )
+        return size
+
+    def delete_stale(self):
+        """
+        Deletes objects whose file is no longer in the data directory, e.g. the
+        outputs of removed or renamed sources, so that the bucket mirrors it.
+        """
+        stale = [
+            key
+            for key in self.list_objects()
+            if not os.path.exists(os.path.join(self.data_dir, *key.split("/")))
+        ]
+        for i in range(0, len(stale), Uploader.DELETE_BATCH_SIZE):
+            batch = stale[i : i + Uploader.DELETE_BATCH_SIZE]
+            response = self.client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+            )
+            if response.get("Errors"):
+                raise RuntimeError(
+                    f"Failed to delete stale objects: {response['Errors']}"
+                )
+            for key in batch:
+                report.record_file("upload", key, deleted=True)
+
+        log(
+            "Deleted stale objects", {"bucket": self.bucket_name, "deleted": len(stale)}
+        )
+
+    def list_objects(self) -> dict[str, dict]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        objects = {}
+        for page in paginator.paginate(Bucket=self.bucket_name):
+            for obj in page.get("Contents", []):
+                objects[obj["Key"]] = obj
+        return objects
+
+
+def local_etag(path: str) -> str:
+    """
+    Computes the ETag S3 assigns to a file uploaded with Uploader.TRANSFER_CONFIG:
+    the MD5 of the content for single part uploads and the MD5 of the part
+    MD5s, suffixed with the part count, for multipart uploads.
+    """
+    config = Uploader.TRANSFER_CONFIG
+    if os.path.getsize(path) < config.multipart_threshold:
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    part_digests = []
+    with open(path, "rb") as f:
+        for part in iter(lambda: f.read(config.multipart_chunksize), b""):
+            part_digests.append(hashlib.md5(part).digest())
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
@@ -0,0 +1,122 @@
+import os
+import typing
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from schemas import normalized_schema
+
+# a generous box around the Citi Bike service areas in NYC and Jersey City,
+# which rules out the 0/0 and test-station coordinates found in the archives
+LAT_BOUNDS = (40.3, 41.2)
+LNG_BOUNDS = (-74.5, -73.5)
+
+
+def out_of_bounds(lat: pa.ChunkedArray, lng: pa.ChunkedArray) -> pa.ChunkedArray:
+    # missing coordinates are allowed, e.g. for e-bikes left outside a station
+    return pc.fill_null(
+        pc.invert(
+            pc.and_(
+                pc.and_(
+                    pc.greater_equal(lat, LAT_BOUNDS[0]),
+                    pc.less_equal(lat, LAT_BOUNDS[1]),
+                ),
+                pc.and_(
+                    pc.greater_equal(lng, LNG_BOUNDS[0]),
+                    pc.less_equal(lng, LNG_BOUNDS[1]),
+                ),
+            )
+        ),
+        False,
+    )
+
+
+# reason codes of rows that are quarantined, in the order rules are checked;
+# a row is quarantined with the first rule it fails. Unparseable timestamps
+# are read as nulls, so they fail the invalid_* rules.
+RULES: dict[str, typing.Callable[[pa.Table], pa.ChunkedArray]] = {
+    "invalid_started_at": lambda t: pc.is_null(t.column("started_at")),
+    "invalid_ended_at": lambda t: pc.is_null(t.column("ended_at")),
+    "ended_before_started": lambda t: pc.less(
+        t.column("ended_at"), t.column("started_at")
+    ),
+    "start_out_of_bounds": lambda t: out_of_bounds(
+        t.column("start_lat"), t.column("start_lng")
+    ),
+    "end_out_of_bounds": lambda t: out_of_bounds(
+        t.column("end_lat"), t.column("end_lng")
+    ),
+}
+
+quarantine_schema = pa.schema({**normalized_schema, "reason": pa.string()})
+
+
+def validate(table: pa.Table) -> typing.Tuple[pa.Table, pa.Table]:
+    """
+    Checks a table of normalized trips against every rule. Returns the valid
+    rows and the rejected rows with the reason they were rejected.
+    """
+    failed = [pc.fill_null(rule(table), False) for rule in RULES.values()]
+    rejected = failed[0]
+    for mask in failed[1:]:
+        rejected = pc.or_(rejected, mask)
+    if not pc.any(rejected).as_py():
+        return table, quarantine_schema.empty_table()
+
+    reasons = pc.case_when(
+        pc.make_struct(*[mask.combine_chunks() for mask in failed]),
+        *[pa.scalar(reason) for reason in RULES],
+    )
+    quarantined = table.filter(rejected).append_column(
+        "reason", reasons.filter(rejected.combine_chunks())
+    )
+    return table.filter(pc.invert(rejected)), quarantined
+
+
+def count_reasons(table: pa.Table) -> dict[str, int]:
+    return {
+        count["values"].as_py(): count["counts"].as_py()
+        for count in pc.value_counts(table.column("reason"))
+    }
+
+
+class QuarantineWriter:
+    """
+    Writes rows rejected by validation to a Parquet dataset under quarantine/,
+    one file per name the writer is called with. Outputs are returned
+    relative to the parent of the quarantine directory, so that they can't be
+    mistaken for trip outputs, which start with the system partition.
+    """
+
+    DIR = "quarantine"
+
+    def __init__(self, out_dir: str, compression: str = "snappy"):
+        self.out_dir = out_dir
+        self.compression = compression
+
+    @staticmethod
+    def is_output(output: str) -> bool:
+        return output.startswith(f"{QuarantineWriter.DIR}/")
+
+    def output(self, system: str, name: str) -> str:
+        return f"{QuarantineWriter.DIR}/system={system}/{name}.parquet"
+
+    def path(self, output: str) -> str:
+        return os.path.join(self.out_dir, output)
+
+    def open_file(self, output: str) -> pq.ParquetWriter:
+        path = self.path(output)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return pq.ParquetWriter(path, quarantine_schema, compression=self.compression)
+
+    def stats(self, outputs: typing.List[str]) -> dict[str, int]:
+        """
+        Counts the quarantined rows of the given outputs by reason.
+        """
+        counts: dict[str, int] = {}
+        for output in outputs:
+            table = pq.ParquetFile(self.path(output)).read(columns=["reason"])
+            for reason, count in count_reasons(table).items():
+                counts[reason] = counts.get(reason, 0) + count
+        return counts
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pyarrow as pa
+
+# the pipeline's modules import each other by bare name, as when run from src/
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from schemas import normalized_schema  # noqa: E402
+
+
+def make_trips(started_at: list, **columns: list) -> pa.Table:
+    """
+    Builds normalized trips with the given start times and columns, numbered
+    ride ids and every other column null.
+    """
+    rows = len(started_at)
+    arrays = {name: pa.nulls(rows, type) for name, type in normalized_schema.items()}
+    arrays["ride_id"] = pa.array([f"ride-{i}" for i in range(rows)])
+    arrays["started_at"] = pa.array(started_at, pa.timestamp("ns"))
+    for name, values in columns.items():
+        arrays[name] = pa.array(values, normalized_schema[name])
+    return pa.table(arrays, schema=pa.schema(normalized_schema))
@@ -0,0 +1,146 @@
+import hashlib
+import os
+
+import boto3
+import pytest
+from boto3.s3.transfer import TransferConfig
+from moto import mock_aws
+
+from archive_extractor import ArchiveExtractor
+
+# objects above 1 KiB are fetched as ranged GETs of 256 bytes
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=1024,
+    multipart_chunksize=256,
+    max_concurrency=2,
+    io_chunksize=64,
+)
+
+SMALL = os.urandom(512)
+LARGE = os.urandom(256 * 7 + 100)
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.delenv("S3_ENDPOINT_URL", raising=False)
+    monkeypatch.setattr(ArchiveExtractor, "TRANSFER_CONFIG", TRANSFER_CONFIG)
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=ArchiveExtractor.BUCKET_NAME)
+        for key, body in (("small.zip", SMALL), ("large.zip", LARGE)):
+            client.put_object(Bucket=ArchiveExtractor.BUCKET_NAME, Key=key, Body=body)
+        client.put_object(
+            Bucket=ArchiveExtractor.BUCKET_NAME, Key="index.html", Body=b"<html/>"
+        )
+        yield client
+
+
+def ranged_gets(extractor: ArchiveExtractor, monkeypatch, fail=None) -> list:
+    """
+    Records the ranges of the extractor's ranged GETs. `fail` is called with
+    each range and the part's bytes, and returns the bytes to write or raises.
+    """
+    ranges = []
+    get_object = extractor.s3.get_object
+
+    def recording_get_object(**kwargs):
+        response = get_object(**kwargs)
+        # objects below the threshold are fetched whole by the transfer manager
+        if "Range" not in kwargs:
+            return response
+        ranges.append(kwargs["Range"])
+        if fail is not None:
+            body = fail(kwargs["Range"], response["Body"].read())
+            response["Body"] = FakeBody(body)
+        return response
+
+    monkeypatch.setattr(extractor.s3, "get_object", recording_get_object)
+    return ranges
+
+
+class FakeBody:
+    def __init__(self, body: bytes):
+        self.body = body
+
+    def iter_chunks(self, chunk_size: int):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start : start + chunk_size]
+
+
+def archive(out_dir, key: str) -> bytes:
+    with open(os.path.join(out_dir, "archives", key), "rb") as f:
+        return f.read()
+
+
+def test_downloads_small_and_ranged_objects(s3, tmp_path, monkeypatch):
+    extractor = ArchiveExtractor(str(tmp_path))
+    ranges = ranged_gets(extractor, monkeypatch)
+
+    extractor.extract()
+
+    assert archive(tmp_path, "small.zip") == SMALL
+    assert archive(tmp_path, "large.zip") == LARGE
+    assert len(ranges) == 8
+    assert extractor.state["large.zip"]["complete"]
+
+
+def test_skips_downloaded_objects(s3, tmp_path, monkeypatch):
+    ArchiveExtractor(str(tmp_path)).extract()
+
+    extractor = ArchiveExtractor(str(tmp_path))
+    ranges = ranged_gets(extractor, monkeypatch)
+    extractor.extract()
+
+    assert ranges == []
+    assert archive(tmp_path, "large.zip") == LARGE
+
+
+def test_resumes_interrupted_download(s3, tmp_path, monkeypatch):
+    extractor = ArchiveExtractor(str(tmp_path))
+
+    def interrupt(byte_range: str, body: bytes) -> bytes:
+        if byte_range.startswith("bytes=1024-"):
+            raise ConnectionError("interrupted")
+        return body
+
+    ranged_gets(extractor, monkeypatch, interrupt)
+    extractor.extract()
+    assert not os.path.exists(os.path.join(tmp_path, "archives", "large.zip"))
+
+    extractor = ArchiveExtractor(str(tmp_path))
+    ranges = ranged_gets(extractor, monkeypatch)
+    extractor.extract()
+
+    assert archive(tmp_path, "large.zip") == LARGE
+    # only the part that failed is fetched again
+    assert ranges == ["bytes=1024-1279"]
+
+
+def test_corrupt_download_is_discarded(s3, tmp_path, monkeypatch):
+    extractor = ArchiveExtractor(str(tmp_path))
+
+    def corrupt(byte_range: str, body: bytes) -> bytes:
+        if byte_range.startswith("bytes=512-"):
+            return bytes(len(body))
+        return body
+
+    ranged_gets(extractor, monkeypatch, corrupt)
+    extractor.extract()
+    assert not os.path.exists(os.path.join(tmp_path, "archives", "large.zip"))
+    assert not os.path.exists(os.path.join(tmp_path, "archives", ".tmp", "large.zip"))
+    assert "large.zip" not in extractor.state
+
+    extractor = ArchiveExtractor(str(tmp_path))
+    ranges = ranged_gets(extractor, monkeypatch)
+    extractor.extract()
+
+    assert archive(tmp_path, "large.zip") == LARGE
+    # every part is fetched again, rather than re-verifying the corrupt ones
+    assert len(ranges) == 8
+    assert (
+        hashlib.md5(archive(tmp_path, "large.zip")).hexdigest()
+        == hashlib.md5(LARGE).hexdigest()
+    )
@@ -0,0 +1,203 @@
+import datetime
+import http.server
+import os
+import re
+import threading
+import typing
+import urllib.parse
+
+import pyarrow as pa
+import pytest
+
+from clickhouse_loader import RAW_TRIPS_COLUMNS, ClickHouseLoader
+from conftest import make_trips
+from manifest import TransformManifest
+from parquet_writer import PartitionedParquetWriter
+
+CREATE_RAW_TRIPS_SQL = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "..",
+    "clickhouse",
+    "docker-entrypoint-initdb.d",
+    "1_create_raw_trips_table.sql",
+)
+
+
+class StubClickHouse(http.server.ThreadingHTTPServer):
+    """
+    Answers the loader's queries over HTTP, keeping just enough table state to
+    check the sequence: each table's comment and rows. `failures` maps a query
+    prefix to a list of "before" or "after" failures, which respond with a 503
+    before or after running the query.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.lock = threading.Lock()
+        self.queries: typing.List[str] = []
+        self.tables: dict[str, dict] = {"raw_trips": {"comment": "", "rows": 7}}
+        self.tokens: typing.List[str] = []
+        self.failures: dict[str, typing.List[str]] = {}
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def run(self, query: str, params: dict, body: bytes) -> bytes:
+        if query.startswith("DROP TABLE"):
+            self.tables.pop(query.split()[-1], None)
+        elif query.startswith("CREATE TABLE IF NOT EXISTS"):
+            name = query.split()[5]
+            comment = re.search(r"COMMENT '(.*)'$", query).group(1)
+            self.tables.setdefault(name, {"comment": comment, "rows": 0})
+        elif query.startswith("INSERT INTO"):
+            token = params["insert_deduplication_token"][0]
+            if token not in self.tokens:
+                self.tokens.append(token)
+                rows = pa.ipc.open_stream(body).read_all().num_rows
+                self.tables[query.split()[2]]["rows"] += rows
+        elif query.startswith("EXCHANGE TABLES"):
+            _, _, a, _, b = query.split()
+            self.tables[a], self.tables[b] = self.tables[b], self.tables[a]
+        elif query.startswith("SELECT comment"):
+            name = re.search(r"name = '(\w+)'", query).group(1)
+            return self.tables[name]["comment"].encode() + b"\n"
+        return b""
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    server: StubClickHouse
+
+    def do_POST(self):
+        params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        query = params["query"][0]
+        with self.server.lock:
+            self.server.queries.append(query)
+            failure = None
+            for prefix, failures in self.server.failures.items():
+                if query.startswith(prefix) and failures:
+                    failure = failures.pop(0)
+            response = b""
+            if failure != "before":
+                response = self.server.run(query, params, body)
+
+        self.send_response(503 if failure else 200)
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def clickhouse():
+    server = StubClickHouse()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(ClickHouseLoader, "RETRY_DELAY", 0)
+
+
+@pytest.fixture
+def out_dir(tmp_path) -> str:
+    """
+    A transform output of 10 trips over two sources.
+    """
+    writer = PartitionedParquetWriter(str(tmp_path / "parquet"))
+    manifest = TransformManifest(str(tmp_path / TransformManifest.FILE_NAME))
+    for source, day in (("a.csv", 1), ("b.csv", 2)):
+        trips = make_trips([datetime.datetime(2024, 1, day, hour) for hour in range(5)])
+        outputs = writer.write(trips, "NYC", source)
+        manifest.record(source, {"size": 0, "mtime": 0, "hash": source}, outputs)
+    manifest.save()
+    return str(tmp_path)
+
+
+def query_kinds(queries: typing.List[str]) -> typing.List[str]:
+    return [" ".join(query.split()[:2]) for query in queries]
+
+
+def test_load_sequence(clickhouse, out_dir):
+    ClickHouseLoader(out_dir, clickhouse.url, batch_rows=4, connections=2).load()
+
+    assert query_kinds(clickhouse.queries) == [
+        "DROP TABLE",
+        "CREATE TABLE",
+        *["INSERT INTO"] * 3,
+        "CREATE TABLE",
+        "EXCHANGE TABLES",
+        "DROP TABLE",
+    ]
+    assert clickhouse.tables["raw_trips"]["rows"] == 10
+    assert "raw_trips_loading" not in clickhouse.tables
+
+
+def test_insert_is_retried_with_its_token(clickhouse, out_dir):
+    clickhouse.failures["INSERT INTO"] = ["after", "before"]
+
+    ClickHouseLoader(out_dir, clickhouse.url, batch_rows=4, connections=1).load()
+
+    inserts = [query for query in clickhouse.queries if query.startswith("INSERT")]
+    assert len(inserts) == 5
+    # the insert that went through before failing isn't written twice
+    assert len(clickhouse.tokens) == 3
+    assert clickhouse.tables["raw_trips"]["rows"] == 10
+
+
+def test_lost_exchange_response_is_not_reissued(clickhouse, out_dir):
+    clickhouse.failures["EXCHANGE TABLES"] = ["after"]
+
+    ClickHouseLoader(out_dir, clickhouse.url).load()
+
+    assert query_kinds(clickhouse.queries).count("EXCHANGE TABLES") == 1
+    assert clickhouse.tables["raw_trips"]["rows"] == 10
+    assert "raw_trips_loading" not in clickhouse.tables
+
+
+def test_failed_exchange_is_reissued(clickhouse, out_dir):
+    clickhouse.failures["EXCHANGE TABLES"] = ["before", "before"]
+
+    ClickHouseLoader(out_dir, clickhouse.url).load()
+
+    assert query_kinds(clickhouse.queries).count("EXCHANGE TABLES") == 3
+    assert clickhouse.tables["raw_trips"]["rows"] == 10
+
+
+def test_rejected_query_is_not_retried(clickhouse, out_dir, monkeypatch):
+    monkeypatch.setattr(
+        StubHandler,
+        "send_response",
+        lambda self, code, message=None: http.server.BaseHTTPRequestHandler.send_response(
+            self, 400 if "INSERT" in self.path else code, message
+        ),
+    )
+
+    with pytest.raises(RuntimeError):
+        ClickHouseLoader(out_dir, clickhouse.url, connections=1).load()
+
+    assert query_kinds(clickhouse.queries).count("INSERT INTO") == 1
+    assert clickhouse.tables["raw_trips"]["rows"] == 7
+
+
+def parse_columns(columns: str) -> typing.List[typing.Tuple[str, str]]:
+    return [
+        tuple(column.strip().split(" ", 1))
+        for column in columns.strip().split(",\n")
+        if column.strip()
+    ]
+
+
+def test_columns_match_create_table_sql():
+    with open(CREATE_RAW_TRIPS_SQL) as f:
+        sql = f.read()
+    columns = re.search(r"raw_trips \((.*?)\) ENGINE", sql, re.DOTALL).group(1)
+
+    assert parse_columns(RAW_TRIPS_COLUMNS) == parse_columns(columns)
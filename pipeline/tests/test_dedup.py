@@ -0,0 +1,52 @@
+import datetime
+import os
+
+import pyarrow.parquet as pq
+
+from conftest import make_trips
+from dedup import TripDeduplicator
+from parquet_writer import PartitionedParquetWriter
+
+START = datetime.datetime(2024, 5, 1)
+
+
+def trips(first: int, last: int):
+    return make_trips(
+        [START + datetime.timedelta(minutes=i) for i in range(first, last)],
+        ride_id=[f"ride-{i}" for i in range(first, last)],
+    )
+
+
+def rows(writer: PartitionedParquetWriter, output: str) -> int:
+    return pq.read_metadata(os.path.join(writer.out_dir, output)).num_rows
+
+
+def test_drops_duplicates_across_sources(tmp_path):
+    writer = PartitionedParquetWriter(str(tmp_path / "parquet"))
+    (first,) = writer.write(trips(0, 10), "NYC", "a")
+    (second,) = writer.write(trips(5, 15), "NYC", "b")
+
+    deduplicator = TripDeduplicator(writer, str(tmp_path))
+    assert deduplicator.deduplicate([first, second]) == 1
+
+    assert rows(writer, first) == 10
+    assert rows(writer, second) == 5
+    # restoring the dropped rows and deduplicating again gives the same output
+    assert deduplicator.deduplicate([first, second]) == 1
+    assert rows(writer, second) == 5
+
+
+def test_restores_rows_when_kept_copy_is_removed(tmp_path):
+    writer = PartitionedParquetWriter(str(tmp_path / "parquet"))
+    (first,) = writer.write(trips(0, 10), "NYC", "a")
+    (second,) = writer.write(trips(5, 15), "NYC", "b")
+    deduplicator = TripDeduplicator(writer, str(tmp_path))
+    deduplicator.deduplicate([first, second])
+
+    os.remove(os.path.join(writer.out_dir, first))
+    deduplicator.remove(first)
+    assert deduplicator.deduplicate([second]) == 1
+
+    table = pq.ParquetFile(os.path.join(writer.out_dir, second)).read()
+    assert table.column("ride_id").to_pylist() == [f"ride-{i}" for i in range(5, 15)]
+    assert not deduplicator.has_dropped(second)
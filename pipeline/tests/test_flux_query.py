@@ -0,0 +1,142 @@
+import datetime
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import make_trips
+from flux_query import FluxQuery
+from parquet_writer import PartitionedParquetWriter
+from station_resolver import STATIONS_FILE, StationIndex
+
+STATIONS = [
+    {
+        "station_id": f"id-{i}",
+        "name": f"Station {i}",
+        "short_name": f"10{i}",
+        "lat": 40.7 + i / 100,
+        "lon": -74.0,
+    }
+    for i in range(5)
+]
+SHORT_NAMES = {station["name"]: station["short_name"] for station in STATIONS}
+
+
+@pytest.fixture(scope="module")
+def trips(tmp_path_factory) -> pd.DataFrame:
+    """
+    Writes trips around a month boundary, some at a station that doesn't
+    resolve or without a start time, and returns them.
+    """
+    out_dir = tmp_path_factory.mktemp("flux")
+    with open(out_dir / STATIONS_FILE, "w") as f:
+        json.dump(STATIONS, f)
+
+    rng = np.random.default_rng(13)
+    rows = 2000
+    started_at = pd.Timestamp("2024-01-20") + pd.to_timedelta(
+        rng.integers(0, 21 * 24 * 3600, rows), unit="s"
+    )
+    ended_at = started_at + pd.to_timedelta(rng.integers(60, 3 * 3600, rows), unit="s")
+    names = [station["name"] for station in STATIONS] + ["Unknown"]
+    df = pd.DataFrame(
+        {
+            "started_at": started_at.to_series().reset_index(drop=True),
+            "ended_at": ended_at.to_series().reset_index(drop=True),
+            "start_station_name": rng.choice(names, rows),
+            "end_station_name": rng.choice(names, rows),
+        }
+    )
+    df.loc[rng.choice(rows, 20, replace=False), "started_at"] = pd.NaT
+
+    table = make_trips(
+        [None if pd.isna(t) else t.to_pydatetime() for t in df["started_at"]],
+        ended_at=[t.to_pydatetime() for t in df["ended_at"]],
+        start_station_name=list(df["start_station_name"]),
+        end_station_name=list(df["end_station_name"]),
+    )
+    writer = PartitionedParquetWriter(
+        os.path.join(out_dir, "parquet"),
+        row_group_size=200,
+        stations=StationIndex(STATIONS),
+    )
+    writer.write(table, "NYC", "trips")
+    df.attrs["out_dir"] = str(out_dir)
+    return df
+
+
+def expected_flux(df, start_date, end_date, start_time, end_time, days_of_week):
+    """
+    Counts flux with pandas, independently of the Arrow kernels.
+    """
+    resolved = df["start_station_name"].isin(SHORT_NAMES) & df["end_station_name"].isin(
+        SHORT_NAMES
+    )
+    start = pd.Timestamp(start_date)
+    end = pd.Timestamp(end_date) + pd.Timedelta(days=1)
+
+    counts = {}
+    for direction, station, timestamp in (
+        ("outbound", "start_station_name", "started_at"),
+        ("inbound", "end_station_name", "ended_at"),
+    ):
+        times = df[timestamp]
+        mask = resolved & (times >= start) & (times < end)
+        if start_time is not None:
+            time_of_day = (
+                times.dt.hour * 10000 + times.dt.minute * 100 + times.dt.second
+            )
+            if start_time > end_time:
+                mask &= (time_of_day > start_time) | (time_of_day < end_time)
+            else:
+                mask &= (time_of_day >= start_time) & (time_of_day <= end_time)
+        if days_of_week is not None:
+            # pandas counts Monday as 0
+            mask &= times.dt.dayofweek.isin(days_of_week)
+        counts[direction] = (
+            df.loc[mask, station].map(SHORT_NAMES).value_counts().to_dict()
+        )
+
+    return {
+        station: (counts["inbound"][station], counts["outbound"][station])
+        for station in sorted(counts["inbound"].keys() & counts["outbound"].keys())
+    }
+
+
+@pytest.mark.parametrize(
+    "start_date,end_date,start_time,end_time,days_of_week",
+    [
+        ("20240125", "20240205", None, None, None),
+        ("20240125", "20240205", None, None, [0]),
+        ("20240201", "20240201", None, None, [3]),
+        ("20240120", "20240209", "070000", "093000", [5, 6]),
+        ("20240128", "20240203", "220000", "040000", [0, 2, 4, 6]),
+    ],
+)
+def test_flux_matches_direct_count(
+    trips, start_date, end_date, start_time, end_time, days_of_week
+):
+    flux = FluxQuery(
+        trips.attrs["out_dir"],
+        start_date,
+        end_date,
+        start_time,
+        end_time,
+        days_of_week,
+        threads=2,
+    ).run()
+
+    expected = expected_flux(
+        trips,
+        start_date,
+        end_date,
+        int(start_time) if start_time else None,
+        int(end_time) if end_time else None,
+        days_of_week,
+    )
+    assert expected
+    assert {
+        row["station_id"]: (row["inbound"], row["outbound"]) for row in flux.to_pylist()
+    } == expected
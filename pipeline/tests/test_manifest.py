@@ -0,0 +1,111 @@
+import os
+
+import pytest
+from dask.distributed import Client
+
+from archive_transformer import ArchiveTransformer
+from cluster_config import ClusterConfig
+from manifest import TransformManifest
+from parquet_writer import PartitionedParquetStream
+
+HEADER = (
+    "ride_id,rideable_type,started_at,ended_at,start_station_name,"
+    "start_station_id,end_station_name,end_station_id,start_lat,start_lng,"
+    "end_lat,end_lng,member_casual\n"
+)
+SOURCE = "202401-citibike-tripdata.csv"
+
+
+def trip(ride_id: str) -> str:
+    return (
+        f"{ride_id},classic_bike,2024-01-01 00:07:14,2024-01-01 00:43:27,"
+        "A St,5013.46,B St,5008.12,40.83,-74.06,40.87,-73.92,member\n"
+    )
+
+
+def write_source(out_dir, ride_ids):
+    path = os.path.join(out_dir, "extracted", SOURCE)
+    with open(path, "w") as f:
+        f.write(HEADER + "".join(trip(ride_id) for ride_id in ride_ids))
+    return path
+
+
+@pytest.fixture(scope="module")
+def client():
+    # an in-process cluster, so that tests can patch the writer
+    with Client(processes=False, n_workers=1, threads_per_worker=1) as client:
+        yield client
+
+
+@pytest.fixture
+def out_dir(tmp_path, client, monkeypatch):
+    def start_client(self, total_bytes):
+        self.client = client
+        self.cluster = ClusterConfig(1, 1, 1 << 30)
+        return client
+
+    monkeypatch.setattr(ArchiveTransformer, "start_client", start_client)
+    os.makedirs(tmp_path / "archives")
+    os.makedirs(tmp_path / "extracted")
+    write_source(str(tmp_path), ["a", "b", "c"])
+    return str(tmp_path)
+
+
+def transformer(out_dir, **kwargs) -> ArchiveTransformer:
+    return ArchiveTransformer(out_dir, engine="arrow", **kwargs)
+
+
+def load_manifest(out_dir) -> TransformManifest:
+    return TransformManifest(os.path.join(out_dir, TransformManifest.FILE_NAME))
+
+
+def test_skips_unchanged_source(out_dir):
+    assert transformer(out_dir).transform_extracted() == 1
+    outputs = load_manifest(out_dir).outputs(SOURCE)
+    assert outputs
+
+    assert transformer(out_dir).transform_extracted() == 0
+    # a new mtime alone rehashes the file, which is still unchanged
+    path = os.path.join(out_dir, "extracted", SOURCE)
+    os.utime(path, (1, 1))
+    assert transformer(out_dir).transform_extracted() == 0
+    assert load_manifest(out_dir).outputs(SOURCE) == outputs
+
+
+def test_rewrites_source_with_changed_hash(out_dir):
+    transformer(out_dir).transform_extracted()
+    previous = load_manifest(out_dir).sources[SOURCE]
+
+    # same size, different content
+    write_source(out_dir, ["a", "b", "d"])
+    assert os.path.getsize(os.path.join(out_dir, "extracted", SOURCE)) == (
+        previous["size"]
+    )
+    assert transformer(out_dir).transform_extracted() == 1
+    assert load_manifest(out_dir).sources[SOURCE]["hash"] != previous["hash"]
+
+
+def test_rewrites_everything_when_settings_change(out_dir):
+    transformer(out_dir).transform_extracted()
+    (output,) = load_manifest(out_dir).outputs(SOURCE)
+
+    changed = transformer(out_dir, compression="zstd")
+    assert changed.manifest.settings == changed.settings()
+    assert not changed.manifest.sources
+    assert not os.path.exists(os.path.join(changed.parquet_dir, output))
+    assert changed.transform_extracted() == 1
+    assert load_manifest(out_dir).settings["compression"] == "zstd"
+
+
+def test_interrupted_write_is_not_recorded(out_dir, monkeypatch):
+    def interrupted_write(self, data):
+        raise RuntimeError("interrupted")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(PartitionedParquetStream, "write", interrupted_write)
+        with pytest.raises(RuntimeError, match="interrupted"):
+            transformer(out_dir).transform_extracted()
+
+    assert SOURCE not in load_manifest(out_dir).sources
+    assert transformer(out_dir).transform_extracted() == 1
+    assert SOURCE in load_manifest(out_dir).sources
@@ -0,0 +1,66 @@
+import datetime
+import os
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from conftest import make_trips
+from parquet_writer import NULL_PARTITION, PartitionedParquetWriter
+
+TRIPS = make_trips(
+    [
+        datetime.datetime(2024, 1, 31, 23, 59),
+        None,
+        datetime.datetime(2024, 2, 1, 0, 1),
+        datetime.datetime(2024, 1, 1, 8, 0),
+    ]
+)
+
+
+def read_dataset(out_dir: str) -> pa.Table:
+    return ds.dataset(out_dir, format="parquet", partitioning="hive").to_table()
+
+
+def test_write_partitions_by_month(tmp_path):
+    writer = PartitionedParquetWriter(str(tmp_path))
+
+    outputs = writer.write(TRIPS, "NYC", "trips")
+
+    assert outputs == [
+        os.path.join("system=NYC", "year=2024", "month=01", "trips.parquet"),
+        os.path.join("system=NYC", "year=2024", "month=02", "trips.parquet"),
+        os.path.join(
+            "system=NYC",
+            f"year={NULL_PARTITION}",
+            f"month={NULL_PARTITION}",
+            "trips.parquet",
+        ),
+    ]
+
+
+def test_write_keeps_trips_without_start_time(tmp_path):
+    writer = PartitionedParquetWriter(str(tmp_path))
+
+    writer.write(TRIPS, "NYC", "trips")
+
+    table = read_dataset(str(tmp_path))
+    assert table.num_rows == TRIPS.num_rows
+    missing = table.filter(ds.field("started_at").is_null())
+    assert missing.column("ride_id").to_pylist() == ["ride-1"]
+    assert missing.column("year").to_pylist() == [None]
+    # the null partition doesn't change the type partition values are read as
+    assert pa.types.is_integer(table.schema.field("year").type)
+
+
+def test_stream_keeps_trips_without_start_time(tmp_path):
+    writer = PartitionedParquetWriter(str(tmp_path))
+
+    stream = writer.open_stream("NYC", "trips")
+    stream.write(TRIPS.slice(0, 2))
+    stream.write(TRIPS.slice(2))
+    outputs = stream.close()
+
+    assert len(outputs) == 3
+    assert sorted(read_dataset(str(tmp_path)).column("ride_id").to_pylist()) == sorted(
+        TRIPS.column("ride_id").to_pylist()
+    )
@@ -0,0 +1,50 @@
+import datetime
+import os
+import re
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from conftest import make_trips
+from rollup import rollup
+
+BENCHMARK_QUERY = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "..",
+    "benchmark",
+    "queries",
+    "station-flux-rollups.sql",
+)
+
+# 2024-01-01 is a Monday
+WEEK = [datetime.datetime(2024, 1, day, 8, 30) for day in range(1, 8)]
+
+
+def week_rollup() -> pa.Table:
+    trips = make_trips(WEEK)
+    return rollup(
+        trips.append_column("start_current_station_id", pa.array(["A"] * len(WEEK))),
+        "outbound",
+    )
+
+
+def test_monday_is_zero():
+    counts = week_rollup().sort_by("date")
+
+    assert counts.column("day_of_week").to_pylist() == list(range(7))
+
+
+def test_days_match_benchmark_filter():
+    with open(BENCHMARK_QUERY) as f:
+        query = f.read()
+    # the benchmark passes days as 0 (Monday) to 6 (Sunday), the days of
+    # toDayOfWeek(t, 1) in the queries over the trips table
+    assert re.findall(r"day_of_week IN \(\{\{daysOfWeek\}\}\)", query)
+
+    counts = week_rollup()
+    for day, started_at in enumerate(WEEK):
+        matched = counts.filter(
+            pc.is_in(counts.column("day_of_week"), pa.array([day], pa.int8()))
+        )
+        assert matched.column("date").to_pylist() == [started_at.date()]
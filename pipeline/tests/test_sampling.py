@@ -0,0 +1,108 @@
+import datetime
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from conftest import make_trips
+from parquet_writer import PartitionedParquetWriter
+from sampling import SampleWriter, format_rate
+
+RATES = [0.05, 0.2]
+
+
+def write_trips(out_dir: str) -> dict[tuple, int]:
+    """
+    Streams two months of trips at stations of very different sizes, many too
+    small to be sampled by their hashes alone, in small chunks across a few
+    sources as the Arrow engine would, and reweights the samples. Returns the
+    trips of each station and month.
+    """
+    samples = SampleWriter(os.path.join(out_dir, SampleWriter.DIR), RATES)
+    writer = PartitionedParquetWriter(os.path.join(out_dir, "parquet"), samples=samples)
+
+    strata = {}
+    started_at, station_ids = [], []
+    for month, sizes in ((3, lambda i: 3 + i * i), (4, lambda i: 1 + i)):
+        start = datetime.datetime(2024, month, 1)
+        for i in range(40):
+            strata[(f"station-{i}", month)] = sizes(i)
+            for _ in range(sizes(i)):
+                started_at.append(start + datetime.timedelta(seconds=len(started_at)))
+                station_ids.append(f"station-{i}")
+    trips = make_trips(started_at, start_station_id=station_ids)
+
+    outputs = []
+    for source in range(3):
+        stream = writer.open_stream("NYC", f"source-{source}")
+        for offset in range(source * 500, trips.num_rows, 1500):
+            stream.write(trips.slice(offset, 500))
+        outputs.extend(stream.close())
+
+    samples.reweight(writer.out_dir, outputs)
+    return strata
+
+
+def read_sample(out_dir: str, rate: float) -> pa.Table:
+    return ds.dataset(
+        os.path.join(out_dir, SampleWriter.DIR, format_rate(rate)),
+        format="parquet",
+        partitioning="hive",
+    ).to_table()
+
+
+def test_realized_rate_matches_requested_rate(tmp_path):
+    strata = write_trips(str(tmp_path))
+    total = sum(strata.values())
+
+    for rate in RATES:
+        sample = read_sample(str(tmp_path), rate)
+        # every stratum keeps at least one trip, on top of the hashed sample
+        assert abs(sample.num_rows / total - rate) < rate * 0.15 + len(strata) / total
+
+
+def test_every_stratum_is_weighted_to_its_trips(tmp_path):
+    strata = write_trips(str(tmp_path))
+
+    for rate in RATES:
+        weights = (
+            read_sample(str(tmp_path), rate)
+            .group_by(["start_station_id", "month"])
+            .aggregate([("weight", "sum")])
+            .to_pylist()
+        )
+        weighted = {
+            (row["start_station_id"], row["month"]): row["weight_sum"]
+            for row in weights
+        }
+        assert weighted.keys() == strata.keys()
+        for stratum, weight in weighted.items():
+            assert abs(weight - strata[stratum]) < 1e-6
+
+
+def test_samples_are_nested(tmp_path):
+    write_trips(str(tmp_path))
+
+    low, high = (read_sample(str(tmp_path), rate) for rate in RATES)
+    assert pc.all(
+        pc.is_in(low.column("ride_id"), value_set=high.column("ride_id"))
+    ).as_py()
+
+
+def test_reweighting_again_keeps_samples(tmp_path):
+    write_trips(str(tmp_path))
+    before = read_sample(str(tmp_path), RATES[0]).sort_by("ride_id")
+
+    samples = SampleWriter(os.path.join(tmp_path, SampleWriter.DIR), RATES)
+    parquet_dir = os.path.join(tmp_path, "parquet")
+    samples.reweight(
+        parquet_dir,
+        [
+            os.path.relpath(os.path.join(root, name), parquet_dir)
+            for root, _, names in os.walk(parquet_dir)
+            for name in names
+        ],
+    )
+
+    assert read_sample(str(tmp_path), RATES[0]).sort_by("ride_id").equals(before)
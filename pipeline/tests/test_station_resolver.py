@@ -0,0 +1,127 @@
+import json
+import math
+import os
+
+import numpy as np
+import pyarrow as pa
+
+from station_resolver import (
+    METERS_PER_DEGREE,
+    STATIONS_FILE,
+    StationIndex,
+    fetch_stations,
+)
+
+# nothing listens on port 1, so fetching fails as it would offline
+UNREACHABLE_URL = "http://127.0.0.1:1/station_information.json"
+
+
+def test_unreachable_feed_leaves_trips_unresolved(tmp_path):
+    assert fetch_stations(UNREACHABLE_URL, str(tmp_path)) is None
+    assert not os.path.exists(tmp_path / STATIONS_FILE)
+
+
+def test_unreachable_feed_keeps_snapshot(tmp_path):
+    snapshot = tmp_path / STATIONS_FILE
+    snapshot.write_text(json.dumps([{"station_id": "1", "name": "A"}]))
+
+    path = fetch_stations(UNREACHABLE_URL, str(tmp_path), refresh=True)
+
+    assert path == str(snapshot)
+    assert json.loads(snapshot.read_text()) == [{"station_id": "1", "name": "A"}]
+
+
+STATIONS = [
+    {
+        "station_id": "a",
+        "name": "Alpha",
+        "short_name": "100",
+        "lat": 40.7,
+        "lon": -74.0,
+    },
+    {
+        "station_id": "b",
+        "name": "Beta",
+        "short_name": "200",
+        "lat": 40.71,
+        "lon": -74.01,
+    },
+    # 30 m east of Alpha, so that coordinates between them have two candidates
+    {
+        "station_id": "c",
+        "name": "Gamma",
+        "short_name": "300",
+        "lat": 40.7,
+        "lon": -74.0 + 30 / (METERS_PER_DEGREE * math.cos(math.radians(40.7))),
+    },
+]
+
+
+def offset(lat: float, lng: float, north: float = 0, east: float = 0) -> tuple:
+    """
+    Moves coordinates by the given meters.
+    """
+    return (
+        lat + north / METERS_PER_DEGREE,
+        lng + east / (METERS_PER_DEGREE * math.cos(math.radians(lat))),
+    )
+
+
+def resolve(index: StationIndex, trips: list) -> list:
+    names, station_ids, lats, lngs = zip(*trips)
+    return index.resolve_ids(
+        pa.array(names, pa.string()),
+        pa.array(station_ids, pa.string()),
+        pa.array(lats, pa.float64()),
+        pa.array(lngs, pa.float64()),
+    ).to_pylist()
+
+
+def test_matches_name_before_short_name():
+    index = StationIndex(STATIONS)
+
+    # the name wins over a short name of another station
+    assert resolve(index, [("Beta", "100", None, None)]) == ["b"]
+
+
+def test_falls_back_to_short_name():
+    index = StationIndex(STATIONS)
+
+    assert resolve(index, [("Old name", "200", None, None)]) == ["b"]
+
+
+def test_matches_nearest_station_within_tolerance():
+    index = StationIndex(STATIONS)
+    lat, lng = 40.7, -74.0
+
+    assert resolve(
+        index,
+        [
+            ("Old name", "999", *offset(lat, lng, north=10)),
+            # nearer to Gamma, in another grid cell than Alpha
+            ("Old name", "999", *offset(lat, lng, east=20)),
+            ("Old name", "999", *offset(lat, lng, north=-20, east=5)),
+        ],
+    ) == ["a", "c", "a"]
+
+
+def test_no_match_beyond_tolerance():
+    index = StationIndex(STATIONS)
+    lat, lng = offset(40.7, -74.0, north=StationIndex.TOLERANCE_METERS + 1)
+
+    assert resolve(index, [("Old name", "999", lat, lng)]) == [None]
+
+
+def test_no_match_for_missing_coordinates():
+    index = StationIndex(STATIONS)
+
+    assert resolve(
+        index,
+        [
+            ("Old name", "999", math.nan, math.nan),
+            ("Old name", "999", 40.7, math.nan),
+            (None, None, None, None),
+            ("Alpha", None, math.nan, math.nan),
+        ],
+    ) == [None, None, None, "a"]
+    assert list(index.nearest(np.array([math.nan]), np.array([-74.0]))) == [-1]
@@ -0,0 +1,73 @@
+import io
+
+import pandas as pd
+import pytest
+
+from arrow_csv_transformer import ArrowCSVTransformer
+from bulk_csv_transformer import BulkCSVTransformer
+from instrumentation import get_worker_counters, reset_worker_counters
+from parse_cache import ParseCache
+
+# a v2 file mixing ISO and US timestamp layouts, with an unparseable and a
+# missing start time
+MIXED_CSV = b"""ride_id,rideable_type,started_at,ended_at,start_station_name,start_station_id,end_station_name,end_station_id,start_lat,start_lng,end_lat,end_lng,member_casual
+a,classic_bike,2024-01-01 10:00:00,1/1/2024 10:05:00,S,1,E,2,40.7,-74.0,40.71,-74.01,member
+b,classic_bike,1/2/2024 11:00,2024-01-02T11:05:00.123,S,1,E,2,40.7,-74.0,40.71,-74.01,casual
+c,classic_bike,not a time,2024-01-02 11:05,S,1,E,2,40.7,-74.0,40.71,-74.01,member
+d,classic_bike,,2024-01-02 11:05,S,1,E,2,40.7,-74.0,40.71,-74.01,member
+"""
+
+EXPECTED_STARTED_AT = pd.to_datetime(
+    ["2024-01-01 10:00:00", "2024-01-02 11:00:00", None, None]
+)
+EXPECTED_ENDED_AT = pd.to_datetime(
+    [
+        "2024-01-01 10:05:00",
+        "2024-01-02 11:05:00.123",
+        "2024-01-02 11:05:00",
+        "2024-01-02 11:05:00",
+    ],
+    format="ISO8601",
+)
+
+
+def to_pandas(chunk) -> pd.DataFrame:
+    return chunk if isinstance(chunk, pd.DataFrame) else chunk.to_pandas()
+
+
+@pytest.mark.parametrize("transformer_class", [BulkCSVTransformer, ArrowCSVTransformer])
+def test_mixed_timestamp_layouts(transformer_class):
+    transformer = transformer_class(["mixed"], "v2")
+    (chunk,) = transformer.load_chunks(io.BytesIO(MIXED_CSV), 10)
+
+    df = to_pandas(chunk)
+    assert list(df["started_at"]) == list(EXPECTED_STARTED_AT)
+    assert list(df["ended_at"]) == list(EXPECTED_ENDED_AT)
+    # the missing start time isn't a parse failure
+    assert transformer.unparseable_rows(chunk) == 1
+
+
+def test_bulk_load_df_counts_unparseable_rows(tmp_path):
+    path = tmp_path / "mixed.csv"
+    path.write_bytes(MIXED_CSV)
+    reset_worker_counters()
+
+    df = BulkCSVTransformer([str(path)], "v2").load_df().compute(scheduler="sync")
+
+    assert list(df["started_at"]) == list(EXPECTED_STARTED_AT)
+    assert list(df["ended_at"]) == list(EXPECTED_ENDED_AT)
+    assert get_worker_counters() == {"unparseable_rows": 1}
+
+
+@pytest.mark.parametrize("transformer_class", [BulkCSVTransformer, ArrowCSVTransformer])
+def test_unparseable_rows_survive_parse_cache(tmp_path, transformer_class):
+    transformer = transformer_class(["mixed"], "v2")
+    cache = ParseCache(str(tmp_path))
+    chunks = map(
+        transformer.to_arrow, transformer.load_chunks(io.BytesIO(MIXED_CSV), 2)
+    )
+    list(cache.write("mixed", chunks))
+
+    cached = [transformer.from_arrow(table) for table in cache.read("mixed")]
+
+    assert [transformer.unparseable_rows(chunk) for chunk in cached] == [0, 1]
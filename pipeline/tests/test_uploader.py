@@ -0,0 +1,99 @@
+import os
+
+import boto3
+import pytest
+from boto3.s3.transfer import TransferConfig
+from moto import mock_aws
+
+from uploader import Uploader, local_etag
+
+BUCKET_NAME = "citibike-test"
+
+# S3 rejects parts smaller than 5 MiB, other than the last
+PART_SIZE = 5 * 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=PART_SIZE, multipart_chunksize=PART_SIZE, max_concurrency=2
+)
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.delenv("S3_ENDPOINT_URL", raising=False)
+    monkeypatch.setattr(Uploader, "TRANSFER_CONFIG", TRANSFER_CONFIG)
+
+    files = {
+        os.path.join("system=citibike", "year=2024", "month=1", "part-0.parquet"): 1000,
+        os.path.join("system=citibike", "year=2024", "month=2", "part-0.parquet"): (
+            2 * PART_SIZE + 1000
+        ),
+    }
+    for file, size in files.items():
+        path = tmp_path / file
+        path.parent.mkdir(parents=True)
+        path.write_bytes(os.urandom(size))
+
+    with mock_aws():
+        yield tmp_path
+
+
+def uploads(uploader: Uploader, monkeypatch) -> list:
+    uploaded = []
+    upload_file = uploader.client.upload_file
+
+    def recording_upload_file(path, bucket, key, **kwargs):
+        uploaded.append(key)
+        return upload_file(path, bucket, key, **kwargs)
+
+    monkeypatch.setattr(uploader.client, "upload_file", recording_upload_file)
+    return uploaded
+
+
+def test_local_etag_matches_bucket(data_dir):
+    Uploader(str(data_dir), BUCKET_NAME).upload()
+
+    objects = boto3.client("s3").list_objects_v2(Bucket=BUCKET_NAME)["Contents"]
+    assert len(objects) == 2
+    for obj in objects:
+        assert obj["ETag"].strip('"') == local_etag(os.path.join(data_dir, obj["Key"]))
+    assert any("-" in obj["ETag"] for obj in objects)
+
+
+def test_skips_unchanged_files(data_dir, monkeypatch):
+    Uploader(str(data_dir), BUCKET_NAME).upload()
+
+    uploader = Uploader(str(data_dir), BUCKET_NAME)
+    uploaded = uploads(uploader, monkeypatch)
+    uploader.upload()
+
+    assert uploaded == []
+
+
+def test_uploads_changed_files(data_dir, monkeypatch):
+    Uploader(str(data_dir), BUCKET_NAME).upload()
+    changed = data_dir / "system=citibike" / "year=2024" / "month=2" / "part-0.parquet"
+    # same size, different content, so only the ETag tells them apart
+    changed.write_bytes(os.urandom(changed.stat().st_size))
+
+    uploader = Uploader(str(data_dir), BUCKET_NAME)
+    uploaded = uploads(uploader, monkeypatch)
+    uploader.upload()
+
+    assert uploaded == ["system=citibike/year=2024/month=2/part-0.parquet"]
+
+
+def test_deletes_objects_of_removed_files(data_dir):
+    Uploader(str(data_dir), BUCKET_NAME).upload()
+    removed = data_dir / "system=citibike" / "year=2024" / "month=1" / "part-0.parquet"
+    renamed = data_dir / "system=citibike" / "year=2024" / "month=2" / "part-0.parquet"
+    removed.unlink()
+    renamed.rename(renamed.with_name("part-1.parquet"))
+
+    Uploader(str(data_dir), BUCKET_NAME).upload()
+
+    objects = boto3.client("s3").list_objects_v2(Bucket=BUCKET_NAME)["Contents"]
+    assert [obj["Key"] for obj in objects] == [
+        "system=citibike/year=2024/month=2/part-1.parquet"
+    ]